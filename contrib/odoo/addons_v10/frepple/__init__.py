@@ -18,3 +18,4 @@
 from . import controllers
 from . import scheduler
 from . import res_company
+from . import tombstone
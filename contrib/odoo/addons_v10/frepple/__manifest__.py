@@ -18,6 +18,7 @@
     ],
     'external_dependencies': {'python': ['jwt']},
     'data': [
+        'security/ir.model.access.csv',
         'frepple_data.xml',
     ],
     'demo': [],
@@ -16,6 +16,7 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
+import zlib
 import odoo
 from werkzeug.exceptions import MethodNotAllowed, InternalServerError
 from werkzeug.wrappers import Response
@@ -90,18 +91,28 @@ class XMLController(odoo.http.Controller):
                   uid=uid,
                   database=database,
                   company=kwargs.get('company', None),
-                  mode=int(kwargs.get('mode', 1))
+                  mode=int(kwargs.get('mode', 1)),
+                  delta=kwargs.get('delta', None)
                   )
                 # TODO Returning an iterator to stream the response back to the client and
                 # to save memory on the server side
-                return req.make_response(
-                    ''.join([i for i in xp.run()]),
-                    headers=[
-                        ('Content-Type', 'application/xml;charset=utf8'),
-                        ('Cache-Control', 'no-cache, no-store, must-revalidate'),
-                        ('Pragma', 'no-cache'),
-                        ('Expires', '0')
-                    ])
+                data = ''.join([i for i in xp.run()])
+                headers = [
+                    ('Content-Type', 'application/xml;charset=utf8'),
+                    ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+                    ('Pragma', 'no-cache'),
+                    ('Expires', '0'),
+                    # Value to pass as the delta argument of the next incremental export
+                    ('X-Frepple-Delta', xp.timestamp)
+                    ]
+                # Compress the data when the client accepts it
+                if 'gzip' in req.httprequest.headers.get('Accept-Encoding', ''):
+                    if isinstance(data, unicode):
+                        data = data.encode('utf-8')
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    data = compressor.compress(data) + compressor.flush()
+                    headers.append(('Content-Encoding', 'gzip'))
+                return req.make_response(data, headers=headers)
             except Exception as e:
                 logger.exception('Error generating frePPLe XML data')
                 raise InternalServerError(description='Error generating frePPLe XML data: check the Odoo log file for more details')
@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import json
 import logging
+from time import time
 from xml.sax.saxutils import quoteattr
 from datetime import datetime, timedelta
 from operator import itemgetter
@@ -27,7 +29,7 @@ logger = logging.getLogger(__name__)
 
 
 class exporter(object):
-    def __init__(self, req, uid, database=None, company=None, mode=1):
+    def __init__(self, req, uid, database=None, company=None, mode=1, delta=None):
         self.database = database
         self.company = company
 
@@ -48,11 +50,27 @@ class exporter(object):
         # Which data elements belong to each mode can vary between implementations.
         self.mode = mode
 
+        # The delta argument requests an incremental export. It is the UTC time
+        # of the previous export, in the format of the write_date field.
+        # Only the records changed since then are exported, and the records
+        # deleted since then are removed from the frePPLe model.
+        # Some entities, such as the calendars, locations, workcenters, bills of
+        # material, open purchase and manufacturing orders and the inventory,
+        # are always exported in full.
+        self.delta = delta
+
+        # Timestamp to pass as the delta argument of the next incremental export.
+        # It leaves a margin for transactions that were still open when we
+        # started reading the data. Records exported twice don't hurt.
+        self.timestamp = (datetime.utcnow() - timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S')
+
         # Initialize an environment
         self.env = req.env
 
 
     def run(self):
+        start = time()
+
         # Check if we manage by work orders or manufacturing orders.
         self.manage_work_orders = False
         m = self.env['ir.model']
@@ -70,6 +88,11 @@ class exporter(object):
         yield '<?xml version="1.0" encoding="UTF-8" ?>\n'
         yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" source="odoo_%s">\n' % self.mode
 
+        # Deleted records
+        if self.delta:
+            for i in self.timed(self.export_deletions):
+                yield i
+
         # Main content.
         # The order of the entities is important. First one needs to create the
         # objects before they are referenced by other objects.
@@ -77,36 +100,122 @@ class exporter(object):
         # operation_alternate, operation_alternate, etc) the reference would
         # automatically create an object, potentially of the wrong type.
         if self.mode == 1:
-            for i in self.export_calendar():
+            for i in self.timed(self.export_calendar):
                 yield i
-        for i in self.export_locations():
+        for i in self.timed(self.export_locations):
             yield i
-        for i in self.export_customers():
+        for i in self.timed(self.export_customers):
             yield i
         if self.mode == 1:
-            for i in self.export_suppliers():
+            for i in self.timed(self.export_suppliers):
                 yield i
-            for i in self.export_workcenters():
+            for i in self.timed(self.export_workcenters):
                 yield i
-        for i in self.export_items():
+        for i in self.timed(self.export_items):
             yield i
         if self.mode == 1:
-            for i in self.export_boms():
+            for i in self.timed(self.export_boms):
                 yield i
-        for i in self.export_salesorders():
+        for i in self.timed(self.export_salesorders):
             yield i
         if self.mode == 1:
-            for i in self.export_purchaseorders():
+            for i in self.timed(self.export_purchaseorders):
                 yield i
-            for i in self.export_manufacturingorders():
+            for i in self.timed(self.export_manufacturingorders):
                 yield i
-            for i in self.export_orderpoints():
+            for i in self.timed(self.export_orderpoints):
                 yield i
-            for i in self.export_onhand():
+            for i in self.timed(self.export_onhand):
                 yield i
 
         # Footer
         yield '</plan>\n'
+        logger.info("Exported odoo data in %.2f seconds" % (time() - start))
+
+
+    def timed(self, section):
+        '''
+        Runs an export method, and logs the time spent in it and the number of
+        XML lines it generated. The time spent by the caller to process the
+        lines isn't included.
+        '''
+        elapsed = 0
+        count = 0
+        lines = section()
+        while True:
+            t = time()
+            try:
+                line = next(lines)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time() - t
+            count += 1
+            yield line
+        logger.info("Exported %s: %d lines in %.2f seconds" % (section.__name__[7:], count, elapsed))
+
+
+    def read_by_id(self, model, ids, fields):
+        '''
+        Reads a list of records with a single batched read, and returns them in
+        a dictionary keyed by their id.
+        This avoids a separate read for each record we are exporting.
+        '''
+        result = {}
+        if ids:
+            for i in self.env[model].browse(list(set(ids))).read(fields):
+                result[i['id']] = i
+        logger.debug("Read %d %s records" % (len(result), model))
+        return result
+
+
+    def changed(self, *records):
+        '''
+        Returns true when a full export is running, or when one of the records
+        was modified since the previous export.
+        '''
+        return not self.delta or any(i['write_date'] > self.delta for i in records)
+
+
+    def remove(self, objects):
+        '''
+        Returns a processing instruction to delete a list of (entity, name)
+        objects from the frePPLe model.
+        A sales order line is planned as a single demand, or as a demand per
+        delivery with the delivery number appended to the name. Removing the
+        demand of a sales order line removes all of them.
+        An XML element with the action "R" aborts the processing of the data
+        when the object doesn't exist in frePPLe. The Python code we generate
+        here skips those objects instead.
+        '''
+        if not objects:
+            return ''
+        return '<?python\n' \
+          'import frepple\n' \
+          'objects = %s\n' \
+          'lines = set(n for e, n in objects if e == "demand")\n' \
+          'for n in [d.name for d in frepple.demands() if lines and (d.name in lines or d.name.rsplit(" ", 1)[0] in lines)]:\n' \
+          '  frepple.demand(name=n, action="R")\n' \
+          'for e, n in objects:\n' \
+          '  if e != "demand":\n' \
+          '    try:\n' \
+          '      getattr(frepple, e)(name=n, action="R")\n' \
+          '    except Exception:\n' \
+          '      pass\n' \
+          '?>\n' % json.dumps(objects).replace('>', '\\u003e')
+
+
+    def export_deletions(self):
+        '''
+        Removes the records deleted in Odoo since the previous export from the
+        frePPLe model, based on the frepple.tombstone model.
+        Only used during incremental exports.
+        '''
+        m = self.env['frepple.tombstone'].sudo()
+        recs = m.search([('create_date', '>', self.delta)])
+        if recs:
+            yield '<!-- deletions -->\n'
+            yield self.remove([(i['entity'], i['name']) for i in recs.read(['entity', 'name'])])
 
 
     def load_company(self):
@@ -332,10 +441,11 @@ class exporter(object):
         if recs:
             yield '<!-- customers -->\n'
             yield '<customers>\n'
-            fields = ['name']
+            fields = ['name', 'write_date']
             for i in recs.read(fields):
                 name = '%d %s' % (i['id'], i['name'])
-                yield '<customer name=%s/>\n' % quoteattr(name)
+                if self.changed(i):
+                    yield '<customer name=%s/>\n' % quoteattr(name)
                 self.map_customers[i['id']] = name
             yield '</customers>\n'
 
@@ -349,7 +459,10 @@ class exporter(object):
         res.partner.id res.partner.name -> supplier.name
         '''
         m = self.env['res.partner']
-        recs = m.search([('supplier', '=', True)])
+        if self.delta:
+            recs = m.search([('supplier', '=', True), ('write_date', '>', self.delta)])
+        else:
+            recs = m.search([('supplier', '=', True)])
         if recs:
             yield '<!-- suppliers -->\n'
             yield '<suppliers>\n'
@@ -413,7 +526,7 @@ class exporter(object):
         self.product_product = {}
         self.product_template_product = {}
         m = self.env['product.template']
-        fields = ['purchase_ok', 'route_ids', 'bom_ids', 'produce_delay', 'list_price', 'uom_id', 'seller_ids', 'standard_price']
+        fields = ['purchase_ok', 'route_ids', 'bom_ids', 'produce_delay', 'list_price', 'uom_id', 'seller_ids', 'standard_price', 'write_date']
         recs = m.search([])
         self.product_templates = {}
         for i in recs.read(fields):
@@ -437,13 +550,20 @@ class exporter(object):
         # Read the products
         m = self.env['product.product']
         recs = m.search([])
-        s = self.env['product.supplierinfo']
-        s_fields=['name', 'delay', 'min_qty', 'date_end', 'date_start', 'price']
-        supplier = {}
         if recs:
+            # Read the suppliers of all purchased items at once
+            supplierinfo = self.read_by_id(
+              'product.supplierinfo',
+              [
+                j for i in self.product_templates.values()
+                if i['purchase_ok'] and buy_route in i['route_ids']
+                for j in i['seller_ids']
+                ],
+              ['name', 'delay', 'min_qty', 'date_end', 'date_start', 'price', 'write_date']
+              )
             yield '<!-- products -->\n'
             yield '<items>\n'
-            fields = ['id','name', 'code', 'product_tmpl_id', 'seller_ids']
+            fields = ['id','name', 'code', 'product_tmpl_id', 'seller_ids', 'write_date']
             for i in recs.read(fields):
                 tmpl = self.product_templates[i['product_tmpl_id'][0]]
                 if i['code']:
@@ -453,6 +573,8 @@ class exporter(object):
                 prod_obj = {'name': name, 'template': i['product_tmpl_id'][0]}
                 self.product_product[i['id']] = prod_obj
                 self.product_template_product[i['product_tmpl_id'][0]] = prod_obj
+                if not self.changed(i, tmpl, *(supplierinfo[j] for j in tmpl['seller_ids'] if j in supplierinfo)):
+                    continue
                 yield '<item name=%s cost="%f" subcategory="%s,%s">\n' % (
                   quoteattr(name),
                   (tmpl['list_price'] or 0) / self.convert_qty_uom(1.0, tmpl['uom_id'][0], i['id']),
@@ -461,7 +583,7 @@ class exporter(object):
                 # Export suppliers for the item, if the item is allowed to be purchased
                 if tmpl['purchase_ok'] and buy_route in tmpl['route_ids'] and tmpl['seller_ids']:
                     yield '<itemsuppliers>\n'
-                    for sup in s.browse(tmpl['seller_ids']).read(s_fields):
+                    for sup in (supplierinfo[j] for j in tmpl['seller_ids']):
                         name = '%d %s' % (sup['name'][0], sup['name'][1])
                         yield '<itemsupplier leadtime="P%dD" priority="1" size_minimum="%f" cost="%f"%s%s><supplier name=%s/></itemsupplier>\n' %(
                           sup['delay'], sup['min_qty'], sup['price'],
@@ -473,6 +595,14 @@ class exporter(object):
                 yield '</item>\n'
             yield '</items>\n'
 
+        # Products that were archived since the previous export
+        if self.delta:
+            recs = m.search([('active', '=', False), ('write_date', '>', self.delta)])
+            yield self.remove([
+              ('item', u'[%s] %s' % (i['code'], i['name']) if i['code'] else i['name'])
+              for i in recs.read(['name', 'code'])
+              ])
+
 
     def export_boms(self):
         '''
@@ -514,26 +644,31 @@ class exporter(object):
             else:
                 mrp_routing_workcenters[i['routing_id'][0]] = [[i['workcenter_id'][1], i['time_cycle'], i['sequence']]]
 
-        # Models used in the bom-loop below
-        bom_lines_model = self.env['mrp.bom.line']
-        bom_lines_fields = [
-            'product_qty', 'product_uom_id', 'product_id', 'routing_id'
-        ]
-        try:
-          subproduct_model = self.env['mrp.subproduct']
-          subproduct_fields = [
-            'product_id', 'product_qty', 'product_uom', 'subproduct_type'
-            ]
-        except:
-          subproduct_model = None
-
-        # Loop over all bom records
+        # Read all bom records
         bom_recs = self.env['mrp.bom'].search([])
         bom_fields = [
             'product_qty', 'product_uom_id', 'product_tmpl_id',
             'routing_id', 'type', 'bom_line_ids', 'sub_products'
         ]
-        for i in bom_recs.read(bom_fields):
+        boms = bom_recs.read(bom_fields)
+
+        # Read the lines and byproducts of all boms at once
+        bom_lines = self.read_by_id(
+          'mrp.bom.line',
+          [j for i in boms for j in i['bom_line_ids']],
+          ['product_qty', 'product_uom_id', 'product_id', 'routing_id']
+          )
+        try:
+          subproducts = self.read_by_id(
+            'mrp.subproduct',
+            [j for i in boms for j in i.get('sub_products', None) or []],
+            ['product_id', 'product_qty', 'product_uom', 'subproduct_type']
+            )
+        except:
+          subproducts = None
+
+        # Loop over all bom records
+        for i in boms:
             # Determine the location
             if i['routing_id']:
                 location = mrp_routings.get(i['routing_id'][0], None)
@@ -577,7 +712,7 @@ class exporter(object):
                 # we sum up all quantities in a single flow. We assume all of them
                 # have the same effectivity.
                 fl = {}
-                for j in bom_lines_model.browse(i['bom_line_ids']).read(bom_lines_fields):
+                for j in (bom_lines[k] for k in i['bom_line_ids']):
                     product = self.product_product.get(j['product_id'][0], None)
                     if not product:
                         continue
@@ -596,8 +731,8 @@ class exporter(object):
                     )
 
                 # Build byproduct flows
-                if i.get('sub_products', None) and subproduct_model:
-                    for j in subproduct_model.browse(i['sub_products']).read(subproduct_fields):
+                if i.get('sub_products', None) and subproducts is not None:
+                    for j in (subproducts[k] for k in i['sub_products']):
                         product = self.product_product.get(j['product_id'][0], None)
                         if not product:
                             continue
@@ -648,8 +783,8 @@ class exporter(object):
                             quoteattr(product_buf['name'])
                             )
                         # Add byproduct flows
-                        if i.get('sub_products', None):
-                          for j in subproduct_model.browse(i['sub_products']).read(subproduct_fields):
+                        if i.get('sub_products', None) and subproducts is not None:
+                          for j in (subproducts[k] for k in i['sub_products']):
                             product = self.product_product.get(j['product_id'][0], None)
                             if not product:
                                 continue
@@ -665,7 +800,7 @@ class exporter(object):
                         # we sum up all quantities in a single flow. We assume all of them
                         # have the same effectivity.
                         fl = {}
-                        for j in bom_lines_model.browse(i['bom_line_ids']).read(bom_lines_fields):
+                        for j in (bom_lines[k] for k in i['bom_line_ids']):
                             product = self.product_product.get(j['product_id'][0], None)
                             if not product:
                                 continue
@@ -721,9 +856,23 @@ class exporter(object):
         '''
         # Get all sales order lines
         m = self.env['sale.order.line']
-        recs = m.search([('state', 'in', ['draft', 'sale'])])
+        if self.delta:
+            # The existing demands of the changed lines are replaced. The number
+            # of deliveries of a line can change, and lines that were closed or
+            # cancelled are removed from frePPLe.
+            recs = m.search([
+              '|', '|', ('write_date', '>', self.delta), ('order_id.write_date', '>', self.delta),
+              ('order_id.picking_ids.write_date', '>', self.delta)
+              ])
+        else:
+            recs = m.search([('state', 'in', ['draft', 'sale'])])
         fields = ['qty_delivered', 'state', 'product_id', 'product_uom_qty', 'product_uom', 'order_id']
         so_line = [i for i in recs.read(fields)]
+        replaced = [
+          ('demand', u'%s %d' % (i['order_id'][1], i['id']))
+          for i in so_line
+          ] if self.delta else []
+        so_line = [i for i in so_line if i['state'] in ('draft', 'sale')]
 
         # Get all sales orders
         m = self.env['sale.order']
@@ -733,15 +882,23 @@ class exporter(object):
         for i in m.browse(ids).read(fields):
             so[i['id']] = i
 
-        pick = self.env['stock.picking']
-        p_fields = ['move_lines', 'sale_id', 'state']
-        move = self.env['stock.move']
-        m_fields = ['product_id', 'product_uom_qty']
+        # Read the pickings and stock moves of all sales orders at once
+        pickings = self.read_by_id(
+          'stock.picking',
+          [j for i in so.values() for j in i['picking_ids']],
+          ['move_lines', 'sale_id', 'state']
+          )
+        moves = self.read_by_id(
+          'stock.move',
+          [j for i in pickings.values() for j in i['move_lines']],
+          ['product_id', 'product_uom_qty']
+          )
 
         # Generate the demand records
         deliveries = set()
         yield '<!-- sales order lines -->\n'
         yield '<demands>\n'
+        yield self.remove(replaced)
 
         for i in so_line:
             name = u'%s %d' % (i['order_id'][1], i['id'])
@@ -782,11 +939,7 @@ class exporter(object):
                 # if DO line is cancel, it will skip the current DO line
                 # else demand status is open
                 pick_number = 0
-                for p in pick.browse(j['picking_ids']).read(p_fields):
-                    p_ids = p['move_lines']
-                    product_id = i['product_id'][0]
-                    mv_ids = move.search([('id', 'in', p_ids), ('product_id','=', product_id)])
-
+                for p in (pickings[k] for k in j['picking_ids']):
                     status = ''
                     if p['state'] == 'done':
                         if self.mode == 1:
@@ -798,7 +951,9 @@ class exporter(object):
                     else:
                         status = 'open'
 
-                    for mv in mv_ids.read(m_fields):
+                    for mv in (moves[k] for k in p['move_lines']):
+                        if not mv['product_id'] or mv['product_id'][0] != i['product_id'][0]:
+                            continue
                         pick_number = pick_number + 1
                         name = u'%s %d %d' % (i['order_id'][1], i['id'], pick_number)
                         yield '<demand name=%s quantity="%s" due="%s" priority="%s" minshipment="%s" status="%s"><item name=%s/><customer name=%s/><location name=%s/></demand>\n' % (
@@ -918,7 +1073,10 @@ class exporter(object):
         convert stock.warehouse.orderpoint.qty_multiple -> buffer->size_multiple
         '''
         m = self.env['stock.warehouse.orderpoint']
-        recs = m.search([])
+        if self.delta:
+            recs = m.search([('write_date', '>', self.delta)])
+        else:
+            recs = m.search([])
         fields = ['warehouse_id', 'product_id', 'product_min_qty', 'product_max_qty', 'product_uom', 'qty_multiple']
         if recs:
             yield '<!-- order points -->\n'
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import sys
+import types
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.frepple.controllers.outbound import exporter
+
+
+class Request(object):
+    def __init__(self, env):
+        self.env = env
+
+
+class Demand(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class TestIncrementalExport(TransactionCase):
+
+    def getExporter(self, delta=None):
+        return exporter(Request(self.env), self.env.uid, mode=1, delta=delta)
+
+    def runRemove(self, instruction, demands):
+        '''
+        Runs a processing instruction generated by the exporter on a stand-in
+        frepple module, and returns the objects it removed.
+        '''
+        removed = []
+
+        def demand(name, action):
+            removed.append(('demand', name))
+
+        def item(name, action):
+            if name == 'missing':
+                raise Exception("Can't find object 'missing' for removal")
+            removed.append(('item', name))
+
+        frepple = types.ModuleType('frepple')
+        frepple.demand = demand
+        frepple.item = item
+        frepple.demands = lambda: [Demand(i) for i in demands]
+        self.assertTrue(instruction.startswith('<?python\n'))
+        self.assertTrue(instruction.endswith('?>\n'))
+        code = instruction[len('<?python\n'):-len('?>\n')]
+        self.assertNotIn('?>', code)
+        previous = sys.modules.get('frepple')
+        sys.modules['frepple'] = frepple
+        try:
+            exec(code, {})
+        finally:
+            if previous:
+                sys.modules['frepple'] = previous
+            else:
+                del sys.modules['frepple']
+        return removed
+
+    def test_remove(self):
+        instruction = self.getExporter().remove([
+            ('demand', u'SO001 5'), ('item', u'[A?>] item'), ('item', u'missing')
+            ])
+        removed = self.runRemove(
+            instruction, [u'SO001 5', u'SO001 5 1', u'SO001 5 2', u'SO001 50', u'SO001 6']
+            )
+        # The demands of all deliveries of the line are removed, and missing
+        # objects are skipped
+        self.assertEqual(sorted(removed), [
+            ('demand', u'SO001 5'), ('demand', u'SO001 5 1'), ('demand', u'SO001 5 2'),
+            ('item', u'[A?>] item')
+            ])
+        self.assertEqual(self.getExporter().remove([]), '')
+
+    def test_tombstones(self):
+        partner = self.env['res.partner'].create({'name': 'frePPLe test customer', 'customer': True})
+        name = u'%d %s' % (partner.id, partner.name)
+        product = self.env['product.product'].create({'name': 'frePPLe test product', 'default_code': 'FTP'})
+        partner.unlink()
+        product.unlink()
+        tombstones = self.env['frepple.tombstone'].search([]).read(['entity', 'name'])
+        self.assertIn(('customer', name), [(i['entity'], i['name']) for i in tombstones])
+        self.assertIn(('item', u'[FTP] frePPLe test product'), [(i['entity'], i['name']) for i in tombstones])
+
+        # An incremental export removes them from frePPLe
+        removed = self.runRemove(
+            ''.join(self.getExporter(delta='2000-01-01 00:00:00').export_deletions()), []
+            )
+        self.assertIn(('item', u'[FTP] frePPLe test product'), removed)
+
+    def test_changed_customers(self):
+        partner = self.env['res.partner'].create({'name': 'frePPLe test customer', 'customer': True})
+        partner.invalidate_cache()
+        write_date = partner.write_date
+        name = u'%d %s' % (partner.id, partner.name)
+
+        # Full export
+        xp = self.getExporter()
+        self.assertIn(name, ''.join(xp.export_customers()))
+        self.assertEqual(xp.map_customers[partner.id], name)
+
+        # Incremental export after the last change of the customer
+        xp = self.getExporter(delta=write_date)
+        self.assertNotIn(name, ''.join(xp.export_customers()))
+        self.assertEqual(xp.map_customers[partner.id], name)
+
+        # Incremental export before the last change of the customer
+        xp = self.getExporter(delta='2000-01-01 00:00:00')
+        self.assertIn(name, ''.join(xp.export_customers()))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from odoo import api, models, fields
+
+
+class frepple_tombstone(models.Model):
+    '''
+    Records deleted in Odoo.
+
+    An incremental export only sends the records changed since the previous
+    export. The records deleted in the meantime are looked up in this table,
+    and are deleted from the frePPLe model as well.
+    We store the entity and name of the frePPLe object, since we can't compute
+    them any longer once the Odoo record is deleted.
+    '''
+
+    _name = 'frepple.tombstone'
+    _description = 'Records to delete in frePPLe'
+    _order = 'id'
+
+    entity = fields.Char('Entity', required=True)
+    name = fields.Char('Name', required=True)
+
+    @api.model
+    def record(self, entity, names):
+        for name in names:
+            self.sudo().create({'entity': entity, 'name': name})
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    @api.multi
+    def unlink(self):
+        self.env['frepple.tombstone'].record('item', [
+            u'[%s] %s' % (i.code, i.name) if i.code else i.name
+            for i in self
+            ])
+        return super(ProductProduct, self).unlink()
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    @api.multi
+    def unlink(self):
+        tombstone = self.env['frepple.tombstone']
+        tombstone.record('customer', [u'%d %s' % (i.id, i.name) for i in self if i.customer])
+        tombstone.record('supplier', [u'%d %s' % (i.id, i.name) for i in self if i.supplier])
+        return super(ResPartner, self).unlink()
+
+
+class SaleOrderLine(models.Model):
+    _inherit = 'sale.order.line'
+
+    @api.multi
+    def unlink(self):
+        # The demand name of the line also matches the demands of its deliveries
+        self.env['frepple.tombstone'].record('demand', [
+            u'%s %d' % (i.order_id.name, i.id) for i in self
+            ])
+        return super(SaleOrderLine, self).unlink()
+
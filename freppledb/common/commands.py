@@ -19,7 +19,9 @@ from datetime import datetime
 from importlib import import_module
 from operator import attrgetter
 import os
+from queue import Queue
 import sys
+from threading import RLock, Thread
 
 if __name__ == "__main__":
   # Initialize django
@@ -27,7 +29,7 @@ if __name__ == "__main__":
   django.setup()
 
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.utils.encoding import force_text
 
 from freppledb.execute.models import Task
@@ -36,6 +38,9 @@ from freppledb.execute.models import Task
 class PlanTaskRegistry:
   reg = []
 
+  # Lock to serialize all changes to the frePPLe model from concurrent tasks
+  lock = RLock()
+
   @classmethod
   def register(cls, task):
     if not issubclass(task, PlanTask):
@@ -123,26 +128,56 @@ class PlanTaskRegistry:
     if not task_weights:
       task_weights = 1
 
-    # Execute all tasks in the list
+    # Execute all tasks in the list.
+    # A task is started as soon as all tasks it depends on are finished.
+    # When multiple tasks are ready at the same time they run in parallel,
+    # each in its own thread with its own database connection.
     try:
       progress = 0
-      for step in task_list:
+      dependencies = cls.getDependencies(task_list)
+      waiting = list(task_list)
+      running = []
+      finished = set()
+      done = Queue()
+      while waiting or running:
+        ready = [ i for i in waiting if dependencies[i] <= finished ]
+        if not ready and not running:
+          raise Exception("Circular dependency between planning tasks")
+        for step in ready:
+          waiting.remove(step)
+          running.append(step)
+          print("\nStart step %s '%s' at %s" % (
+            step.sequence,
+            step.description,
+            datetime.now().strftime("%H:%M:%S")
+            ))
+
         # Update status and message
         if cls.task:
           cls.task.status = '%d%%' % int(progress * 100.0 / task_weights)
-          cls.task.message = step.description
+          cls.task.message = ', '.join([ i.description for i in running ])
           cls.task.save(using=database)
 
-        # Run the step
-        print("\nStart step %s '%s' at %s" % (
-          step.sequence,
-          step.description,
-          datetime.now().strftime("%H:%M:%S")
-          ))
-        step.run(database=database, **kwargs)
+        if len(running) == 1 and ready:
+          # Run the step in the main thread
+          step = running.pop()
+          step.run(database=database, **kwargs)
+        else:
+          # Run the steps in parallel
+          for step in ready:
+            Thread(target=cls.runThread, args=(step, done, database), kwargs=kwargs).start()
+          step, exc = done.get()
+          running.remove(step)
+          if exc:
+            # Wait for the other running steps before reporting the error
+            for i in running:
+              done.get()
+            raise exc
+
         if step.sequence > 0:
           print("Finished '%s' at %s" % (step.description, datetime.now().strftime("%H:%M:%S")))
         progress += step.weight
+        finished.add(step)
 
       # Final task status
       if cls.task:
@@ -159,6 +194,44 @@ class PlanTaskRegistry:
         cls.task.save(using=database)
       raise
 
+  @classmethod
+  def getDependencies(cls, task_list):
+    '''
+    Returns a dictionary with the set of tasks each task needs to wait for.
+    A task without explicit dependencies waits for all tasks before it.
+    A task with explicit dependencies waits for those, and for the last
+    task without explicit dependencies before it. Explicit dependencies on
+    tasks that aren't active in this run are ignored.
+    '''
+    res = {}
+    barrier = None
+    for idx, step in enumerate(task_list):
+      if step.dependencies is None:
+        res[step] = set(task_list[:idx])
+        barrier = step
+      else:
+        res[step] = set([
+          i for i in task_list
+          if i == barrier or (i != step and i.__name__ in step.dependencies)
+          ])
+    return res
+
+  @classmethod
+  def runThread(cls, step, done, database=DEFAULT_DB_ALIAS, **kwargs):
+    # The main thread waits for the result of every step. It is reported
+    # for any exception, including a SystemExit raised by the step.
+    exc = None
+    try:
+      step.run(database=database, **kwargs)
+    except BaseException as e:
+      exc = e
+    finally:
+      try:
+        # Each thread uses its own database connection
+        connections[database].close()
+      finally:
+        done.put( (step, exc) )
+
 
 class PlanTask:
   '''
@@ -168,6 +241,11 @@ class PlanTask:
   sequence = None
   label = None
 
+  # Tuple with the class names of the tasks this task depends on.
+  # The default None means the task depends on all tasks with a lower
+  # sequence number.
+  dependencies = None
+
   @staticmethod
   def getWeight(**kwargs):
     return 1
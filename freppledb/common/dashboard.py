@@ -15,13 +15,18 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
 from importlib import import_module
 import logging
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
 from django.http import HttpResponseNotAllowed, HttpResponseForbidden, HttpResponseServerError
+from django.utils import translation
 
 logger = logging.getLogger(__name__)
 
@@ -46,11 +51,24 @@ class Dashboard:
       client browser.
       It should return HTML content for synchronous widgets.
       It should return a Django response object for asynchronous widgets.
+
+  The responses of asynchronous widgets with the attribute 'cacheable' are
+  cached. The cache key includes a version stamp of the scenario, which is
+  changed after each plan run and each data edit. The cache is configured
+  with the alias "dashboard" in the CACHES setting, and it needs to be shared
+  between the web server and the worker processes. The widgets aren't cached
+  when this alias is missing, or when it uses a local memory cache.
   '''
 
   __registry__ = {}
   __ready__ = False
 
+  # The user preferences that influence the output of a widget
+  cachePreferences = (
+    'horizonbuckets', 'horizonstart', 'horizonend', 'horizontype',
+    'horizonlength', 'horizonunit'
+    )
+
 
   @classmethod
   def register(cls, w):
@@ -87,7 +105,16 @@ class Dashboard:
         return HttpResponseServerError("This widget is synchronous")
       if not w.has_permission(request.user):
         return HttpResponseForbidden()
-      return w.render(request)
+      widgetcache = cls.getCache()
+      if not w.cacheable or widgetcache is None:
+        return w.render(request)
+      key = cls.getCacheKey(request, w)
+      response = widgetcache.get(key, None)
+      if response is None:
+        response = w.render(request)
+        if not response.streaming and response.status_code == 200:
+          widgetcache.set(key, response)
+      return response
     except Exception as e:
       logger.error("Exception rendering widget %s: %s" % (w.name, e))
       if settings.DEBUG:
@@ -96,6 +123,61 @@ class Dashboard:
         return HttpResponseServerError("Server error")
 
 
+  # Cache backends that aren't shared between processes
+  localCaches = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache'
+    )
+
+  @classmethod
+  def getCache(cls):
+    '''
+    Returns the cache of the widgets, or None when no shared cache is
+    configured.
+    '''
+    if settings.CACHES.get('dashboard', {}).get('BACKEND', cls.localCaches[0]) in cls.localCaches:
+      return None
+    return caches['dashboard']
+
+
+  @classmethod
+  def getVersion(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Returns the version stamp of the plan and the data of a scenario.
+    '''
+    widgetcache = cls.getCache()
+    if widgetcache is None:
+      return None
+    return widgetcache.get_or_set('dashboard:version:%s' % database, lambda: uuid4().hex, None)
+
+
+  @classmethod
+  def invalidate(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Assigns a new version stamp to a scenario, which makes all cached widgets
+    of the scenario obsolete.
+    This method is called after each plan run and after each data edit.
+    '''
+    widgetcache = cls.getCache()
+    if widgetcache is None:
+      return
+    try:
+      widgetcache.set('dashboard:version:%s' % database, uuid4().hex, None)
+    except Exception as e:
+      logger.error("Can't invalidate the dashboard cache of %s: %s" % (database, e))
+
+
+  @classmethod
+  def getCacheKey(cls, request, widget):
+    signature = '%s|%s|%s|%s|%s|%s' % (
+      widget.name, request.database, cls.getVersion(request.database),
+      translation.get_language(),
+      sorted(request.GET.items()),
+      [ getattr(request.user, i, None) for i in cls.cachePreferences ]
+      )
+    return 'dashboard:%s' % hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
   @classmethod
   def createWidgetPermissions(cls, app):
     # Registered all permissions defined by dashboard widgets
@@ -135,11 +217,15 @@ class Widget:
       It returns a HTTPResponse object for asynchronous widgets.
     - Class attribute 'url' optionally defines a url to a report with a more
       complete content than can be displayed in the dashboard widget.
+    - Class attribute 'cacheable' can be set to true for asynchronous widgets
+      that only display data from the database. The response is then cached
+      until the next plan run or data edit.
   '''
   name = "Undefined"
   title = "Undefined"
   permissions = ()
   asynchronous = False  # Asynchroneous widget
+  cacheable = False     # Cache the response of an asynchronous widget
   url = None            # URL opened when the header is clicked
   exporturl = False     # Enable or disable a download icon
   args = ''             # Arguments passed in the url for asynchronous widgets
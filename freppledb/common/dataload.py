@@ -15,15 +15,17 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from copy import copy
 from datetime import timedelta, datetime
 from decimal import Decimal
+from io import StringIO
 from logging import INFO, ERROR, WARNING, DEBUG
 
 from django import forms
 from django.contrib.admin.models import LogEntry, CHANGE, ADDITION
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
 from django.db.models.fields import IntegerField, AutoField, DurationField, BooleanField
 from django.db.models.fields import DateField, DateTimeField, TimeField, NOT_PROVIDED
 from django.db.models.fields.related import RelatedField
@@ -33,8 +35,11 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
+from freppledb.common.models import AuditModel, HierarchyModel
+from freppledb.common.pgcopy import escape
 
-def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+
+def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=False):
 
   class MappedRow:
     '''
@@ -123,10 +128,10 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
     # Some models have their own special uploading logic
     return model.parseData(data, MappedRow, user, database, ping)
   else:
-    return _parseData(model, data, MappedRow, user, database, ping)
+    return _parseData(model, data, MappedRow, user, database, ping, bulk)
 
 
-def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=False):
   '''
   This method:
     - reads CSV data from an input iterator
@@ -137,6 +142,9 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
     - the first row contains a header, listing all field names
     - a first character # marks a comment line
     - empty rows are skipped
+
+  With the bulk argument the records are validated and saved in batches,
+  which is a lot faster for large files.
   '''
 
   class MappedRow:
@@ -210,12 +218,27 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
     # Some models have their own special uploading logic
     return model.parseData(data, MappedRow, user, database, ping)
   else:
-    return _parseData(model, data, MappedRow, user, database, ping)
+    return _parseData(model, data, MappedRow, user, database, ping, bulk)
+
+
+def _bulkSupported(model):
+  '''
+  Bulk saving bypasses the save method of the model. It is only possible
+  for models that don't have any other logic in their save method than
+  the base classes we know of.
+  '''
+  if model._meta.proxy or isinstance(model._meta.pk, AutoField):
+    return False
+  for cls in model.__mro__:
+    if 'save' in cls.__dict__:
+      return cls in (AuditModel, HierarchyModel, models.Model)
+  return True
 
 
-def _parseData(model, data, rowmapper, user, database, ping):
+def _parseData(model, data, rowmapper, user, database, ping, bulk=False):
 
   selfReferencing = []
+  foreignKeys = {}
 
   def formfieldCallback(f):
     #global selfReferencing
@@ -223,10 +246,177 @@ def _parseData(model, data, rowmapper, user, database, ping):
       tmp = BulkForeignKeyFormField(field=f, using=database)
       if f.remote_field.model == model:
         selfReferencing.append(tmp)
+      foreignKeys[f.name] = tmp
       return tmp
     else:
       return f.formfield(localize=True)
 
+  def saveBatch(batch):
+    '''
+    Validates and saves a batch of rows:
+      - the existing records and the foreign keys are read with a single
+        query per batch
+      - each row is validated with the upload form, as in the normal mode,
+        except for the uniqueness of the primary key which is checked on
+        the records read for the batch
+      - the records are copied in a temporary table, and inserted or
+        updated in the model table with a single statement
+      - when that statement fails, the rows are saved one by one to report
+        the rows that fail
+    '''
+    nonlocal errors, changed, added, admin_log, pingcounter
+
+    # Read the existing records and the referenced foreign keys
+    pk = model._meta.pk
+    keys = set()
+    for rownum, r in batch:
+      try:
+        keys.add(pk.to_python(r[pk.name]))
+      except Exception:
+        pass
+    existing = { obj.pk: obj for obj in model.objects.using(database).filter(pk__in=keys) }
+    if issubclass(model, HierarchyModel):
+      owners = { obj.pk: obj.owner_id for obj in existing.values() }
+    for name, fld in foreignKeys.items():
+      fld.prefetch([ r[name] for rownum, r in batch ])
+
+    # Validate the rows
+    pending = {}
+    rows = {}
+    for rownum, r in batch:
+      try:
+        try:
+          key = pk.to_python(r[pk.name])
+        except Exception:
+          key = None
+        it = pending.get(key, None) or existing.get(key, None)
+        form = BatchForm(r, instance=it) if it else BatchForm(r)
+        if ping:
+          pingcounter += 1
+          if pingcounter >= 100:
+            pingcounter = 0
+            yield (DEBUG, rownum, None, None, None)
+        if not form.has_changed():
+          continue
+        if not form.is_valid():
+          # Validation fails
+          for error in form.non_field_errors():
+            errors += 1
+            yield (ERROR, rownum, None, None, error)
+          for field in form:
+            for error in field.errors:
+              errors += 1
+              yield (ERROR, rownum, field.name, r[field.name], error)
+          continue
+        obj = form.save(commit=False)
+        if not it and (obj.pk in existing or obj.pk in pending):
+          errors += 1
+          yield (
+            ERROR, rownum, pk.name, r[pk.name],
+            obj.unique_error_message(model, (pk.name,)).messages[0]
+            )
+          continue
+        # Mimic the save method of the base classes
+        if isinstance(obj, AuditModel):
+          obj.lastmodified = datetime.now()
+        if isinstance(obj, HierarchyModel) and (
+          obj.pk not in owners or owners[obj.pk] != obj.owner_id
+          ):
+            # A new record or a new owner requires a rebuild of the hierarchy
+            obj.lft = None
+            obj.rght = None
+            obj.lvl = None
+        pending[obj.pk] = obj
+        if not it:
+          # Add the new object in the cache of available keys
+          for x in selfReferencing:
+            if x.cache is not None:
+              if obj.pk not in x.cache:
+                x.cache[obj.pk] = obj
+            else:
+              x.batch[obj.pk] = obj
+        rows.setdefault(obj.pk, []).append((
+          rownum, bool(it),
+          LogEntry(
+            user_id=user.id,
+            content_type_id=content_type_id,
+            object_id=obj.pk,
+            object_repr=force_text(obj),
+            action_flag=it and CHANGE or ADDITION,
+            #. Translators: Translation included with Django
+            change_message='Changed %s.' % get_text_list(form.changed_data, 'and')
+          ) if user else None
+          ))
+      except Exception as e:
+        errors += 1
+        yield (ERROR, None, None, None, "Exception during upload: %s" % e)
+    if not pending:
+      return
+
+    # Copy the records in a temporary table, and merge them in the model table
+    try:
+      connection = connections[database]
+      qn = connection.ops.quote_name
+      columns = model._meta.concrete_fields
+      updates = [ f.column for f in columns if f.name in fields ]
+      if issubclass(model, AuditModel):
+        updates.append('lastmodified')
+      if issubclass(model, HierarchyModel):
+        updates.extend(['lft', 'rght', 'lvl'])
+      updates = [ c for c in updates if c != pk.column ]
+      buf = StringIO()
+      for obj in pending.values():
+        print('\t'.join(
+          escape(f.get_db_prep_save(getattr(obj, f.attname), connection))
+          for f in columns
+          ), file=buf)
+      buf.seek(0)
+      with transaction.atomic(using=database):
+        cursor = connection.cursor()
+        cursor.execute(
+          'create temporary table tmp_upload on commit drop as select %s from %s limit 0' % (
+            ', '.join(qn(f.column) for f in columns), qn(model._meta.db_table)
+          ))
+        cursor.copy_expert(
+          'copy tmp_upload (%s) from stdin' % ', '.join(qn(f.column) for f in columns),
+          buf
+          )
+        cursor.execute(
+          'insert into %s (%s) select %s from tmp_upload on conflict (%s) do %s' % (
+            qn(model._meta.db_table),
+            ', '.join(qn(f.column) for f in columns),
+            ', '.join(qn(f.column) for f in columns),
+            qn(pk.column),
+            ('update set %s' % ', '.join('%s = excluded.%s' % (qn(c), qn(c)) for c in updates)) if updates else 'nothing'
+          ))
+        cursor.execute('drop table tmp_upload')
+      saved = pending.values()
+    except Exception:
+      # Save the rows one by one, to report the rows that fail
+      saved = []
+      for obj in pending.values():
+        try:
+          with transaction.atomic(using=database):
+            if obj.pk in existing:
+              obj.save(using=database, force_update=True)
+            else:
+              obj.save(using=database, force_insert=True)
+          saved.append(obj)
+        except Exception as e:
+          errors += 1
+          yield (ERROR, rows[obj.pk][-1][0], None, None, "Exception during upload: %s" % e)
+    for obj in saved:
+      for rownum, it, entry in rows[obj.pk]:
+        if it:
+          changed += 1
+        else:
+          added += 1
+        if entry:
+          admin_log.append(entry)
+    if len(admin_log) > 100:
+      LogEntry.objects.all().using(database).bulk_create(admin_log)
+      admin_log = []
+
   # Initialize
   headers = []
   rownumber = 0
@@ -317,6 +507,18 @@ def _parseData(model, data, rowmapper, user, database, ping):
         )
       rowWrapper = rowmapper(headers)
 
+      # The bulk mode requires a primary key in the data, and a model
+      # without custom logic in its save method
+      bulk = bulk and has_pk_field and _bulkSupported(model)
+      batch = []
+      if bulk:
+        class BatchForm(UploadForm):
+          def validate_unique(self):
+            # The uniqueness of the primary key is checked on the records
+            # read for the batch. The other unique constraints are checked
+            # by the database.
+            pass
+
       # Get natural keys for the class
       natural_key = None
       if hasattr(model.objects, 'get_by_natural_key'):
@@ -329,7 +531,14 @@ def _parseData(model, data, rowmapper, user, database, ping):
     elif len(rowWrapper) == 0:
       continue
 
-    # Case 3: Process a data row
+    # Case 3a: Collect a batch of data rows
+    elif bulk:
+      batch.append( (rownumber, copy(rowWrapper)) )
+      if len(batch) >= 1000:
+        yield from saveBatch(batch)
+        batch = []
+
+    # Case 3b: Process a data row
     else:
       try:
         # Step 1: Send a ping-alive message to make the upload interruptable
@@ -417,6 +626,10 @@ def _parseData(model, data, rowmapper, user, database, ping):
         errors += 1
         yield (ERROR, None, None, None, "Exception during upload: %s" % e)
 
+  # Save the remaining batch
+  if bulk and batch:
+    yield from saveBatch(batch)
+
   # Save remaining admin log entries
   LogEntry.objects.all().using(database).bulk_create(admin_log)
 
@@ -445,6 +658,7 @@ class BulkForeignKeyFormField(forms.fields.Field):
     if field.remote_field.model._default_manager.all().using(using).count() > 20000:
       self.queryset = field.remote_field.model._default_manager.all().using(using)
       self.cache = None
+      self.batch = {}
     else:
       self.queryset = None
       self.cache = { obj.pk: obj for obj in field.remote_field.model._default_manager.all().using(using) }
@@ -461,6 +675,8 @@ class BulkForeignKeyFormField(forms.fields.Field):
           'Select a valid choice. That choice is not one of'
           ' the available choices.'
           ))
+    elif value in self.batch:
+      return self.batch[value]
     else:
       try:
         return self.queryset.get(pk=value)
@@ -471,5 +687,19 @@ class BulkForeignKeyFormField(forms.fields.Field):
           ))
 
 
+  def prefetch(self, values):
+    '''
+    Reads all referenced records of a batch of rows with a single query.
+    This is only needed when the table is too big for the cache.
+    '''
+    if self.cache is not None:
+      return
+    values = set(v for v in values if v not in EMPTY_VALUES and v not in self.batch)
+    if values:
+      self.batch.update({
+        obj.pk: obj for obj in self.queryset.filter(pk__in=values)
+        })
+
+
   def has_changed(self, initial, data):
     return initial != data
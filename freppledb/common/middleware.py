@@ -29,6 +29,7 @@ from django.db import DEFAULT_DB_ALIAS
 from django.http import HttpResponseNotFound
 from django.http.response import HttpResponseForbidden
 
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import Scenario, User
 
 import logging
@@ -138,7 +139,14 @@ class MultiDBMiddleware(object):
     - _state.db: a bit of a hack for the django internal stuff
     - is_active
     - is_superuser
+
+  After a request that changed data in a scenario, the cached dashboard
+  widgets of the scenario are invalidated.
   """
+
+  # Requests that only change the preferences or the session of the user
+  preferenceRequests = re.compile(r'^/(preferences|horizon|settings|data/login|data/logout)/')
+
   def process_request(self, request):
     request.user = auth.get_user(request)
     if not hasattr(request.user, 'scenarios'):
@@ -184,3 +192,10 @@ class MultiDBMiddleware(object):
         request.scenario = default_scenario
       else:
         request.scenario = Scenario(name=DEFAULT_DB_ALIAS)
+
+  def process_response(self, request, response):
+    # A successful update of the data invalidates the cached dashboard widgets
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 \
+      and not self.preferenceRequests.match(request.path):
+      Dashboard.invalidate(getattr(request, 'database', DEFAULT_DB_ALIAS))
+    return response
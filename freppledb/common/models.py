@@ -33,6 +33,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.text import capfirst
 
 from freppledb.common.fields import JSONBField
+from freppledb.common.pgcopy import CopyFromGenerator, escape
 
 
 logger = logging.getLogger(__name__)
@@ -49,34 +50,105 @@ class HierarchyModel(models.Model):
                             related_name='xchildren', help_text=_('Hierarchical parent'),
                             on_delete=models.CASCADE)
 
+  # The nested set numbering leaves free numbers after the children of each
+  # node. New nodes and moved subtrees are numbered within this free space,
+  # and only when there is no room left the hierarchy is rebuilt.
+  maxGap = 10000
+
   def save(self, *args, **kwargs):
-    # Trigger recalculation of the hieracrhy.
-    # TODO this triggers the recalculation in too many cases, including a lot
-    # of changes which don't require it. Alternative solution is to use the
-    # pre-save signal which has more information.
-    self.lft = None
-    self.rght = None
-    self.lvl = None
+    # Keep the hierarchy up to date. Only a new record or a change of the
+    # owner requires a renumbering.
+    update_fields = kwargs.get('update_fields', None)
+    if update_fields is not None:
+      if 'owner' not in update_fields:
+        super(HierarchyModel, self).save(*args, **kwargs)
+        return
+      kwargs['update_fields'] = set(update_fields) | {'lft', 'rght', 'lvl'}
+    database = kwargs.get('using', None) or self._state.db or DEFAULT_DB_ALIAS
+    with transaction.atomic(using=database):
+      self.updateHierarchy(database)
 
-    # Call the real save() method
-    super(HierarchyModel, self).save(*args, **kwargs)
+      # Call the real save() method
+      super(HierarchyModel, self).save(*args, **kwargs)
 
-  def delete(self, *args, **kwargs):
-    try:
-      # Update an arbitrary other object to trigger recalculation of the hierarchy
-      obj = self.__class__.objects.using(self._state.db).exclude(pk=self.pk)[0]
-      obj.lft = None
-      obj.rght = None
-      obj.lvl = None
-      obj.save(
-        update_fields=['lft', 'rght', 'lvl'],
-        using=self._state.db
+  def updateHierarchy(self, database=DEFAULT_DB_ALIAS):
+    '''
+    Computes the lft, rght and lvl fields of this record. When the record
+    moves to another owner, the records below it are renumbered as well.
+    When the hierarchy can't be updated locally, the fields are set to null.
+    The next call to rebuildHierarchy then renumbers the complete hierarchy.
+    '''
+    table = connections[database].ops.quote_name(self._meta.db_table)
+    cursor = connections[database].cursor()
+    cursor.execute(
+      "select owner_id, lft, rght, lvl from %s where name = %%s for update" % table,
+      (self.name,)
+      )
+    current = cursor.fetchone()
+    if current and current[1] is None:
+      # Waiting for a rebuild
+      self.lft = self.rght = self.lvl = None
+      return
+    if current and current[0] == self.owner_id:
+      # The hierarchy didn't change
+      self.lft, self.rght, self.lvl = current[1:]
+      return
+
+    # Find the free numbers after the last child of the new owner
+    if self.owner_id:
+      cursor.execute(
+        "select lft, rght, lvl from %s where name = %%s for update" % table,
+        (self.owner_id,)
         )
-    except:
-      # Failure can happen when eg we delete the last record
-      pass
-    # Call the real delete() method
-    super(HierarchyModel, self).delete(*args, **kwargs)
+      owner = cursor.fetchone()
+      if not owner or owner[0] is None \
+        or (current and current[1] <= owner[0] <= current[2]):
+          # Owner is waiting for a rebuild, or we have a loop in the hierarchy
+          self.lft = self.rght = self.lvl = None
+          return
+      cursor.execute(
+        "select max(rght) from %s where owner_id = %%s and name <> %%s" % table,
+        (self.owner_id, self.name)
+        )
+      lastchild = cursor.fetchone()[0]
+      first = (lastchild if lastchild is not None else owner[0]) + 1
+      last = owner[1] - 1
+      level = owner[2] + 1
+    else:
+      cursor.execute(
+        "select max(rght) from %s where owner_id is null and name <> %%s" % table,
+        (self.name,)
+        )
+      lastroot = cursor.fetchone()[0]
+      first = (lastroot or 0) + 1
+      last = 2 ** 31 - 1
+      level = 0
+
+    if current:
+      # Move the record and the records below it
+      width = current[2] - current[1] + 1
+      if last - first + 1 < width:
+        self.lft = self.rght = self.lvl = None
+        return
+      cursor.execute('''
+        update %s
+        set lft = lft + %%s, rght = rght + %%s, lvl = lvl + %%s
+        where lft between %%s and %%s
+        ''' % table,
+        (first - current[1], first - current[1], level - current[3], current[1], current[2])
+        )
+      self.lft = first
+      self.rght = first + width - 1
+      self.lvl = level
+    else:
+      # Number a new record, leaving free numbers for its children
+      span = max(2, min((last - first + 1) // 8, self.maxGap + 2))
+      if last - first + 1 < span:
+        self.lft = self.rght = self.lvl = None
+        return
+      self.lft = first
+      self.rght = first + span - 1
+      self.lvl = level
 
   class Meta:
     abstract = True
@@ -89,80 +161,128 @@ class HierarchyModel(models.Model):
     if len(cls.objects.using(database).filter(lft__isnull=True)[:1]) == 0:
       return
 
-    nodes = {}
-    children = {}
-    updates = []
+    # Load all nodes in memory
+    nodes = { i: j for i, j in cls.objects.using(database).values_list('name', 'owner') }
 
-    def tagChildren(me, left, level):
-      right = left + 1
-      # Get all children of this node
-      for i in children.get(me, []):
-        # Recursive execution of this function for each child of this node
-        right = tagChildren(i, right, level + 1)
+    # Spread the numbers over half of the integer range, leaving the other
+    # half for new top level nodes
+    gap = max(0, min(cls.maxGap, 2 ** 30 // (len(nodes) + 1) - 2))
+    updates = cls.numberHierarchy(nodes, gap)
 
-      # After processing the children of this node now know its left and right values
-      updates.append( (left, right, level, me) )
+    # Write all results to the database: copy them in a temporary table and
+    # update the table with a single statement
+    table = connections[database].ops.quote_name(cls._meta.db_table)
+    with transaction.atomic(using=database):
+      cursor = connections[database].cursor()
+      cursor.execute('''
+        create temporary table tmp_hierarchy (
+          name character varying(300) NOT NULL,
+          lft integer NOT NULL,
+          rght integer NOT NULL,
+          lvl integer NOT NULL
+        )
+        ''')
+      cursor.copy_from(
+        CopyFromGenerator(
+          "%s\t%s\t%s\t%s" % (
+            escape(i[0]), i[1], i[2], i[3]
+            )
+          for i in updates
+          ),
+        'tmp_hierarchy',
+        size=256 * 1024
+        )
+      cursor.execute('''
+        update %s
+        set lft = tmp.lft, rght = tmp.rght, lvl = tmp.lvl
+        from tmp_hierarchy as tmp
+        where %s.name = tmp.name
+        ''' % (table, table))
+      cursor.execute("drop table tmp_hierarchy")
 
-      # Remove from node list (to mark as processed)
-      del nodes[me]
+  @staticmethod
+  def numberHierarchy(nodes, gap=0):
+    '''
+    Computes the nested set numbering of a hierarchy.
+    The argument is a dictionary with the owner of every node. Nodes that
+    are part of a loop are logged and changed into top level nodes.
+    Returns a list with the name, left, right and level of every node.
+    The execution time is linear in the number of nodes.
+    '''
+    children = {}
+    roots = []
+    for i, j in nodes.items():
+      if j is None:
+        roots.append(i)
+      elif i == j:
+        logging.error("Data error: '%s' points to itself as owner" % i)
+        nodes[i] = None
+        roots.append(i)
+      elif j not in nodes:
+        logging.error("Data error: '%s' has an unknown owner '%s'" % (i, j))
+        nodes[i] = None
+        roots.append(i)
+      else:
+        if j not in children:
+          children[j] = []
+        children[j].append(i)
 
-      # Return the right value of this node + 1
-      return right + 1
+    result = []
+    cnt = 1
 
-    # Load all nodes in memory
-    for i in cls.objects.using(database).values('name', 'owner'):
-      if i['name'] == i['owner']:
-        logging.error("Data error: '%s' points to itself as owner" % i['name'])
-        nodes[i['name']] = None
-      else:
-        nodes[i['name']] = i['owner']
-        if i['owner']:
-          if not i['owner'] in children:
-            children[i['owner']] = set()
-          children[i['owner']].add(i['name'])
-    keys = sorted(nodes.items())
+    def tagChildren(root, cnt):
+      # Depth-first traversal with an explicit stack, so deep hierarchies
+      # don't run into the recursion limit of Python
+      stack = [ (root, cnt, 0, iter(children.get(root, ()))) ]
+      cnt += 1
+      while stack:
+        me, left, level, todo = stack[-1]
+        for i in todo:
+          # Skip nodes that were changed into top level nodes
+          if nodes[i] == me:
+            stack.append( (i, cnt, level + 1, iter(children.get(i, ()))) )
+            cnt += 1
+            break
+        else:
+          # After processing the children of this node now know its
+          # left and right values, leaving free numbers for new children
+          stack.pop()
+          cnt += gap
+          result.append( (me, left, cnt, level) )
+          cnt += 1
+      return cnt
 
     # Loop over nodes without parent
-    cnt = 1
-    for i, j in keys:
-      if j is None:
-        cnt = tagChildren(i, cnt, 0)
+    for i in sorted(roots):
+      cnt = tagChildren(i, cnt)
 
-    if nodes:
-      # If the nodes dictionary isn't empty, it is an indication of an
-      # invalid hierarchy.
-      # There are loops in your hierarchy, ie parent-chains not ending
+    if len(result) < len(nodes):
+      # Some nodes can't be reached from a top-level node. This is an
+      # indication of loops in the hierarchy, ie parent-chains not ending
       # at a top-level node without parent.
-      bad = nodes.copy()
-      updated = True
-      while updated:
-        updated = False
-        for i in bad.keys():
-          ok = True
-          for j, k in bad.items():
-            if k == i:
-              ok = False
-              break
-          if ok:
-            # If none of the bad keys points to me as a parent, I am unguilty
-            del bad[i]
-            updated = True
-      logging.error("Data error: Hierarchy loops among %s" % sorted(bad.keys()))
-      for i, j in sorted(bad.items()):
+      # Each remaining node is visited once while following its chain of
+      # owners. A chain that runs into itself identifies a loop.
+      done = { i[0]: None for i in result }
+      loops = []
+      for i in nodes:
+        if i in done:
+          continue
+        path = []
+        j = i
+        while j not in done:
+          done[j] = i
+          path.append(j)
+          j = nodes[j]
+        if done[j] == i:
+          loops.extend(path[path.index(j):])
+      logging.error("Data error: Hierarchy loops among %s" % sorted(loops))
+
+      # Continue with the nodes in a loop as top level nodes
+      for i in loops:
         nodes[i] = None
-
-      # Continue loop over nodes without parent
-      keys = sorted(nodes.items())
-      for i, j in keys:
-        if j is None:
-          cnt = tagChildren(i, cnt, 0)
-
-    # Write all results to the database
-    with transaction.atomic(using=database):
-      connections[database].cursor().executemany(
-        'update %s set lft=%%s, rght=%%s, lvl=%%s where name = %%s' % connections[database].ops.quote_name(cls._meta.db_table),
-        updates
-        )
+      for i in sorted(loops):
+        cnt = tagChildren(i, cnt)
+    return result
 
 
 class MultiDBManager(models.Manager):
@@ -0,0 +1,346 @@
+#
+# Copyright (C) 2017 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r'''
+Utilities to move data in and out of PostgreSQL with the COPY statement.
+
+The binary COPY format is documented at
+https://www.postgresql.org/docs/current/static/sql-copy.html
+'''
+
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal, Context
+import json
+from struct import Struct
+import tempfile
+
+import pytz
+
+
+# Header of a binary COPY stream: signature, flags field and header extension length
+COPY_SIGNATURE = b'PGCOPY\n\377\r\n\0'
+
+_int16 = Struct('!h')
+_int32 = Struct('!i')
+_int64 = Struct('!q')
+_uint16 = Struct('!H')
+_float32 = Struct('!f')
+_float64 = Struct('!d')
+_numeric_header = Struct('!hhHh')
+_interval = Struct('!qii')
+
+# PostgreSQL stores dates and timestamps relative to 2000-01-01
+_epoch_date = date(2000, 1, 1)
+_epoch_datetime = datetime(2000, 1, 1)
+_infinity = 0x7FFFFFFFFFFFFFFF
+
+# Large enough to decode any numeric without rounding
+_numeric_context = Context(prec=1000)
+
+
+def _decode_bool(data):
+  return data != b'\x00'
+
+
+def _decode_text(data):
+  return data.decode('utf-8')
+
+
+def _decode_json(data):
+  return json.loads(data.decode('utf-8'))
+
+
+def _decode_jsonb(data):
+  # The first byte holds the jsonb format version
+  return json.loads(data[1:].decode('utf-8'))
+
+
+def _decode_numeric(data):
+  ndigits, weight, sign, dscale = _numeric_header.unpack_from(data)
+  if sign == 0xC000:
+    return Decimal('NaN')
+  digits = Struct('!%dH' % ndigits).unpack_from(data, 8)
+  value = Decimal((
+    1 if sign == 0x4000 else 0,
+    tuple(int(c) for c in ''.join('%04d' % d for d in digits)) or (0,),
+    (weight - ndigits + 1) * 4
+    ))
+  return value.quantize(Decimal((0, (1,), -dscale)), context=_numeric_context)
+
+
+def _decode_date(data):
+  days = _int32.unpack(data)[0]
+  if days == 0x7FFFFFFF:
+    return date.max
+  elif days == -0x80000000:
+    return date.min
+  return _epoch_date + timedelta(days=days)
+
+
+def _decode_timestamp(data):
+  micro = _int64.unpack(data)[0]
+  if micro == _infinity:
+    return datetime.max
+  elif micro == -_infinity - 1:
+    return datetime.min
+  return _epoch_datetime + timedelta(microseconds=micro)
+
+
+def _decode_time(data):
+  micro = _int64.unpack(data)[0]
+  seconds, micro = divmod(micro, 1000000)
+  minutes, seconds = divmod(seconds, 60)
+  hours, minutes = divmod(minutes, 60)
+  return time(hours, minutes, seconds, micro)
+
+
+def _decode_interval(data):
+  micro, days, months = _interval.unpack(data)
+  # Same convention as psycopg2: a month counts as 30 days
+  return timedelta(days=days + months * 30, microseconds=micro)
+
+
+# Decoders for the binary representation, keyed by the PostgreSQL type oid
+decoders = {
+  16: _decode_bool,                          # bool
+  18: _decode_text,                          # char
+  19: _decode_text,                          # name
+  20: lambda d: _int64.unpack(d)[0],         # int8
+  21: lambda d: _int16.unpack(d)[0],         # int2
+  23: lambda d: _int32.unpack(d)[0],         # int4
+  25: _decode_text,                          # text
+  26: lambda d: _int32.unpack(d)[0] & 0xFFFFFFFF,  # oid
+  114: _decode_json,                         # json
+  700: lambda d: _float32.unpack(d)[0],      # float4
+  701: lambda d: _float64.unpack(d)[0],      # float8
+  1042: _decode_text,                        # bpchar
+  1043: _decode_text,                        # varchar
+  1082: _decode_date,                        # date
+  1083: _decode_time,                        # time
+  1114: _decode_timestamp,                   # timestamp
+  1186: _decode_interval,                    # interval
+  1700: _decode_numeric,                     # numeric
+  3802: _decode_jsonb,                       # jsonb
+  }
+
+def _decode_timestamptz(tz):
+  '''
+  Returns a decoder for timestamps with time zone. The binary format holds
+  the UTC time, which is converted to a naive datetime in the time zone of
+  the database session. This gives the same values as the regular database
+  cursor. The UTC offsets are cached per 15 minutes.
+  '''
+  offsets = {}
+
+  def decode(data):
+    micro = _int64.unpack(data)[0]
+    if micro == _infinity:
+      return datetime.max
+    elif micro == -_infinity - 1:
+      return datetime.min
+    utc = _epoch_datetime + timedelta(microseconds=micro)
+    key = micro // 900000000
+    offset = offsets.get(key, None)
+    if offset is None:
+      offset = tz.fromutc(utc.replace(tzinfo=tz)).replace(tzinfo=None) - utc
+      offsets[key] = offset
+    return utc + offset
+
+  return decode
+
+
+class BinaryCopyReader:
+  '''
+  Reads the result of a SQL query with the binary COPY protocol.
+
+  The raw data is first copied into a spooled temporary file. The rows are
+  then decoded in batches into one list per column, and handed out again as
+  tuples. This allows us to use the class as a drop-in replacement for
+  iterating over a database cursor:
+
+    with BinaryCopyReader(connection, "select name, due from demand") as rows:
+      for name, due in rows:
+        ...
+  '''
+
+  def __init__(self, connection, sql, batchsize=10000, spool=64 * 1024 * 1024):
+    self.connection = connection
+    self.sql = sql
+    self.batchsize = batchsize
+    self.spool = spool
+    self.buffer = None
+    self.columns = None
+    self.decoders = None
+    self.bytes = 0
+
+  def __enter__(self):
+    cursor = self.connection.cursor()
+    try:
+      # Find the output columns and their types
+      cursor.execute('select * from (%s) q limit 0' % self.sql)
+      self.columns = [ c[0] for c in cursor.description ]
+      self.decoders = []
+      tz = None
+      for col in cursor.description:
+        if col[1] == 1184:
+          # timestamptz
+          if not tz:
+            tz = self.getTimeZone(cursor)
+          self.decoders.append(_decode_timestamptz(tz))
+        elif col[1] in decoders:
+          self.decoders.append(decoders[col[1]])
+        else:
+          raise ValueError("Binary copy doesn't support type %s of field '%s'" % (col[1], col[0]))
+
+      # Copy the data into the buffer.
+      # The query is copied as is, which preserves its sort order.
+      self.buffer = tempfile.SpooledTemporaryFile(max_size=self.spool, mode="w+b")
+      cursor.copy_expert('copy (%s) to stdout with (format binary)' % self.sql, self.buffer)
+      self.bytes = self.buffer.tell()
+      self.buffer.seek(0)
+    except:
+      self.close()
+      raise
+    finally:
+      cursor.close()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  @staticmethod
+  def getTimeZone(cursor):
+    cursor.execute('show timezone')
+    name = cursor.fetchone()[0]
+    try:
+      return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+      raise ValueError("Binary copy doesn't support time zone '%s'" % name)
+
+  def close(self):
+    if self.buffer:
+      self.buffer.close()
+      self.buffer = None
+
+  def __iter__(self):
+    for batch in self.batches():
+      yield from zip(*batch)
+
+  def batches(self):
+    '''
+    Generator returning the data in batches. Each batch is a list with
+    the decoded values of each column.
+    '''
+    if self.buffer is None:
+      raise ValueError("BinaryCopyReader needs to be used as a context manager")
+    header = self.buffer.read(len(COPY_SIGNATURE) + 8)
+    if not header.startswith(COPY_SIGNATURE):
+      raise ValueError("Invalid binary copy header")
+    self.buffer.read(_int32.unpack_from(header, len(COPY_SIGNATURE) + 4)[0])
+    read = self.buffer.read
+    numcols = len(self.decoders)
+    batch = [ [] for i in range(numcols) ]
+    count = 0
+    while True:
+      fieldcount = _int16.unpack(read(2))[0]
+      if fieldcount == -1:
+        # End of the data
+        break
+      elif fieldcount != numcols:
+        raise ValueError("Unexpected field count %d in binary copy" % fieldcount)
+      for col in batch:
+        size = _int32.unpack(read(4))[0]
+        col.append(None if size < 0 else read(size))
+      count += 1
+      if count >= self.batchsize:
+        yield self.decode(batch)
+        batch = [ [] for i in range(numcols) ]
+        count = 0
+    if count:
+      yield self.decode(batch)
+
+  def decode(self, batch):
+    return [
+      [ None if v is None else dec(v) for v in col ]
+      for dec, col in zip(self.decoders, batch)
+      ]
+
+
+def escape(value):
+  '''
+  Formats a value for the text COPY format.
+  None is exported as a NULL value. Backslashes and the characters that
+  separate the fields and the lines are escaped.
+  '''
+  if value is None:
+    return '\\N'
+  return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyFromGenerator:
+  '''
+  A file-like object that feeds the output of a generator to the copy_from
+  and copy_expert methods of a psycopg2 cursor.
+
+  The generator returns the lines of text in the COPY format, without the
+  end-of-line character. They are formatted only when PostgreSQL asks for
+  the next chunk of data. The data is streamed to the database while it is
+  being generated, and we don't need to write it in a temporary file first:
+
+    cursor.copy_from(
+      CopyFromGenerator("%s\\t%s" % (escape(i.name), i.due) for i in frepple.demands()),
+      'mytable', columns=('name', 'due')
+      )
+
+  Fields that can contain backslashes, tabs or newlines need to be formatted
+  with the escape function.
+  '''
+
+  def __init__(self, lines):
+    self.lines = iter(lines)
+    self.buffer = bytearray()
+    self.eof = False
+    self.bytes = 0
+
+  def read(self, size=-1):
+    buf = self.buffer
+    while not self.eof and (size < 0 or len(buf) < size):
+      try:
+        buf += next(self.lines).encode('utf-8')
+        buf += b'\n'
+      except StopIteration:
+        self.eof = True
+    if size < 0 or size >= len(buf):
+      data = bytes(buf)
+      buf.clear()
+    else:
+      data = bytes(buf[:size])
+      del buf[:size]
+    self.bytes += len(data)
+    return data
+
+  def readline(self, size=-1):
+    if self.buffer:
+      idx = self.buffer.find(b'\n')
+      return self.read(idx + 1 if idx >= 0 else -1)
+    try:
+      data = next(self.lines).encode('utf-8') + b'\n'
+    except StopIteration:
+      self.eof = True
+      return b''
+    self.bytes += len(data)
+    return data
@@ -34,6 +34,7 @@ import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import hashlib
 from logging import ERROR, WARNING, DEBUG
 import math
 import operator
@@ -53,7 +54,8 @@ from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, FieldDoesNotExist
 from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import CharField, AutoField
@@ -76,6 +78,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.views.generic.base import View
 
 from freppledb.boot import getAttributeFields
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import User, Comment, Parameter, BucketDetail, Bucket, HierarchyModel
 from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata
 from freppledb.admin import data_site
@@ -410,6 +413,11 @@ class GridReport(View):
   # A model class from which we can inherit information.
   model = None
 
+  # Set to true to estimate the number of records from the statistics of the
+  # PostgreSQL planner, rather than counting them. Only tables with more
+  # than 10000 records are estimated.
+  estimateCount = False
+
   # Allow editing in this report or not
   editable = True
 
@@ -641,7 +649,8 @@ class GridReport(View):
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database))
     else:
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset).using(request.database))
-    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*field_names):
+    # Records are streamed from a server-side cursor
+    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*field_names).iterator():
       if hasattr(row, "__getitem__"):
         ws.append([ _getCellValue(row[f]) for f in field_names ])
       else:
@@ -712,7 +721,8 @@ class GridReport(View):
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database), prefs)
     else:
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset).using(request.database), prefs)
-    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields):
+    # Records are streamed from a server-side cursor
+    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields).iterator():
       # Clear the return string buffer
       sf.seek(0)
       sf.truncate(0)
@@ -965,6 +975,132 @@ class GridReport(View):
       return "%s asc" % sort
 
 
+  @classmethod
+  def _count(reportclass, request, query):
+    '''
+    Returns the number of records in a query.
+    Reports with many records can use the estimate of the query planner
+    instead. The estimate is only used for the complete report: the planner
+    can be far off for a filtered query.
+    '''
+    if reportclass.estimateCount and not query.query.where:
+      try:
+        sql, params = query.query.get_compiler(query.db).as_sql(with_col_aliases=False)
+        cursor = connections[request.database].cursor()
+        cursor.execute('explain (format json) %s' % sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+          plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        if estimate > 10000:
+          return estimate
+      except Exception as e:
+        logger.warning("Can't estimate number of records: %s" % e)
+    return query.count()
+
+
+  @classmethod
+  def _get_keyset(reportclass, query):
+    '''
+    Returns the list of (field, descending) tuples on which a query is sorted,
+    completed with the primary key to make the sort order unique.
+    None is returned when the sort order isn't suited for keyset pagination.
+    '''
+    if query.query.distinct or not query.query.order_by or query.query.extra_order_by:
+      return None
+    keys = []
+    for o in query.query.order_by:
+      if not isinstance(o, str) or o == '?':
+        return None
+      descending = o.startswith('-')
+      name = o[1:] if descending else o
+      # Only sort on concrete fields, possibly of a related model
+      opts = query.model._meta
+      parts = name.split('__')
+      try:
+        for idx, part in enumerate(parts):
+          field = opts.pk if part == 'pk' else opts.get_field(part)
+          if idx < len(parts) - 1:
+            if not field.is_relation or not field.related_model:
+              return None
+            opts = field.related_model._meta
+      except FieldDoesNotExist:
+        return None
+      if field.is_relation or not field.concrete:
+        return None
+      keys.append((name, descending))
+    if not any(k[0] in ('pk', query.model._meta.pk.name) for k in keys):
+      keys.append(('pk', False))
+    return keys
+
+
+  @classmethod
+  def _get_page(reportclass, request, query, page):
+    '''
+    Returns a queryset with the records of a page of a sorted query.
+
+    The sort key of the last record of every page is remembered in the cache.
+    When a page is requested after its previous page, the records are selected
+    with a condition on the sort key rather than with an offset. The database
+    can then seek the page with an index, and the cost of a page no longer
+    depends on its position.
+    Other pages and sort orders that aren't suited for this pagination are
+    retrieved with an offset.
+
+    The page is selected only once: a single query reads the primary keys and
+    sort keys of its records. The returned queryset then retrieves the records
+    by their primary key.
+    '''
+    pagesize = request.pagesize
+    keys = reportclass._get_keyset(query)
+    if not keys:
+      return query[(page - 1) * pagesize:page * pagesize]
+    query = query.order_by(*[ ('-%s' % k) if d else k for k, d in keys ])
+
+    # The sort keys are stored per user, report, filter and sort order. The
+    # version stamp of the scenario changes after each plan run and data edit,
+    # which discards the sort keys of the previous data.
+    # Without a version stamp the sort keys could be outdated, and all pages
+    # are retrieved with an offset.
+    version = Dashboard.getVersion(request.database)
+    if version is None:
+      cachekey = None
+      boundaries = {}
+    else:
+      signature = '%s|%s|%s|%s|%s|%s' % (
+        request.user.pk, request.database, version, request.path, keys,
+        sorted((k, v) for k, v in request.GET.items() if k not in ('page', 'nd'))
+        )
+      cachekey = 'keyset:%s' % hashlib.sha1(signature.encode('utf-8')).hexdigest()
+      boundaries = cache.get(cachekey, {})
+
+    # Select the records of the page
+    previous = boundaries.get(page - 1, None)
+    if page > 1 and previous:
+      # Records sorting after the previous page.
+      # In ascending order PostgreSQL sorts null values at the end.
+      seek = None
+      for idx, (k, d) in enumerate(keys):
+        after = models.Q(**{'%s__lt' % k if d else '%s__gt' % k: previous[idx]})
+        if not d:
+          after |= models.Q(**{'%s__isnull' % k: True})
+        for k2, v2 in zip(keys[:idx], previous):
+          after &= models.Q(**{k2: v2})
+        seek = after if seek is None else (seek | after)
+      base = query.filter(seek)
+      offset = 0
+    else:
+      base = query
+      offset = (page - 1) * pagesize
+    records = list(base.values_list('pk', *[ k for k, d in keys ])[offset:offset + pagesize])
+
+    # Remember the sort key of the last record on the page
+    if cachekey and len(records) == pagesize and None not in records[-1]:
+      boundaries[page] = records[-1][1:]
+      cache.set(cachekey, boundaries, 600)
+    return query.filter(pk__in=[ r[0] for r in records ])
+
+
   @classmethod
   def _generate_json_data(reportclass, request, *args, **kwargs):
     page = 'page' in request.GET and int(request.GET['page']) or 1
@@ -973,24 +1109,23 @@ class GridReport(View):
       query = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database)
     else:
       query = reportclass.filter_items(request, reportclass.basequeryset).using(request.database)
-    recs = query.count()
+    recs = reportclass._count(request, query)
     total_pages = math.ceil(float(recs) / request.pagesize)
     if page > total_pages:
       page = total_pages
     if page < 1:
       page = 1
-    query = reportclass._apply_sort(request, query, request.prefs)
+    query = reportclass._get_page(request, reportclass._apply_sort(request, query, request.prefs), page)
 
     yield '{"total":%d,\n' % total_pages
     yield '"page":%d,\n' % page
     yield '"records":%d,\n' % recs
     yield '"rows":[\n'
-    cnt = (page - 1) * request.pagesize + 1
     first = True
 
     # GridReport
     fields = [ i.field_name for i in reportclass.rows if i.field_name ]
-    for i in hasattr(reportclass, 'query') and reportclass.query(request, query[cnt - 1:cnt + request.pagesize]) or query[cnt - 1:cnt + request.pagesize].values(*fields):
+    for i in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields):
       if first:
         r = [ '{' ]
         first = False
@@ -1809,27 +1944,20 @@ class GridPivot(GridReport):
     else:
       page = 'page' in request.GET and int(request.GET['page']) or 1
       if isinstance(reportclass.basequeryset, collections.Callable):
-        recs = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database).count()
+        query = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database)
       else:
-        recs = reportclass.filter_items(request, reportclass.basequeryset).using(request.database).count()
+        query = reportclass.filter_items(request, reportclass.basequeryset).using(request.database)
+      recs = reportclass._count(request, query)
       total_pages = math.ceil(float(recs) / request.pagesize)
       if page > total_pages:
         page = total_pages
       if page < 1:
         page = 1
-      cnt = (page - 1) * request.pagesize + 1
-      if isinstance(reportclass.basequeryset, collections.Callable):
-        query = reportclass.query(
-          request,
-          reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False), prefs).using(request.database)[cnt - 1:cnt + request.pagesize],
-          sortsql=reportclass._apply_sort_index(request, prefs)
-          )
-      else:
-        query = reportclass.query(
-          request,
-          reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset), prefs).using(request.database)[cnt - 1:cnt + request.pagesize],
-          sortsql=reportclass._apply_sort_index(request, prefs)
-          )
+      query = reportclass.query(
+        request,
+        reportclass._get_page(request, reportclass._apply_sort(request, query, prefs), page),
+        sortsql=reportclass._apply_sort_index(request, prefs)
+        )
 
     # Generate header of the output
     yield '{"total":%d,\n' % total_pages
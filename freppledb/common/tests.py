@@ -15,20 +15,102 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime
+import json
+from logging import ERROR, INFO
 import os
 import os.path
+import random
+from threading import Barrier, Event
+from time import sleep, time
+import unittest
+from unittest.mock import patch
 
+from django.contrib.admin.models import LogEntry
 from django.core import management
+from django.core.cache import cache
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase, TransactionTestCase
-
-from freppledb.common.models import User
+from django.db import connection, transaction, DatabaseError, DEFAULT_DB_ALIAS
+from django.db.backends.utils import CursorWrapper
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from freppledb.common.commands import PlanTaskRegistry, PlanTask
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.dataload import parseCSVdata
+from freppledb.common.models import User, HierarchyModel
+from freppledb.common.pgcopy import BinaryCopyReader, CopyFromGenerator, escape
+from freppledb.execute.models import Task
 import freppledb.common as common
 import freppledb.input as input
 
 from rest_framework.test import APIClient, APITestCase, APIRequestFactory
 
 
+class HierarchyTest(SimpleTestCase):
+
+  def test_deep_hierarchy(self):
+    # Much deeper than the recursion limit of Python
+    nodes = { 'node 0': None }
+    for i in range(1, 100000):
+      nodes['node %s' % i] = 'node %s' % (i - 1)
+    result = { i[0]: i[1:] for i in HierarchyModel.numberHierarchy(nodes) }
+    self.assertEqual(result['node 0'], (1, 200000, 0))
+    self.assertEqual(result['node 99999'], (100000, 100001, 99999))
+
+  def test_loops(self):
+    nodes = {'a': 'b', 'b': 'c', 'c': 'a', 'd': 'a', 'e': None, 'f': 'f'}
+    result = { i[0]: i[1:] for i in HierarchyModel.numberHierarchy(nodes, gap=2) }
+    self.assertEqual(
+      result,
+      {'e': (1, 4, 0), 'f': (5, 8, 0), 'a': (9, 16, 0), 'd': (10, 13, 1), 'b': (17, 20, 0), 'c': (21, 24, 0)}
+      )
+    self.assertEqual(nodes, {'a': None, 'b': None, 'c': None, 'd': 'a', 'e': None, 'f': None})
+
+  @unittest.skipUnless('FREPPLE_BENCHMARK' in os.environ, 'Benchmark is only run when FREPPLE_BENCHMARK is set')
+  def test_benchmark(self):
+    # Numbering a random hierarchy of 1M nodes must take about 10 times
+    # longer than a hierarchy of 100K nodes
+    rnd = random.Random(1)
+    timing = {}
+    for size in (100000, 1000000):
+      nodes = { 'node 0': None }
+      for i in range(1, size):
+        nodes['node %s' % i] = 'node %s' % rnd.randrange(i)
+      start = time()
+      HierarchyModel.numberHierarchy(nodes, gap=10)
+      timing[size] = time() - start
+    self.assertLess(timing[1000000], 20 * timing[100000])
+
+
+class HierarchyRebuildTest(TestCase):
+
+  @unittest.skipUnless('FREPPLE_BENCHMARK' in os.environ, 'Benchmark is only run when FREPPLE_BENCHMARK is set')
+  def test_benchmark(self):
+    # Rebuilding a random hierarchy of 1M nodes in the database, including
+    # the copy and update of the numbering, must take about 10 times longer
+    # than a hierarchy of 100K nodes
+    rnd = random.Random(1)
+    timing = {}
+    for size in (100000, 1000000):
+      input.models.Location.objects.all().delete()
+      input.models.Location.objects.bulk_create(
+        [
+          input.models.Location(name='node %s' % i, owner_id='node %s' % rnd.randrange(i) if i else None)
+          for i in range(size)
+        ],
+        batch_size=10000
+        )
+      start = time()
+      input.models.Location.rebuildHierarchy()
+      timing[size] = time() - start
+      self.assertFalse(input.models.Location.objects.filter(lft__isnull=True).exists())
+      root = input.models.Location.objects.get(name='node 0')
+      self.assertEqual((root.lft, root.lvl), (1, 0))
+      self.assertEqual(input.models.Location.objects.filter(lft__gt=root.lft, rght__lt=root.rght).count(), size - 1)
+    self.assertLess(timing[1000000], 20 * timing[100000])
+
+
 class DataLoadTest(TestCase):
 
   def setUp(self):
@@ -45,6 +127,196 @@ class DataLoadTest(TestCase):
     self.fail("Didn't find expected number of parameters")
 
 
+class BulkLoadTest(TestCase):
+
+  data = [
+    ['name', 'description', 'category', 'owner'],
+    ['existing 1', 'changed', 'cat', ''],
+    ['existing 2', 'unchanged', 'cat', ''],
+    ['new 1', 'added', 'cat', 'existing 1'],
+    ['new 2', 'added', 'cat', 'new 1'],
+    ['invalid owner', 'added', 'cat', 'unknown'],
+    ['invalid description', 'x' * 600, 'cat', ''],
+    ['existing 1', 'changed again', 'cat', ''],
+    [' existing 2', 'duplicate', 'cat', ''],
+    ]
+
+  def setUp(self):
+    self.user = User.objects.create_superuser('bulkload', 'your@company.com', 'bulkload')
+    input.models.Customer.objects.create(name='existing 1', description='original', category='cat')
+    input.models.Customer.objects.create(name='existing 2', description='unchanged', category='cat')
+
+  def load(self, bulk):
+    # Loads the data, and returns the messages and the resulting records
+    with transaction.atomic():
+      messages = [
+        (i[0], i[1], i[2], str(i[4]))
+        for i in parseCSVdata(input.models.Customer, iter(self.data), user=self.user, bulk=bulk)
+        ]
+      records = sorted(input.models.Customer.objects.values_list('name', 'description', 'owner'))
+      log = sorted(LogEntry.objects.values_list('object_id', 'action_flag'))
+      transaction.set_rollback(True)
+    return messages, records, log
+
+  def test_bulk_load(self):
+    # The bulk mode gives the same result as the row by row mode
+    result = self.load(bulk=True)
+    self.assertEqual(result, self.load(bulk=False))
+    messages, records, log = result
+    self.assertEqual(
+      [ i[:3] for i in messages ],
+      [ (ERROR, 6, 'owner'), (ERROR, 7, 'description'), (ERROR, 9, 'name'), (INFO, None, None) ]
+      )
+    self.assertEqual(
+      messages[-1][3],
+      '8 data rows, changed 2 and added 2 records, 3 errors, 0 warnings'
+      )
+    self.assertEqual(records, [
+      ('existing 1', 'changed again', None),
+      ('existing 2', 'unchanged', None),
+      ('new 1', 'added', 'existing 1'),
+      ('new 2', 'added', 'new 1'),
+      ])
+    self.assertEqual(len(log), 4)
+
+  def test_batch_failure(self):
+    # When a batch can't be saved at once, its rows are saved one by one
+    expected = self.load(bulk=False)
+    with patch.object(CursorWrapper, 'copy_expert', side_effect=DatabaseError('copy failed')):
+      self.assertEqual(self.load(bulk=True), expected)
+
+
+class BinaryCopyReaderTest(TestCase):
+
+  fixtures = ['demo']
+
+  def test_reader(self):
+    # The binary copy returns the same rows in the same order as a cursor,
+    # also for timestamps around the changes to summer and winter time
+    for sql in (
+      "select name, startdate, enddate, bucket_id from common_bucketdetail order by startdate desc, name",
+      "select id, flowdate, quantity, onhand from operationplanmaterial order by flowdate, quantity desc, id",
+      "select '2018-10-28 02:30:00+00'::timestamptz, '2018-03-25 01:30:00+00'::timestamptz, null::timestamptz",
+      ):
+      with connection.cursor() as cursor:
+        cursor.execute(sql)
+        expected = cursor.fetchall()
+      with BinaryCopyReader(connection, sql, batchsize=100) as rows:
+        self.assertEqual(list(rows), expected, sql)
+
+
+class CopyFromGeneratorTest(TestCase):
+
+  values = [
+    ('tab', 'a\tb'),
+    ('newline', 'a\nb\r\nc'),
+    ('backslash', 'a\\b\\N\\'),
+    ('null', None),
+    ('empty', ''),
+    ('unicode', 'h\u00e9llo \u4e16\u754c'),
+    ]
+
+  def copy(self, lines, size=8192):
+    with connection.cursor() as cursor:
+      cursor.execute("create temporary table tmp_copy (name text, value text)")
+      try:
+        cursor.copy_from(CopyFromGenerator(lines), 'tmp_copy', size=size)
+        cursor.execute("select name, value from tmp_copy order by name")
+        return cursor.fetchall()
+      finally:
+        cursor.execute("drop table tmp_copy")
+
+  def test_escape(self):
+    self.assertEqual(escape(None), '\\N')
+    self.assertEqual(escape(1.5), '1.5')
+    self.assertEqual(escape('a\tb\nc\rd\\e'), 'a\\tb\\nc\\rd\\\\e')
+
+  def test_copy(self):
+    # Tiny chunks split the lines and the escape sequences
+    for size in (1, 3, 8192):
+      self.assertEqual(
+        self.copy(("%s\t%s" % (escape(n), escape(v)) for n, v in self.values), size),
+        sorted(self.values)
+        )
+
+  def test_empty(self):
+    data = CopyFromGenerator(iter(()))
+    self.assertEqual(data.read(100), b'')
+    self.assertEqual(data.read(), b'')
+    self.assertEqual(data.readline(), b'')
+    self.assertEqual(data.bytes, 0)
+    self.assertEqual(self.copy(iter(())), [])
+
+  def test_read(self):
+    data = CopyFromGenerator(["a\tb", "", "c\u00e9"])
+    self.assertEqual(data.read(3), b'a\tb')
+    self.assertEqual(data.readline(), b'\n')
+    self.assertEqual(data.readline(), b'\n')
+    self.assertEqual(data.read(), 'c\u00e9\n'.encode('utf-8'))
+    self.assertEqual(data.read(), b'')
+    self.assertEqual(data.bytes, 9)
+
+
+class PaginationTest(TransactionTestCase):
+
+  fixtures = ['demo']
+
+  def setUp(self):
+    # Login
+    if not User.objects.filter(username="admin").count():
+      User.objects.create_superuser('admin', 'your@company.com', 'admin')
+    User.objects.filter(username='admin').update(pagesize=5)
+    self.client.login(username='admin', password='admin')
+    cache.clear()
+
+  def getPage(self, page):
+    response = self.client.get('/data/input/demand/?format=json&sidx=due&sord=desc&page=%s' % page)
+    data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+    return [ r['name'] for r in data['rows'] ]
+
+  def test_keyset_pagination(self):
+    # Browsing page by page retrieves the next pages with a keyset condition
+    pages = [ self.getPage(i) for i in range(1, 5) ]
+    self.assertEqual(len(pages[1]), 5)
+    names = [ n for p in pages for n in p ]
+    self.assertEqual(len(names), len(set(names)))
+    # Jumping to a page retrieves the same records with an offset
+    cache.clear()
+    self.assertEqual(self.getPage(3), pages[2])
+
+  def getPageQueries(self, page):
+    # Queries selecting the records of a page
+    with CaptureQueriesContext(connection) as queries:
+      self.getPage(page)
+    return [
+      q['sql'] for q in queries.captured_queries
+      if 'FROM "demand"' in q['sql'] and 'LIMIT' in q['sql']
+      ]
+
+  def test_keyset_invalidation(self):
+    self.getPage(1)
+    self.getPage(2)
+    # The page is selected once, with a keyset condition
+    queries = self.getPageQueries(3)
+    self.assertEqual(len(queries), 1)
+    self.assertNotIn('OFFSET', queries[0])
+    # After a plan run or a data edit the sort keys are computed again
+    Dashboard.invalidate(DEFAULT_DB_ALIAS)
+    queries = self.getPageQueries(4)
+    self.assertEqual(len(queries), 1)
+    self.assertIn('OFFSET', queries[0])
+
+  def test_without_cache(self):
+    # Without a shared cache the sort keys can't be invalidated, and the
+    # pages are always retrieved with an offset
+    with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+      self.getPage(1)
+      self.getPage(2)
+      queries = self.getPageQueries(3)
+      self.assertEqual(len(queries), 1)
+      self.assertIn('OFFSET', queries[0])
+
+
 class UserPreferenceTest(TestCase):
 
   def test_get_set_preferences(self):
@@ -56,6 +328,134 @@ class UserPreferenceTest(TestCase):
     self.assertEqual(after, {'a': 1, 'b': 'c'})
 
 
+class PlanTaskDependencyTest(TestCase):
+
+  def test_dependencies(self):
+    class first(PlanTask):
+      sequence = 1
+    class second(PlanTask):
+      sequence = 2
+      dependencies = ()
+    class third(PlanTask):
+      sequence = 3
+      dependencies = ('second', 'unknown')
+    class fourth(PlanTask):
+      sequence = 4
+    class fifth(PlanTask):
+      sequence = 5
+      dependencies = ('first', 'third')
+    deps = PlanTaskRegistry.getDependencies([first, second, third, fourth, fifth])
+    self.assertEqual(deps[first], set())
+    self.assertEqual(deps[second], {first})
+    self.assertEqual(deps[third], {first, second})
+    self.assertEqual(deps[fourth], {first, second, third})
+    self.assertEqual(deps[fifth], {first, third, fourth})
+
+  def test_concurrency(self):
+    # Tasks record their start and end, and the progress at their start
+    log = []
+    concurrent = Barrier(2, timeout=10)
+    thirdStarted = Event()
+
+    class StandInTask(PlanTask):
+      dependencies = ()
+      @classmethod
+      def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+        log.append(('start', cls.__name__, PlanTaskRegistry.task.status, PlanTaskRegistry.task.message))
+        cls.work()
+        log.append(('end', cls.__name__))
+    class first(StandInTask):
+      sequence = 1
+      description = 'first'
+      @staticmethod
+      def work():
+        concurrent.wait()
+    class second(StandInTask):
+      sequence = 2
+      description = 'second'
+      @staticmethod
+      def work():
+        concurrent.wait()
+        # The progress is reported and the next task is started while
+        # this task holds the model lock
+        with PlanTaskRegistry.lock:
+          if not thirdStarted.wait(10):
+            raise Exception("Third task didn't start")
+          log.append(('unlock', 'second'))
+    class third(StandInTask):
+      sequence = 3
+      description = 'third'
+      dependencies = ('first',)
+      @staticmethod
+      def work():
+        thirdStarted.set()
+        with PlanTaskRegistry.lock:
+          log.append(('lock', 'third'))
+    class fourth(StandInTask):
+      sequence = 4
+      description = 'fourth'
+      dependencies = None
+      @staticmethod
+      def work():
+        pass
+
+    task = Task.objects.create(name='generate plan', submitted=datetime.now(), status='Waiting')
+    with patch.object(PlanTaskRegistry, 'reg', [first, second, third, fourth]):
+      with patch.dict(os.environ, {'FREPPLE_TASKID': str(task.id)}):
+        PlanTaskRegistry.run()
+
+    # The independent first and second task run concurrently
+    self.assertEqual(sorted(log[:2]), [
+      ('start', 'first', '0%', 'first, second'),
+      ('start', 'second', '0%', 'first, second')
+      ])
+    # The third task waits for the first task only, and the model lock
+    # serializes its model updates with the second task
+    self.assertLess(log.index(('end', 'first')), log.index(('start', 'third', '25%', 'second, third')))
+    self.assertLess(log.index(('unlock', 'second')), log.index(('lock', 'third')))
+    # The fourth task waits for all tasks
+    self.assertEqual(log[-2:], [('start', 'fourth', '75%', 'fourth'), ('end', 'fourth')])
+    task = Task.objects.get(pk=task.id)
+    self.assertEqual((task.status, task.message), ('100%', ''))
+
+  def test_failure(self):
+    # An error in a parallel task is raised after the other running tasks
+    # finish. A SystemExit doesn't leave the registry waiting.
+    for error in (ValueError('task failed'), SystemExit(2)):
+      log = []
+      concurrent = Barrier(2, timeout=10)
+
+      class failing(PlanTask):
+        sequence = 1
+        dependencies = ()
+        @classmethod
+        def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+          concurrent.wait()
+          raise error
+      class running(PlanTask):
+        sequence = 2
+        dependencies = ()
+        @classmethod
+        def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+          concurrent.wait()
+          sleep(0.2)
+          log.append('running')
+      class skipped(PlanTask):
+        sequence = 3
+        @classmethod
+        def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+          log.append('skipped')
+
+      task = Task.objects.create(name='generate plan', submitted=datetime.now(), status='Waiting')
+      with patch.object(PlanTaskRegistry, 'reg', [failing, running, skipped]):
+        with patch.dict(os.environ, {'FREPPLE_TASKID': str(task.id)}):
+          with self.assertRaises(type(error)):
+            PlanTaskRegistry.run()
+      self.assertEqual(log, ['running'])
+    task = Task.objects.get(pk=task.id)
+    self.assertNotEqual(task.status, '100%')
+
+
 class ExcelTest(TransactionTestCase):
 
   fixtures = ['demo']
@@ -18,10 +18,12 @@
 import csv
 from datetime import datetime
 import os
+from threading import Lock, Thread
+from time import time
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections
 
 from freppledb import VERSION
 from freppledb.common.models import User
@@ -42,6 +44,9 @@ class Command(BaseCommand):
   ext = 'csv'
   #ext = 'cpy'
 
+  # Number of rows fetched at once from the ERP database
+  batchsize = 10000
+
   requires_system_checks = False
 
   def get_version(self):
@@ -60,6 +65,10 @@ class Command(BaseCommand):
       '--task', type=int,
       help='Task identifier (generated automatically if not provided)'
       )
+    parser.add_argument(
+      '--threads', type=int, default=1,
+      help='Number of extracts running in parallel, each on its own connection to the ERP database'
+      )
 
 
   def handle(self, **options):
@@ -96,101 +105,154 @@ class Command(BaseCommand):
     if not os.access(self.destination, os.W_OK):
       raise CommandError("Can't write to folder %s " % self.destination)
 
-    # Open database connection
-    print("Connecting to the database")
-    with getERPconnection(self.database) as erp_connection:
-      self.cursor = erp_connection.cursor()
-      self.fk = '_id' if self.ext == 'cpy' else ''
-
-      # Extract all files
-      try:
-        self.extractLocation()
-        self.task.status = '6%'
-        self.task.save(using=self.database)
-
-        self.extractCustomer()
-        self.task.status = '12%'
-        self.task.save(using=self.database)
-
-        self.extractItem()
-        self.task.status = '18%'
-        self.task.save(using=self.database)
-
-        self.extractSupplier()
-        self.task.status = '24%'
-        self.task.save(using=self.database)
-
-        self.extractResource()
-        self.task.status = '30%'
-        self.task.save(using=self.database)
-
-        self.extractSalesOrder()
-        self.task.status = '36%'
-        self.task.save(using=self.database)
-
-        self.extractOperation()
-        self.task.status = '42%'
-        self.task.save(using=self.database)
-
-        self.extractSuboperation()
-        self.task.status = '48%'
-        self.task.save(using=self.database)
-
-        self.extractOperationResource()
-        self.task.status = '54%'
-        self.task.save(using=self.database)
-
-        self.extractOperationMaterial()
-        self.task.status = '60%'
-        self.task.save(using=self.database)
-
-        self.extractItemSupplier()
-        self.task.status = '66%'
-        self.task.save(using=self.database)
-
-        self.extractCalendar()
-        self.task.status = '72%'
-        self.task.save(using=self.database)
-
-        self.extractCalendarBucket()
-        self.task.status = '78%'
-        self.task.save(using=self.database)
+    # List of extracts and the file they write.
+    # All extracts are independent of each other.
+    extracts = [
+      (self.extractLocation, 'location'),
+      (self.extractCustomer, 'customer'),
+      (self.extractItem, 'item'),
+      (self.extractSupplier, 'supplier'),
+      (self.extractResource, 'resource'),
+      (self.extractSalesOrder, 'demand'),
+      (self.extractOperation, 'operation'),
+      (self.extractSuboperation, 'suboperation'),
+      (self.extractOperationResource, 'operationresource'),
+      (self.extractOperationMaterial, 'operationmaterial'),
+      (self.extractItemSupplier, 'itemsupplier'),
+      (self.extractCalendar, 'calendar'),
+      (self.extractCalendarBucket, 'calendarbucket'),
+      (self.extractBuffer, 'buffer'),
+      ]
+    extracts = [
+      (f, os.path.join(self.destination, '%s.%s' % (name, self.ext)))
+      for f, name in extracts
+      ]
+
+    # The progress is based on the number of rows written. We expect the same
+    # number of rows as in the files of the previous run.
+    self.lock = Lock()
+    self.expected = { outfilename: self.countRows(outfilename) for f, outfilename in extracts }
+    self.rows = { outfilename: 0 for f, outfilename in extracts }
+    self.fk = '_id' if self.ext == 'cpy' else ''
+
+    # Extract all files
+    try:
+      threads = min(options['threads'] or 1, len(extracts))
+      if threads > 1:
+        # Parallel extraction, each thread with its own database connection
+        print("Extracting with %d connections to the database" % threads)
+        todo = list(reversed(extracts))
+        errors = []
+        workers = [
+          Thread(target=self.extractParallel, args=(todo, errors))
+          for i in range(threads)
+          ]
+        for w in workers:
+          w.start()
+        for w in workers:
+          w.join()
+        if errors:
+          raise errors[0]
+      else:
+        # Sequential extraction
+        print("Connecting to the database")
+        with getERPconnection(self.database) as erp_connection:
+          cursor = erp_connection.cursor()
+          for f, outfilename in extracts:
+            self.extract(f, cursor, outfilename)
+      self.task.status = 'Done'
+
+    except Exception as e:
+      self.task.status = 'Failed'
+      self.task.message = 'Failed: %s' % e
+
+    finally:
+      self.task.finished = datetime.now()
+      self.task.save(using=self.database)
+
+
+  def extractParallel(self, todo, errors):
+    '''
+    Runs extracts from the list on a new database connection, till the list
+    is empty or till an extract fails.
+    '''
+    try:
+      with getERPconnection(self.database) as erp_connection:
+        cursor = erp_connection.cursor()
+        while not errors:
+          try:
+            f, outfilename = todo.pop()
+          except IndexError:
+            break
+          self.extract(f, cursor, outfilename)
+    except Exception as e:
+      errors.append(e)
+    finally:
+      # Close the frePPLe database connection used to update the task
+      connections[self.database].close()
+
+
+  def extract(self, f, cursor, outfilename):
+    '''
+    Runs an extract, and marks it as complete in the progress.
+    '''
+    starttime = time()
+    f(cursor, outfilename)
+    print("Extracted %d rows to %s in %.2f seconds" % (
+      self.rows[outfilename], outfilename, time() - starttime
+      ))
+    self.rows[outfilename] = max(self.rows[outfilename], self.expected[outfilename])
+    self.updateProgress(outfilename, 0)
 
-        self.extractBuffer()
-        self.task.status = '84%'
-        self.task.save(using=self.database)
 
-        self.extractItemSupplier()
-        self.task.status = '90%'
-        self.task.save(using=self.database)
+  def countRows(self, outfilename):
+    '''
+    Returns the number of data rows in the file of a previous extract.
+    '''
+    try:
+      with open(outfilename, 'r', newline='') as infile:
+        return max(sum(1 for row in infile) - 1, 1)
+    except OSError:
+      return 1
 
-        self.extractCalendar()
-        self.task.status = '96%'
-        self.task.save(using=self.database)
 
-        self.extractCalendarBucket()
-        self.task.status = '100%'
+  def updateProgress(self, outfilename, rows):
+    '''
+    Updates the progress of the task when rows are written to a file.
+    '''
+    with self.lock:
+      self.rows[outfilename] += rows
+      progress = int(
+        sum(min(self.rows[i], self.expected[i]) for i in self.expected) * 100
+        / sum(self.expected.values())
+        )
+      status = '%d%%' % progress
+      if status != self.task.status:
+        self.task.status = status
         self.task.save(using=self.database)
 
-        self.task.status = 'Done'
-
-      except Exception as e:
-        self.task.status = 'Failed'
-        self.task.message = 'Failed: %s' % e
 
-      finally:
-        self.task.finished = datetime.now()
-        self.task.save(using=self.database)
+  def writeRows(self, outcsv, cursor, outfilename):
+    '''
+    Writes the result of a query to a CSV file.
+    The rows are fetched in batches. This keeps the memory usage constant,
+    independent of the size of the result.
+    '''
+    while True:
+      rows = cursor.fetchmany(self.batchsize)
+      if not rows:
+        break
+      outcsv.writerows(rows)
+      self.updateProgress(outfilename, len(rows))
 
 
-  def extractLocation(self):
+  def extractLocation(self, cursor, outfilename):
     '''
     Straightforward mapping JobBOSS locations to frePPLe locations.
     Only the SHOP location is actually used in the frePPLe model.
     '''
-    outfilename = os.path.join(self.destination, 'location.%s' % self.ext)
     print("Start extracting locations to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         location_id, description, current_timestamp
       from location
@@ -198,16 +260,15 @@ class Command(BaseCommand):
     with open(outfilename, 'w', newline='') as outfile:
       outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
       outcsv.writerow(['name', 'description', 'lastmodified'])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractCustomer(self):
+  def extractCustomer(self, cursor, outfilename):
     '''
     Straightforward mapping JobBOSS customers to frePPLe customers.
     '''
-    outfilename = os.path.join(self.destination, 'customer.%s' % self.ext)
     print("Start extracting customers to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select distinct customer, type, current_timestamp from customer
       union
       select 'N/A', null, current_timestamp
@@ -215,16 +276,15 @@ class Command(BaseCommand):
     with open(outfilename, 'w', newline='') as outfile:
       outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
       outcsv.writerow(['name', 'category', 'lastmodified'])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractItem(self):
+  def extractItem(self, cursor, outfilename):
     '''
     Map active JobBOSS jobs into frePPLe items.
     '''
-    outfilename = os.path.join(self.destination, 'item.%s' % self.ext)
     print("Start extracting items to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select job, part_number, description, customer, current_timestamp
       from job
       where status = 'Active'
@@ -232,16 +292,15 @@ class Command(BaseCommand):
     with open(outfilename, 'w', newline='') as outfile:
       outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
       outcsv.writerow(['name', 'subcategory', 'description', 'category', 'lastmodified'])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractSupplier(self):
+  def extractSupplier(self, cursor, outfilename):
     '''
     Map active JobBOSS vendors into frePPLe suppliers.
     '''
-    outfilename = os.path.join(self.destination, 'supplier.%s' % self.ext)
     print("Start extracting suppliers to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select vendor, name, current_timestamp
       from vendor
       where status = 'Active'
@@ -249,17 +308,16 @@ class Command(BaseCommand):
     with open(outfilename, 'w', newline='') as outfile:
       outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
       outcsv.writerow(['name', 'description', 'lastmodified'])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractResource(self):
+  def extractResource(self, cursor, outfilename):
     '''
     Map JobBOSS work centers into frePPLe resources.
     Only take the top-level workcenters, and skip the inactive ones.
     '''
-    outfilename = os.path.join(self.destination, 'resource.%s' % self.ext)
     print("Start extracting resources to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select work_center, uvtext4, department, machines, 'SHOP', 'default', current_timestamp
       from work_center
       where parent_id is null and department <> 'INACTIVE'
@@ -271,16 +329,15 @@ class Command(BaseCommand):
     with open(outfilename, 'w', newline='') as outfile:
       outcsv = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL)
       outcsv.writerow(['name', 'category', 'subcategory', 'maximum', 'location%s' % self.fk, 'type', 'lastmodified'])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractSalesOrder(self):
+  def extractSalesOrder(self, cursor, outfilename):
     '''
     Map JobBOSS top level jobs into frePPLe sales orders.
     '''
-    outfilename = os.path.join(self.destination, 'demand.%s' % self.ext)
     print("Start extracting demand to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         job, job, 'SHOP', coalesce(customer, 'N/A'), 'open', order_date,
         make_quantity - completed_quantity, make_quantity - completed_quantity,
@@ -297,18 +354,17 @@ class Command(BaseCommand):
         'status', 'due', 'quantity', 'minimum shipment' if self.ext == 'csv' else 'minshipment',
         'description', 'category', 'priority', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractOperation(self):
+  def extractOperation(self, cursor, outfilename):
     '''
     Map JobBOSS jobs into frePPLe operations.
     We extract a routing operation and also suboperations.
     SQL contains an ugly trick to avoid duplicate job-sequence combinations.
     '''
-    outfilename = os.path.join(self.destination, 'operation.%s' % self.ext)
     print("Start extracting operations to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         job, description, part_number, null, 'routing', job,
         'SHOP', null, null, current_timestamp
@@ -352,16 +408,15 @@ class Command(BaseCommand):
         'name', 'description', 'category', 'subcategory', 'type', 'item%s' % self.fk,
         'location%s' % self.fk, 'duration', 'duration_per', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractSuboperation(self):
+  def extractSuboperation(self, cursor, outfilename):
     '''
     Map JobBOSS joboperations into frePPLe suboperations.
     '''
-    outfilename = os.path.join(self.destination, 'suboperation.%s' % self.ext)
     print("Start extracting suboperations to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         distinct job.job, concat(job.job, ' - ', sequence), sequence, current_timestamp
       from job_operation
@@ -374,16 +429,15 @@ class Command(BaseCommand):
       outcsv.writerow([
         'operation%s' % self.fk, 'suboperation%s' % self.fk, 'priority', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractOperationResource(self):
+  def extractOperationResource(self, cursor, outfilename):
     '''
     Map JobBOSS joboperation workcenters into frePPLe operation-resources.
     '''
-    outfilename = os.path.join(self.destination, 'operationresource.%s' % self.ext)
     print("Start extracting operationresource to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         concat(job.job, ' - ', sequence),
         coalesce(vendor.vendor, coalesce(work_center.parent_id, work_center.work_center)),
@@ -401,16 +455,15 @@ class Command(BaseCommand):
       outcsv.writerow([
         'operation%s' % self.fk, 'resource%s' % self.fk, 'quantity', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractOperationMaterial(self):
+  def extractOperationMaterial(self, cursor, outfilename):
     '''
     Map JobBOSS joboperation workcenters into frePPLe operation-materials.
     '''
-    outfilename = os.path.join(self.destination, 'operationmaterial.%s' % self.ext)
     print("Start extracting operationmaterial to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         case when job_operation.sequence is null then parent_job else concat(parent_job, ' - ', sequence) end,
         component_job, 'start', -relationship_qty, current_timestamp
@@ -438,16 +491,15 @@ class Command(BaseCommand):
       outcsv.writerow([
         'operation%s' % self.fk, 'item%s' % self.fk, 'type', 'quantity', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractBuffer(self):
+  def extractBuffer(self, cursor, outfilename):
     '''
     Map JobBOSS operation completed into frePPLe buffer onhand.
     '''
-    outfilename = os.path.join(self.destination, 'buffer.%s' % self.ext)
     print("Start extracting buffer to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select
         concat(job, ' @ SHOP'), job, 'SHOP',
         case when completed_quantity > order_quantity then order_quantity else completed_quantity end,
@@ -461,23 +513,22 @@ class Command(BaseCommand):
       outcsv.writerow([
         'name', 'item%s' % self.fk, 'location%s' % self.fk, 'onhand', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractItemSupplier(self):
+  def extractItemSupplier(self, cursor, outfilename):
     '''
     Extract the purchasing parameters for each item from its suppliers.
     '''
     pass
 
 
-  def extractCalendar(self):
+  def extractCalendar(self, cursor, outfilename):
     '''
     Extract working hours calendars from the ERP system.
     '''
-    outfilename = os.path.join(self.destination, 'calendar.%s' % self.ext)
     print("Start extracting calendar to %s" % outfilename)
-    self.cursor.execute('''
+    cursor.execute('''
       select 'Working hours', current_timestamp
       ''')
     with open(outfilename, 'w', newline='') as outfile:
@@ -485,8 +536,8 @@ class Command(BaseCommand):
       outcsv.writerow([
         'name', 'lastmodified'
         ])
-      outcsv.writerows(self.cursor.fetchall())
+      self.writeRows(outcsv, cursor, outfilename)
 
 
-  def extractCalendarBucket(self):
+  def extractCalendarBucket(self, cursor, outfilename):
     pass
@@ -23,6 +23,7 @@ from django.db import DEFAULT_DB_ALIAS
 from django.utils.translation import ugettext_lazy as _
 
 from freppledb.common.commands import PlanTaskRegistry, PlanTask
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import Parameter
 
 
@@ -226,7 +227,20 @@ class ExportPlan(PlanTask):
   @staticmethod
   def run(database=DEFAULT_DB_ALIAS, **kwargs):
     from freppledb.execute.export_database_plan import export
-    export(database=database).run()
+    # Passing the argument --env=export=delta to the frepple_run command
+    # only writes the differences with the plan already in the database.
+    try:
+      connections = int(Parameter.getValue('plan.exportConnections', database, '2'))
+    except ValueError:
+      print("Warning: Invalid format for parameter 'plan.exportConnections'.")
+      connections = 2
+    export(
+      database=database,
+      delta=(os.environ.get('export', None) == 'delta'),
+      connections=connections
+      ).run()
+    # The cached dashboard widgets are now outdated
+    Dashboard.invalidate(database)
 
 
 @PlanTaskRegistry.register
@@ -22,47 +22,104 @@ PostgreSQL database.
 The code in this file is executed NOT by the Django web application, but by the
 embedded Python interpreter from the frePPLe engine.
 '''
+from array import array
+from bisect import bisect_left, bisect_right
+from copy import copy
 from datetime import timedelta, datetime, date
 import io
 import json
+from operator import add
 import os
 from psycopg2.extensions import adapt
+from queue import Queue, Empty
 from subprocess import Popen, PIPE
 import sys
 import tempfile
 from time import time
-from threading import Thread
+from threading import Thread, Lock
 
-from django.db import connections, DEFAULT_DB_ALIAS, transaction
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.conf import settings
 
+from freppledb.common.pgcopy import CopyFromGenerator, escape
+from freppledb.output.models import ResourceBucketSummary, ProblemSummary, KPI
+
 import frepple
 
 
 class DatabasePipe(Thread):
   '''
   An auxiliary class that allows us to run a function with its own
-  PostgreSQL process pipe.
+  PostgreSQL connection.
+
+  The functions to run are either passed as arguments, or are pulled as
+  (owner, function) tuples from a queue shared by a pool of pipes.
   '''
-  def __init__(self, owner, *f):
+  def __init__(self, owner, *f, queue=None):
     self.owner = owner
     super(DatabasePipe, self).__init__()
     self.functions = f
+    self.queue = queue
+    self.exception = None
 
   def run(self):
-    # Pass the database password to the psql environment
     try:
       for f in self.functions:
         f(self.owner)
+      while self.queue:
+        try:
+          owner, f = self.queue.get_nowait()
+        except Empty:
+          break
+        f(owner)
+    except Exception as e:
+      print("Error during the export:", e)
+      self.exception = e
     finally:
-      pass
+      # Each thread uses its own database connection
+      connections[self.owner.database].close()
 
 
 class export:
+  '''
+  Exports the plan to the database.
+
+  In the default mode all proposed operationplans and their materials,
+  resources and resource plan are erased, and the complete plan is inserted
+  again.
+  In delta mode, which is only available when exporting the complete model,
+  the new plan is first copied into temporary tables. It is then compared
+  with the stored plan, and only the rows that are new, changed or removed
+  are written to the plan tables. This reduces table bloat and WAL volume
+  when only a small part of the plan changes between runs.
+  The operationplans are matched on their id. The solver gives a new id to
+  the proposed operationplans it creates. A new proposed operationplan with
+  the same content as a stored one that is no longer in the plan takes over
+  the id of the stored record. The materials, resources and pegging of the
+  operationplan are exported with that id as well. The ids in the database
+  can then differ from the ids in memory.
+  '''
+
+  # Hash of the content of an operationplan with alias "tmp". A new proposed
+  # operationplan with the same hash as an obsolete one reuses its id.
+  contentHash = '''md5(row(
+    tmp.type, tmp.status, round(tmp.quantity, 6), tmp.startdate, tmp.enddate,
+    tmp.operation_id, tmp.item_id, tmp.location_id, tmp.origin_id,
+    tmp.destination_id, tmp.supplier_id, tmp.demand_id
+    )::text)'''
 
-  def __init__(self, cluster=-1, verbosity=1, database=None):
+  def __init__(self, cluster=-1, verbosity=1, database=None, delta=False, connections=2):
     self.cluster = cluster
     self.verbosity = verbosity
+    self.delta = delta and cluster == -1
+    # Number of database connections used in parallel
+    self.connections = max(connections, 1)
+    # The operationplans, their materials and resources and the pegging are
+    # exported in shards. Each shard contains complete clusters. The
+    # dictionary clusters maps a cluster to its shard.
+    self.shard = 0
+    self.shards = 1
+    self.clusters = {}
     if database:
       self.database = database
     else:
@@ -72,6 +129,75 @@ class export:
         self.database = DEFAULT_DB_ALIAS
     self.encoding = 'UTF8'
     self.timestamp = str(datetime.now())
+    # The plan is streamed to the database in chunks of this size
+    self.copysize = 256 * 1024
+    # Size up to which data that can't be streamed directly is kept in memory
+    self.spoolsize = 64 * 1024 * 1024
+    # Problem totals of the plan, collected while exporting the problems
+    self.summary = {}
+    # In delta mode, the ids of stored operationplans reused by new ones
+    self.reuse = {}
+    # Earliest start and latest end of the loadplans, collected while
+    # exporting the resources of the operationplans
+    self.horizon = [datetime.max, datetime.min]
+    self.lock = Lock()
+
+
+  def skip(self, cluster):
+    '''
+    Returns true when the entities of the cluster aren't exported
+    by this object.
+    '''
+    if self.cluster != -1:
+      return cluster != self.cluster
+    return self.shards > 1 and self.clusters.get(cluster, cluster % self.shards) != self.shard
+
+
+  def getShards(self, count):
+    '''
+    Returns a list of copies of this object, each exporting a shard.
+
+    The shards are balanced on the number of operationplans. The clusters
+    are assigned from big to small, each to the shard with the fewest
+    operationplans so far.
+    A cluster isn't split over shards, because its operationplans refer to
+    each other. When one cluster holds most of the plan, its shard still
+    takes most of the export time.
+    '''
+    clusters = {}
+    if count > 1:
+      sizes = {}
+      for i in frepple.operations():
+        sizes[i.cluster] = sizes.get(i.cluster, 0) + sum(1 for j in i.operationplans)
+      totals = [0] * count
+      for cluster, size in sorted(sizes.items(), key=lambda c: (-c[1], c[0])):
+        shard = totals.index(min(totals))
+        clusters[cluster] = shard
+        totals[shard] += size
+    res = []
+    for i in range(count):
+      shard = copy(self)
+      shard.shard = i
+      shard.shards = count
+      shard.clusters = clusters
+      res.append(shard)
+    return res
+
+
+  def getShardName(self):
+    if self.shards > 1:
+      return " of shard %d/%d" % (self.shard + 1, self.shards)
+    else:
+      return ""
+
+
+  def addSummary(self, values):
+    '''
+    Adds the totals computed by an export function to the plan summary.
+    '''
+    with self.lock:
+      for k, v in values.items():
+        self.summary[k] = self.summary.get(k, 0) + v
 
 
   def getPegging(self, opplan):
@@ -94,9 +220,12 @@ class export:
     if self.verbosity:
       print("Emptying database plan tables...")
     starttime = time()
-    if self.cluster == -1:
+    if self.delta:
+      # Delta export: the plan tables are updated during the export
+      cursor.execute("truncate table out_problem, out_constraint, out_pegging")
+    elif self.cluster == -1:
       # Complete export for the complete model
-      cursor.execute("truncate table out_problem, out_resourceplan, out_constraint")
+      cursor.execute("truncate table out_problem, out_resourceplan, out_constraint, out_pegging")
       cursor.execute('''
         update operationplan
           set owner_id = null
@@ -137,6 +266,7 @@ class export:
         if i.cluster == self.cluster:
           cursor.execute(("insert into cluster_keys (name) values (%s);\n" % adapt(i.name).getquoted().decode(self.encoding)))
       cursor.execute("delete from out_constraint where demand in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)")
+      cursor.execute("delete from out_pegging where demand in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)")
       cursor.execute('''
         delete from operationplanmaterial
         using cluster_keys
@@ -195,8 +325,10 @@ class export:
     if self.verbosity:
       print("Exporting problems...")
     starttime = time()
-    cursor = connections[self.database].cursor()
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+
+    summary = {}
+
+    def getProblems():
       for i in frepple.problems():
         if isinstance(i.owner, frepple.operationplan):
           owner = i.owner.operation
@@ -204,18 +336,24 @@ class export:
           owner = i.owner
         if self.cluster != -1 and owner.cluster != self.cluster:
           continue
-        print(("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-           i.entity, i.name, owner.name,
-           i.description, str(i.start), str(i.end),
-           round(i.weight, 6)
-        )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-      tmp,
+        weight = round(i.weight, 6)
+        key = (i.entity, i.name)
+        summary[('problems',) + key] = summary.get(('problems',) + key, 0) + 1
+        summary[('weight',) + key] = summary.get(('weight',) + key, 0) + weight
+        yield "%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+           i.entity, i.name, escape(owner.name),
+           escape(i.description), str(i.start), str(i.end),
+           weight
+           )
+
+    cursor = connections[self.database].cursor()
+    cursor.copy_from(
+      CopyFromGenerator(getProblems()),
       'out_problem',
-      columns=('entity','name','owner', 'description', 'startdate', 'enddate', 'weight')
+      columns=('entity','name','owner', 'description', 'startdate', 'enddate', 'weight'),
+      size=self.copysize
       )
-      tmp.close()
+    self.addSummary(summary)
     if self.verbosity:
       print('Exported problems in %.2f seconds' % (time() - starttime))
 
@@ -224,25 +362,26 @@ class export:
     if self.verbosity:
       print("Exporting constraints...")
     starttime = time()
-    cursor = connections[self.database].cursor()
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+
+    def getConstraints():
       for d in frepple.demands():
         if self.cluster != -1 and self.cluster != d.cluster:
           continue
         for i in d.constraints:
-          print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-             d.name, i.entity, i.name,
-             isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
-             i.description, str(i.start), str(i.end),
+          yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+             escape(d.name), i.entity, i.name,
+             escape(isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name),
+             escape(i.description), str(i.start), str(i.end),
              round(i.weight, 6)
-           )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'out_constraint',
-        columns=('demand','entity','name','owner','description','startdate','enddate','weight')
-        )
-      tmp.close()
+             )
+
+    cursor = connections[self.database].cursor()
+    cursor.copy_from(
+      CopyFromGenerator(getConstraints()),
+      'out_constraint',
+      columns=('demand','entity','name','owner','description','startdate','enddate','weight'),
+      size=self.copysize
+      )
     if self.verbosity:
       print('Exported constraints in %.2f seconds' % (time() - starttime))
 
@@ -251,7 +390,7 @@ class export:
 
     def getOperationPlans():
       for i in frepple.operations():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if self.skip(i.cluster):
           continue
         for j in i.operationplans:
           delay = j.delay
@@ -323,7 +462,7 @@ class export:
               )
 
     if self.verbosity:
-      print("Exporting operationplans...")
+      print("Exporting operationplans%s..." % self.getShardName())
     starttime = time()
     cursor = connections[self.database].cursor()
 
@@ -339,7 +478,7 @@ class export:
         enddate timestamp with time zone,
         criticality numeric(15,6),
         delay numeric,
-        plan json,
+        plan jsonb,
         source character varying(300),
         lastmodified timestamp with time zone NOT NULL,
         operation_id character varying(300),
@@ -355,14 +494,109 @@ class export:
         id integer NOT NULL
       );
       ''')
-    with tempfile.TemporaryFile(mode="w+t",encoding='utf-8') as tmp:
-      for p in getOperationPlans():
-        print("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % p, file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(file=tmp,table='tmp_operationplan')
-      tmp.close()
-
-    # Merge temp table into the actual table
+    data = CopyFromGenerator(
+      "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % p
+      for p in getOperationPlans()
+      )
+    cursor.copy_from(file=data, table='tmp_operationplan', size=self.copysize)
+    copied = data.bytes
+
+    deleted = 0
+    reused = 0
+    if self.delta:
+      # Remove the proposed operationplans that are no longer part of the plan
+      cursor.execute('''
+        create temporary table tmp_obsolete as
+        select id from operationplan
+        where ((status='proposed' or status is null) or type = 'STCK')
+        and not exists (
+          select 1 from tmp_operationplan
+          where tmp_operationplan.id = operationplan.id
+          )
+        ''')
+
+      # A new proposed operationplan that is identical to an obsolete one
+      # takes over the id of the obsolete operationplan. The stored record is
+      # then kept, together with its materials and resources, instead of
+      # being deleted and inserted again with a new id.
+      # The records are matched on a hash of their content. Identical records
+      # are numbered, so that each obsolete record is reused only once.
+      cursor.execute('''
+        create temporary table tmp_reuse as
+        select new.id as newid, old.id as oldid
+        from (
+          select id, hash, row_number() over (partition by hash order by id) as seq
+          from (
+            select tmp.id, %s as hash
+            from tmp_operationplan as tmp
+            where not exists (
+              select 1 from operationplan
+              where operationplan.id = tmp.id
+              )
+            ) new
+          ) new
+        inner join (
+          select id, hash, row_number() over (partition by hash order by id) as seq
+          from (
+            select tmp.id, %s as hash
+            from operationplan as tmp
+            inner join tmp_obsolete
+              on tmp_obsolete.id = tmp.id
+            ) old
+          ) old
+        on old.hash = new.hash
+        and old.seq = new.seq
+        ''' % (self.contentHash, self.contentHash))
+      cursor.execute('''
+        update tmp_operationplan
+          set id = tmp_reuse.oldid
+        from tmp_reuse
+        where tmp_operationplan.id = tmp_reuse.newid
+        ''')
+      reused = cursor.rowcount
+      cursor.execute('''
+        update tmp_operationplan
+          set owner_id = tmp_reuse.oldid
+        from tmp_reuse
+        where tmp_operationplan.owner_id = tmp_reuse.newid
+        ''')
+      cursor.execute('''
+        delete from tmp_obsolete
+        using tmp_reuse
+        where tmp_obsolete.id = tmp_reuse.oldid
+        ''')
+      # The materials, resources and pegging are exported with the same ids
+      cursor.execute("select newid, oldid from tmp_reuse")
+      self.reuse.update(cursor.fetchall())
+      cursor.execute("drop table tmp_reuse")
+
+      cursor.execute('''
+        delete from operationplanmaterial
+        using tmp_obsolete
+        where operationplanmaterial.operationplan_id = tmp_obsolete.id
+        ''')
+      cursor.execute('''
+        delete from operationplanresource
+        using tmp_obsolete
+        where operationplanresource.operationplan_id = tmp_obsolete.id
+        ''')
+      cursor.execute('''
+        update operationplan
+          set owner_id = null
+        from tmp_obsolete
+        where operationplan.owner_id = tmp_obsolete.id
+        ''')
+      cursor.execute('''
+        delete from operationplan
+        using tmp_obsolete
+        where operationplan.id = tmp_obsolete.id
+        ''')
+      deleted = cursor.rowcount
+      cursor.execute("drop table tmp_obsolete")
+
+    # Merge temp table into the actual table.
+    # In delta mode only the operationplans with a different content are
+    # updated. The lastmodified field isn't part of the comparison.
     cursor.execute('''
       update operationplan
         set name=tmp.name, type=tmp.type, status=tmp.status, reference=tmp.reference,
@@ -374,8 +608,25 @@ class export:
         location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
         due=tmp.due, color=tmp.color
       from tmp_operationplan as tmp
-      where operationplan.id = tmp.id;
-      ''')
+      where operationplan.id = tmp.id
+      %s;
+      ''' % ('''
+      and (
+        operationplan.name, operationplan.type, operationplan.status,
+        operationplan.reference, operationplan.quantity, operationplan.startdate,
+        operationplan.enddate, operationplan.criticality, operationplan.delay,
+        operationplan.plan, operationplan.source, operationplan.operation_id,
+        operationplan.owner_id, operationplan.item_id, operationplan.destination_id,
+        operationplan.origin_id, operationplan.location_id, operationplan.supplier_id,
+        operationplan.demand_id, operationplan.due, operationplan.color
+        ) is distinct from (
+        tmp.name, tmp.type, tmp.status, tmp.reference, tmp.quantity, tmp.startdate,
+        tmp.enddate, tmp.criticality, tmp.delay * interval '1 second', tmp.plan,
+        tmp.source, tmp.operation_id, tmp.owner_id, tmp.item_id, tmp.destination_id,
+        tmp.origin_id, tmp.location_id, tmp.supplier_id, tmp.demand_id, tmp.due,
+        tmp.color
+        )''' if self.delta else ''))
+    updated = cursor.rowcount
     cursor.execute('''
       insert into operationplan
         (name,type,status,reference,quantity,startdate,enddate,
@@ -397,8 +648,20 @@ class export:
         where operationplan.id = tmp_operationplan.id
         );
       ''')
+    inserted = cursor.rowcount
+    cursor.execute("drop table tmp_operationplan")
+
+    if self.verbosity:
+      print('Exported operationplans%s in %.2f seconds: %d inserted, %d updated, %d deleted, %d reused, %d bytes copied' % (
+        self.getShardName(), time() - starttime, inserted, updated, deleted, reused, copied
+        ))
+
 
-    #update demand table specific fields
+  def updateDemands(self):
+    '''
+    Update the planned quantity, delivery date and delay of the demands.
+    '''
+    cursor = connections[self.database].cursor()
     cursor.execute('''
         with cte as (
           select demand_id, sum(quantity) plannedquantity, max(enddate) deliverydate, max(enddate)-due as delay
@@ -424,78 +687,225 @@ class export:
         )
       ''')
 
-    if self.verbosity:
-      print('Exported operationplans in %.2f seconds' % (time() - starttime))
+
+  def mergeDetails(self, cursor, table, fields):
+    '''
+    Applies the differences between the new materials or resources of the
+    operationplans in a temporary table and the stored records.
+    The records are compared on a hash of their fields. Identical records
+    are numbered, so that duplicates are matched one by one.
+    Returns the number of deleted and inserted records.
+    '''
+    hash = 'md5(row(%s)::text)' % ', '.join(
+      'round(%s, 6)' % f if f in ('quantity', 'onhand') else f
+      for f in fields
+      )
+    cursor.execute('''
+      create temporary table tmp_stored as
+      select id, hash, row_number() over (partition by hash order by id) as seq
+      from (select id, %s as hash from %s) stored
+      ''' % (hash, table))
+    cursor.execute('''
+      create temporary table tmp_new as
+      select *, row_number() over (partition by hash) as seq
+      from (select *, %s as hash from tmp_%s) new
+      ''' % (hash, table))
+    cursor.execute('''
+      delete from %s
+      using tmp_stored, operationplan
+      where %s.id = tmp_stored.id
+      and %s.operationplan_id = operationplan.id
+      and ((operationplan.status='proposed' or operationplan.status is null)
+           or operationplan.type = 'STCK'
+           or %s.status = 'proposed'
+           or %s.status is null)
+      and not exists (
+        select 1 from tmp_new
+        where tmp_new.hash = tmp_stored.hash
+        and tmp_new.seq = tmp_stored.seq
+        )
+      ''' % ((table,) * 5))
+    deleted = cursor.rowcount
+    cursor.execute('''
+      insert into %s (%s, lastmodified)
+      select %s, lastmodified
+      from tmp_new
+      where not exists (
+        select 1 from tmp_stored
+        where tmp_stored.hash = tmp_new.hash
+        and tmp_stored.seq = tmp_new.seq
+        )
+      ''' % (table, ', '.join(fields), ', '.join(fields)))
+    inserted = cursor.rowcount
+    cursor.execute("drop table tmp_stored, tmp_new")
+    return deleted, inserted
 
 
   def exportOperationPlanMaterials(self):
     if self.verbosity:
-      print("Exporting operationplan materials...")
+      print("Exporting operationplan materials%s..." % self.getShardName())
     starttime = time()
     cursor = connections[self.database].cursor()
     currentTime = self.timestamp
-    updates = []
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
-      for i in frepple.buffers():
-        if self.cluster != -1 and self.cluster != i.cluster:
-          continue
-        for j in i.flowplans:
-          #if the record is confirmed, it is already in the table.
-          if j.status == 'confirmed':
-            updates.append('''
-            update operationplanmaterial
-            set onhand=%s, flowdate='%s'
-            where status = 'confirmed' and item_id = %s
-              and location_id = %s and operationplan_id = %s;
-            ''' % (round(j.onhand, 6), str(j.date), adapt(j.buffer.item.name),
-                   adapt(j.buffer.location.name), j.operationplan.id ))
-          else:
-            print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-               j.operationplan.id, j.buffer.item.name, j.buffer.location.name,
-               round(j.quantity, 6),
-               str(j.date), round(j.onhand, 6), j.status, currentTime
-               )), file=tmp)
+    inserted = 0
+    confirmed = 0
+    if self.delta:
+      cursor.execute('''
+        create temporary table tmp_operationplanmaterial (
+          operationplan_id integer NOT NULL,
+          item_id character varying(300),
+          location_id character varying(300),
+          quantity numeric(15,6) NOT NULL,
+          flowdate timestamp with time zone NOT NULL,
+          onhand numeric(15,6) NOT NULL,
+          status character varying(20),
+          lastmodified timestamp with time zone NOT NULL
+        )
+        ''')
+
+    # The confirmed records are already in the table. Only their onhand and
+    # date are updated, from a staging table that is copied afterwards.
+    with tempfile.SpooledTemporaryFile(max_size=self.spoolsize, mode="w+t", encoding='utf-8') as tmp_confirmed:
+      def getFlowplans():
+        nonlocal inserted, confirmed
+        reuse = self.reuse
+        for i in frepple.buffers():
+          if self.skip(i.cluster):
+            continue
+          for j in i.flowplans:
+            if j.status == 'confirmed':
+              confirmed += 1
+              print("%s\t%s\t%s\t%s\t%s" % (
+                reuse.get(j.operationplan.id, j.operationplan.id), j.buffer.item.name, j.buffer.location.name,
+                str(j.date), round(j.onhand, 6)
+                ), file=tmp_confirmed)
+            else:
+              inserted += 1
+              yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+                 reuse.get(j.operationplan.id, j.operationplan.id), j.buffer.item.name, j.buffer.location.name,
+                 round(j.quantity, 6),
+                 str(j.date), round(j.onhand, 6), j.status, currentTime
+                 )
 
-      tmp.seek(0)
+      data = CopyFromGenerator(getFlowplans())
       cursor.copy_from(
-        tmp,
-        'operationplanmaterial',
-        columns=('operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate', 'onhand', 'status', 'lastmodified')
+        data,
+        'tmp_operationplanmaterial' if self.delta else 'operationplanmaterial',
+        columns=('operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate', 'onhand', 'status', 'lastmodified'),
+        size=self.copysize
         )
-      tmp.close()
-    if len(updates) > 0:
-      cursor.execute('\n'.join(updates))
+      copied = data.bytes
+      deleted = 0
+      if self.delta:
+        # Remove the records that changed or disappeared, and insert the new ones
+        deleted, inserted = self.mergeDetails(
+          cursor, 'operationplanmaterial',
+          ('operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate', 'onhand', 'status')
+          )
+        cursor.execute("drop table tmp_operationplanmaterial")
+      updated = 0
+      if confirmed:
+        cursor.execute('''
+          create temporary table tmp_confirmedmaterial (
+            operationplan_id integer NOT NULL,
+            item_id character varying(300) NOT NULL,
+            location_id character varying(300) NOT NULL,
+            flowdate timestamp with time zone NOT NULL,
+            onhand numeric(15,6) NOT NULL
+          )
+          ''')
+        copied += tmp_confirmed.tell()
+        tmp_confirmed.seek(0)
+        cursor.copy_from(tmp_confirmed, 'tmp_confirmedmaterial', size=self.copysize)
+        cursor.execute('''
+          update operationplanmaterial
+          set onhand = tmp.onhand, flowdate = tmp.flowdate
+          from tmp_confirmedmaterial as tmp
+          where operationplanmaterial.status = 'confirmed'
+          and operationplanmaterial.operationplan_id = tmp.operationplan_id
+          and operationplanmaterial.item_id = tmp.item_id
+          and operationplanmaterial.location_id = tmp.location_id
+          and (operationplanmaterial.onhand, operationplanmaterial.flowdate)
+            is distinct from (tmp.onhand, tmp.flowdate)
+          ''')
+        updated = cursor.rowcount
+        cursor.execute("drop table tmp_confirmedmaterial")
     if self.verbosity:
-      print('Exported operationplan materials in %.2f seconds' % (time() - starttime))
+      print('Exported operationplan materials%s in %.2f seconds: %d inserted, %d updated, %d deleted, %d bytes copied' % (
+        self.getShardName(), time() - starttime, inserted, updated, deleted, copied
+        ))
 
 
   def exportOperationPlanResources(self):
     if self.verbosity:
-      print("Exporting operationplan resources...")
+      print("Exporting operationplan resources%s..." % self.getShardName())
     starttime = time()
     cursor = connections[self.database].cursor()
     currentTime = self.timestamp
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+    inserted = 0
+    if self.delta:
+      cursor.execute('''
+        create temporary table tmp_operationplanresource (
+          operationplan_id integer NOT NULL,
+          resource_id character varying(300) NOT NULL,
+          quantity numeric(15,6) NOT NULL,
+          startdate timestamp with time zone NOT NULL,
+          enddate timestamp with time zone NOT NULL,
+          setup character varying(300),
+          status character varying(20),
+          lastmodified timestamp with time zone NOT NULL
+        )
+        ''')
+
+    startdate = datetime.max
+    enddate = datetime.min
+
+    def getLoadplans():
+      nonlocal inserted, startdate, enddate
+      reuse = self.reuse
       for i in frepple.resources():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if self.skip(i.cluster):
           continue
         for j in i.loadplans:
           if j.quantity < 0:
-            print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-              j.operationplan.id, j.resource.name,
+            inserted += 1
+            if j.startdate < startdate:
+              startdate = j.startdate
+            if j.enddate > enddate:
+              enddate = j.enddate
+            yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+              reuse.get(j.operationplan.id, j.operationplan.id), j.resource.name,
               round(-j.quantity, 6),
               str(j.startdate), str(j.enddate),
               j.setup and j.setup or "\\N", j.status, currentTime
-              )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'operationplanresource',
-        columns=('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status', 'lastmodified')
+              )
+
+    data = CopyFromGenerator(getLoadplans())
+    cursor.copy_from(
+      data,
+      'tmp_operationplanresource' if self.delta else 'operationplanresource',
+      columns=('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status', 'lastmodified'),
+      size=self.copysize
+      )
+    copied = data.bytes
+    # The horizon of the resource plan spans the loadplans of all shards
+    with self.lock:
+      if startdate < self.horizon[0]:
+        self.horizon[0] = startdate
+      if enddate > self.horizon[1]:
+        self.horizon[1] = enddate
+    deleted = 0
+    if self.delta:
+      # Remove the records that changed or disappeared, and insert the new ones
+      deleted, inserted = self.mergeDetails(
+        cursor, 'operationplanresource',
+        ('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status')
         )
-      tmp.close()
+      cursor.execute("drop table tmp_operationplanresource")
     if self.verbosity:
-      print('Exported operationplan resources in %.2f seconds' % (time() - starttime))
+      print('Exported operationplan resources%s in %.2f seconds: %d inserted, %d deleted, %d bytes copied' % (
+        self.getShardName(), time() - starttime, inserted, deleted, copied
+        ))
 
 
   def exportResourceplans(self):
@@ -509,16 +919,9 @@ class export:
     # The end date is computed as 5 weeks after the end of the latest loadplan in
     # the entire plan.
     # If no loadplans exist at all we use the current date +- 1 month.
-    startdate = datetime.max
-    enddate = datetime.min
-    for i in frepple.resources():
-      if self.cluster != -1 and self.cluster != i.cluster:
-        continue
-      for j in i.loadplans:
-        if j.startdate < startdate:
-          startdate = j.startdate
-        if j.enddate > enddate:
-          enddate = j.enddate
+    # The dates of the loadplans are collected by the export of the resources
+    # of the operationplans, which runs before this one.
+    startdate, enddate = self.horizon
     if startdate == datetime.max:
       startdate = frepple.settings.current
     if enddate == datetime.min:
@@ -533,119 +936,422 @@ class export:
     while startdate < enddate:
       buckets.append(startdate)
       startdate += timedelta(days=1)
+    # Index of each daily bucket in the plan arrays
+    days = {
+      datetime(i.year, i.month, i.day): idx
+      for idx, i in enumerate(buckets[:-1])
+      }
+
+    # In delta mode we export into a temporary table first
+    if self.delta:
+      table = 'tmp_resourceplan'
+      cursor.execute('''
+        create temporary table tmp_resourceplan (
+          resource character varying(300) NOT NULL,
+          startdate timestamp with time zone NOT NULL,
+          enddate timestamp with time zone NOT NULL,
+          available numeric(15,6),
+          unavailable numeric(15,6),
+          setup numeric(15,6),
+          load numeric(15,6),
+          free numeric(15,6)
+        )
+        ''')
+    else:
+      table = 'out_resourceplan'
+
+    # A parent resource reports the total of the leaf resources below it.
+    # We find the leaves of each parent from the lft and rght fields of the
+    # resource hierarchy.
+    cursor.execute('''
+      select name, lft, rght,
+        exists (select 1 from resource as child where child.owner_id = resource.name)
+      from resource
+      where lft is not null
+      ''')
+    leaves = []
+    parents = {}
+    for name, lft, rght, isparent in cursor.fetchall():
+      if isparent:
+        parents[name] = (lft, rght)
+      else:
+        leaves.append( (lft, name) )
+    leaves.sort()
+    leafkeys = [ i[0] for i in leaves ]
+    ancestors = {}
+    for name, (lft, rght) in parents.items():
+      for idx in range(bisect_right(leafkeys, lft), bisect_left(leafkeys, rght)):
+        ancestors.setdefault(leaves[idx][1], []).append(name)
+
+    # The total of the leaves is accumulated per parent: in arrays for the
+    # daily buckets, and in a dictionary for the buckets of bucketized
+    # resources.
+    rollup = {}
+    own = {}
+
+    def addToParents(name, starts, plan):
+      for parent in ancestors.get(name, []):
+        if parent not in rollup:
+          rollup[parent] = (
+            [ array('d', bytes(8 * len(days))) for i in range(5) ], {}, [False]
+            )
+        acc, other, daily = rollup[parent]
+        if starts is None:
+          daily[0] = True
+          for idx in range(5):
+            acc[idx] = array('d', map(add, acc[idx], plan[idx]))
+        else:
+          for dt, values in zip(starts, zip(*plan)):
+            if dt in other:
+              other[dt] = list(map(add, other[dt], values))
+            else:
+              other[dt] = list(values)
+
+    def formatPlan(name, starts, plan):
+      # The plan is stored sparsely. Consecutive days with the same values
+      # are stored as a single record, and days without availability, load,
+      # setup and free capacity aren't stored at all.
+      # The buckets of bucketized resources are stored as single records.
+      if starts is None:
+        runstart = None
+        runvalues = None
+        for dt, values in zip(buckets, zip(*plan)):
+          values = tuple(round(v, 6) for v in values)
+          if values == runvalues:
+            continue
+          if runstart and any(runvalues):
+            yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+              (name, runstart, datetime(dt.year, dt.month, dt.day)) + runvalues
+              )
+          runstart = datetime(dt.year, dt.month, dt.day)
+          runvalues = values
+        if runstart and any(runvalues):
+          dt = buckets[len(plan[0])]
+          yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+            (name, runstart, datetime(dt.year, dt.month, dt.day)) + runvalues
+            )
+      else:
+        for dt, values in zip(starts, zip(*plan)):
+          if any(values):
+            yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
+              name, dt, dt + timedelta(days=1),
+              round(values[0], 6), round(values[1], 6), round(values[2], 6),
+              round(values[3], 6), round(values[4], 6)
+              )
 
     # Loop over all reporting buckets of all resources
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+    inserted = 0
+
+    def getResourceplans():
+      nonlocal inserted
       for i in frepple.resources():
+        if self.cluster != -1 and self.cluster != i.cluster:
+          continue
+        # The plan is collected as a set of arrays
+        starts = None if not isinstance(i, frepple.resource_buckets) else []
+        plan = [ array('d') for idx in range(5) ]
+        available, unavailable, setup, load, free = plan
         for j in i.plan(buckets):
-          print(("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-           i.name, str(j['start']),
-           round(j['available'], 6),
-           round(j['unavailable'], 6),
-           round(j['setup'], 6),
-           round(j['load'], 6),
-           round(j['free'], 6)
-           )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'out_resourceplan',
-        columns=('resource','startdate','available','unavailable','setup','load','free')
+          if starts is not None:
+            starts.append(j['start'])
+          available.append(j['available'])
+          unavailable.append(j['unavailable'])
+          setup.append(j['setup'])
+          load.append(j['load'])
+          free.append(j['free'])
+        if i.name in parents:
+          own[i.name] = (starts, plan)
+          continue
+        addToParents(i.name, starts, plan)
+        for rec in formatPlan(i.name, starts, plan):
+          inserted += 1
+          yield rec
+
+      # Replace the plan of the parents with the total of their leaves
+      for name, (starts, plan) in own.items():
+        if name in rollup:
+          acc, other, daily = rollup[name]
+          if starts is None:
+            dates = [ datetime(b.year, b.month, b.day) for b in buckets[:len(plan[0])] ]
+          else:
+            dates = starts
+          for pos, dt in enumerate(dates):
+            idx = days.get(dt, None) if daily[0] else None
+            if idx is not None:
+              values = [ col[idx] for col in acc ]
+              if dt in other:
+                values = list(map(add, values, other[dt]))
+            elif dt in other:
+              values = other[dt]
+            else:
+              continue
+            for col, v in zip(plan, values):
+              col[pos] = v
+        for rec in formatPlan(name, starts, plan):
+          inserted += 1
+          yield rec
+
+    data = CopyFromGenerator(getResourceplans())
+    cursor.copy_from(
+      data,
+      table,
+      columns=('resource','startdate','enddate','available','unavailable','setup','load','free'),
+      size=self.copysize
+      )
+    copied = data.bytes
+
+    updated = 0
+    deleted = 0
+    if self.delta:
+      # Merge the temporary table into the actual table, and collect the
+      # resources with a changed plan.
+      changed = set()
+      cursor.execute('''
+        delete from out_resourceplan
+        where not exists (
+          select 1 from tmp_resourceplan as tmp
+          where tmp.resource = out_resourceplan.resource
+          and tmp.startdate = out_resourceplan.startdate
+          )
+        returning resource
+        ''')
+      deleted = cursor.rowcount
+      changed.update(i[0] for i in cursor.fetchall())
+      cursor.execute('''
+        update out_resourceplan
+        set enddate = tmp.enddate,
+        available = tmp.available,
+        unavailable = tmp.unavailable,
+        setup = tmp.setup,
+        load = tmp.load,
+        free = tmp.free
+        from tmp_resourceplan as tmp
+        where out_resourceplan.resource = tmp.resource
+        and out_resourceplan.startdate = tmp.startdate
+        and (
+          out_resourceplan.enddate, out_resourceplan.available, out_resourceplan.unavailable,
+          out_resourceplan.setup, out_resourceplan.load, out_resourceplan.free
+          ) is distinct from (
+          tmp.enddate, tmp.available, tmp.unavailable, tmp.setup, tmp.load, tmp.free
+          )
+        returning out_resourceplan.resource
+        ''')
+      updated = cursor.rowcount
+      changed.update(i[0] for i in cursor.fetchall())
+      cursor.execute('''
+        insert into out_resourceplan
+          (resource, startdate, enddate, available, unavailable, setup, load, free)
+        select resource, startdate, enddate, available, unavailable, setup, load, free
+        from tmp_resourceplan as tmp
+        where not exists (
+          select 1 from out_resourceplan
+          where tmp.resource = out_resourceplan.resource
+          and tmp.startdate = out_resourceplan.startdate
+          )
+        returning resource
+        ''')
+      inserted = cursor.rowcount
+      changed.update(i[0] for i in cursor.fetchall())
+      cursor.execute("drop table tmp_resourceplan")
+
+      # Refresh the bucketed summary of the changed resources only
+      ResourceBucketSummary.refresh(self.database, changed)
+    elif self.cluster != -1:
+      ResourceBucketSummary.refresh(
+        self.database,
+        [ i.name for i in frepple.resources() if i.cluster == self.cluster ]
         )
-      tmp.close()
-    
-    #update owner records with sum of children quantities
-    cursor.execute('''
-      with cte as (
-      select parent.name resource, 
-      out_resourceplan.startdate, 
-      sum(out_resourceplan.available) available, 
-      sum(out_resourceplan.unavailable) unavailable,
-      sum(out_resourceplan.setup) setup, 
-      sum(out_resourceplan.load) "load",
-      sum(out_resourceplan.free) free
-      from resource parent
-      inner join resource child on child.lft > parent.lft and child.rght < parent.rght
-      and not exists (select 1 from resource where owner_id = child.name)
-      inner join out_resourceplan on out_resourceplan.resource = child.name
-      group by parent.name, startdate)
-      update out_resourceplan
-      set available = cte.available,
-      unavailable = cte.unavailable,
-      setup = cte.setup,
-      load = cte.load,
-      free = cte.free
-      from cte
-      where out_resourceplan.resource = cte.resource
-      and out_resourceplan.startdate = cte.startdate
-    ''')
-    
+    else:
+      ResourceBucketSummary.refresh(self.database)
+
     if self.verbosity:
-      print('Exported resourceplans in %.2f seconds' % (time() - starttime))
+      print('Exported resourceplans in %.2f seconds: %d inserted, %d updated, %d deleted, %d bytes copied' % (
+        time() - starttime, inserted, updated, deleted, copied
+        ))
 
 
   def exportPegging(self):
 
     def getDemandPlan():
+      reuse = self.reuse
       for i in frepple.demands():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if self.skip(i.cluster):
           continue
         if i.hidden or not isinstance(i, frepple.demand_default):
           continue
-        peg = []
-        for j in i.pegging:
-          peg.append({
-            'level': j.level,
-            'opplan': j.operationplan.id,
-            'quantity': j.quantity
-            })
-        yield (json.dumps({'pegging': peg}), i.name)
-
-    print("Exporting demand pegging...")
+        yield i, [
+          (j.level, reuse.get(j.operationplan.id, j.operationplan.id), j.quantity)
+          for j in i.pegging
+          ]
+
+    print("Exporting demand pegging%s..." % self.getShardName())
     starttime = time()
-    with transaction.atomic(using=self.database, savepoint=False):
+    cursor = connections[self.database].cursor()
+
+    # Copy the pegging to a temporary table. Temporary tables aren't written
+    # to the WAL, which makes them a cheap staging area.
+    # The same pegging is also copied in the out_pegging table, with a record
+    # per pegged operationplan.
+    cursor.execute('''
+      create temporary table tmp_demandplan (
+        name character varying(300) NOT NULL,
+        plan jsonb
+      );
+      ''')
+    records = 0
+    # The demand plans are streamed to the database. The pegging records
+    # are kept aside in a spooled file, which only goes to disk when it
+    # gets big, and copied afterwards.
+    with tempfile.SpooledTemporaryFile(max_size=self.spoolsize, mode="w+t", encoding='utf-8') as tmp_peg:
+
+      def getDemandLines():
+        nonlocal records
+        for dmd, peg in getDemandPlan():
+          seq = 0
+          for lvl, opplan, qty in peg:
+            seq += 1
+            print("%s\t%s\t%s\t%s\t%s" % (
+              escape(dmd.name), opplan, seq, lvl, round(qty, 6)
+              ), file=tmp_peg)
+          records += seq
+          # We need to double any backslash to assure that the string remains
+          # valid when passing it through postgresql (which eats them away)
+          yield "%s\t%s" % (
+            escape(dmd.name),
+            json.dumps({'pegging': [
+              { 'level': lvl, 'opplan': opplan, 'quantity': qty }
+              for lvl, opplan, qty in peg
+              ]}).replace("\\", "\\\\")
+            )
+
+      data = CopyFromGenerator(getDemandLines())
+      cursor.copy_from(file=data, table='tmp_demandplan', size=self.copysize)
+      copied = data.bytes + tmp_peg.tell()
+      tmp_peg.seek(0)
+      cursor.copy_from(
+        tmp_peg,
+        'out_pegging',
+        columns=('demand', 'operationplan', 'sequence', 'level', 'quantity'),
+        size=self.copysize
+        )
+
+    # Update all demands with a single statement. Demands with an unchanged
+    # pegging aren't touched.
+    cursor.execute('''
+      update demand
+        set plan = tmp.plan
+      from tmp_demandplan as tmp
+      where demand.name = tmp.name
+      and demand.plan is distinct from tmp.plan
+      ''')
+    updated = cursor.rowcount
+    cursor.execute("drop table tmp_demandplan")
+    print('Exported demand pegging%s in %.2f seconds: %d updated, %d pegging records, %d bytes copied' % (
+      self.getShardName(), time() - starttime, updated, records, copied
+      ))
+
+
+  def exportSummaries(self):
+    '''
+    Stores the problem summary and the performance indicators of the plan.
+    The problem totals are collected while exporting the problems. The
+    indicators are computed from the plan tables, because these also contain
+    the closed operationplans that aren't loaded in the plan.
+    '''
+    if self.verbosity:
+      print("Exporting plan summaries...")
+    starttime = time()
+    if self.cluster != -1:
+      # A partial export only replaces the problems of a single cluster
+      ProblemSummary.refresh(self.database)
+    else:
       cursor = connections[self.database].cursor()
+      cursor.execute("truncate table out_problemsummary")
       cursor.executemany(
-        "update demand set plan=%s where name=%s",
-        [ i for i in getDemandPlan() ]
+        "insert into out_problemsummary (entity, name, count, weight) values (%s, %s, %s, %s)",
+        [
+          (k[1], k[2], v, round(self.summary[('weight',) + k[1:]], 6))
+          for k, v in self.summary.items()
+          if k[0] == 'problems'
+          ]
         )
-    print('Exported demand pegging in %.2f seconds' % (time() - starttime))
+    KPI.refresh(self.database)
+    if self.verbosity:
+      print('Exported plan summaries in %.2f seconds' % (time() - starttime))
 
 
+  def runParallel(self, *tasks):
+    '''
+    Runs a list of (export object, function) tuples over the pool of
+    database connections, and waits for all of them to finish.
+    '''
+    queue = Queue()
+    for t in tasks:
+      queue.put(t)
+    pipes = [
+      DatabasePipe(self, queue=queue)
+      for i in range(min(self.connections, len(tasks)))
+      ]
+    # Start all threads
+    for i in pipes:
+      i.start()
+    # Wait for all threads to finish
+    for i in pipes:
+      i.join()
+    for i in pipes:
+      if i.exception:
+        raise i.exception
 
 
   def run(self):
     '''
     This function exports the data from the frePPLe memory into the database.
-    The export runs in parallel over 2 connections to PostgreSQL.
+    The export runs in parallel over a pool of connections to PostgreSQL.
+    The operationplans, their materials and resources and the pegging are
+    split in shards by cluster, and each shard streams its own data.
     '''
+    self.summary.clear()
+    self.reuse.clear()
+    self.horizon[:] = [datetime.max, datetime.min]
+
     # Truncate
     task = DatabasePipe(self, export.truncate)
     task.start()
     task.join()
+    if task.exception:
+      raise task.exception
+
+    # In delta mode the operationplans are exported as a single shard, since
+    # finding the obsolete operationplans requires the complete plan.
+    shards = self.getShards(1 if self.delta else self.connections)
 
     # Export process
-    tasks = (
-       DatabasePipe(
-         self,
-         export.exportResourceplans,
-         export.exportProblems,
-         export.exportConstraints
-         ),
-      DatabasePipe(
-        self,
-        export.exportOperationplans,
-         export.exportOperationPlanMaterials,
-         export.exportOperationPlanResources,
-         export.exportPegging
-        ),
+    tasks = [ (i, export.exportOperationplans) for i in shards ]
+    tasks.extend([
+      (self, export.exportProblems),
+      (self, export.exportConstraints)
+      ])
+    if not self.delta:
+      tasks.extend([ (i, export.exportPegging) for i in shards ])
+    self.runParallel(*tasks)
+
+    # Materials and resources refer to the operationplans. They can only
+    # be exported when all operationplans are stored.
+    # In delta mode the pegging also waits for the operationplans, since it
+    # uses the ids reused from the stored operationplans.
+    tasks = [ (i, export.exportOperationPlanMaterials) for i in shards ]
+    tasks.extend([ (i, export.exportOperationPlanResources) for i in shards ])
+    if self.delta:
+      tasks.extend([ (i, export.exportPegging) for i in shards ])
+    tasks.append( (self, export.updateDemands) )
+    self.runParallel(*tasks)
+
+    # The summaries need the totals of all shards, and the resource plan
+    # needs the horizon of the loadplans of all shards
+    self.runParallel(
+      (self, export.exportResourceplans),
+      (self, export.exportSummaries)
       )
-    # Start all threads
-    for i in tasks:
-      i.start()
-    # Wait for all threads to finish
-    for i in tasks:
-      i.join()
 
     # Report on the output
     if self.verbosity:
@@ -687,15 +1393,19 @@ class export:
       process.stdin.write("SET client_encoding = 'UTF8';\n".encode(self.encoding))
 
     # Send all output to the PSQL process through a pipe
+    self.summary.clear()
+    self.horizon[:] = [datetime.max, datetime.min]
     try:
       self.truncate()
       self.exportProblems()
       self.exportConstraints()
       self.exportOperationplans()
+      self.updateDemands()
       self.exportOperationPlanMaterials()
       self.exportOperationPlanResources()
       self.exportResourceplans()
       self.exportPegging()
+      self.exportSummaries()
     except:
       print('An error occured during the sequential export')
 
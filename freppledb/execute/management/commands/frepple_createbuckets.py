@@ -24,6 +24,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.template import Template, RequestContext
 
 from freppledb.common.models import Bucket, BucketDetail
+from freppledb.output.models import ResourceBucketSummary
 from freppledb.execute.models import Task
 from freppledb.common.models import User
 from freppledb import VERSION
@@ -199,6 +200,9 @@ class Command(BaseCommand):
           # Next date
           curdate = curdate + timedelta(1)
 
+        # The resource plan summary depends on the buckets
+        ResourceBucketSummary.refresh(database)
+
       # Log success
       task.status = 'Done'
       task.finished = datetime.now()
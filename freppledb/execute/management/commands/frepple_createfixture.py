@@ -191,5 +191,11 @@ class Command(BaseCommand):
       if n>0:
         file_object.write(",\n")
       n = Command.extractTable(database,file_object, 'out_problem', 'output.problem')
+      if n>0:
+        file_object.write(",\n")
+      n = Command.extractTable(database,file_object, 'out_problemsummary', 'output.problemsummary')
+      if n>0:
+        file_object.write(",\n")
+      n = Command.extractTable(database,file_object, 'out_kpi', 'output.kpi')
       #close the square bracket
       file_object.write("\n]")
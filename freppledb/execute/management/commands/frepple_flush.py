@@ -141,10 +141,17 @@ class Command(BaseCommand):
         tables.add('operationplanmaterial')
         tables.add('operationplanresource')
         tables.add('out_problem')
+        tables.add('out_pegging')
+        tables.add('out_problemsummary')
+        tables.add('out_kpi')
       if 'resource' in tables and 'out_resourceplan' not in tables:
         tables.add('out_resourceplan')
+      if ('resource' in tables or 'common_bucket' in tables) and 'out_resourcebucket' not in tables:
+        tables.add('out_resourcebucket')
       if 'demand' in tables and 'out_constraint' not in tables:
         tables.add('out_constraint')
+      if 'demand' in tables and 'out_pegging' not in tables:
+        tables.add('out_pegging')
       tables.discard('auth_group_permissions')
       tables.discard('auth_permission')
       tables.discard('auth_group')
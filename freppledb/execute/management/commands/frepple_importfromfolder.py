@@ -224,7 +224,7 @@ class Command(BaseCommand):
     datafile = EncodedCSVReader(file, delimiter=self.delimiter)
     try:
       with transaction.atomic(using=self.database):
-        for error in parseCSVdata(model, datafile, user=self.user, database=self.database):
+        for error in parseCSVdata(model, datafile, user=self.user, database=self.database, bulk=True):
           if error[0] == ERROR:
             print('%s Error: %s%s%s%s' % (
               datetime.now().replace(microsecond=0),
@@ -265,7 +265,7 @@ class Command(BaseCommand):
         wb = load_workbook(filename=file, read_only=True, data_only=True)
         for ws_name in wb.get_sheet_names():
           ws = wb.get_sheet_by_name(name=ws_name)
-          for error in parseExcelWorksheet(model, ws, user=self.user, database=self.database):
+          for error in parseExcelWorksheet(model, ws, user=self.user, database=self.database, bulk=True):
             if error[0] == ERROR:
               print('%s Error: %s%s%s%s' % (
                 datetime.now().replace(microsecond=0),
@@ -28,8 +28,10 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, connections
 
 from freppledb import VERSION
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import Parameter
 from freppledb.execute.models import Task
+from freppledb.output.models import ResourceBucketSummary
 
 
 logger = logging.getLogger(__name__)
@@ -154,6 +156,8 @@ class Command(BaseCommand):
         elif task.name == 'load dataset':
           args = task.arguments.split()
           management.call_command('loaddata', *args, verbosity=0, database=database, task=task.id)
+          # The dataset can contain a resource plan and buckets
+          ResourceBucketSummary.refresh(database)
         # E
         elif task.name == 'copy scenario':
           args = task.arguments.split()
@@ -219,6 +223,8 @@ class Command(BaseCommand):
         task.message = str(e)
         task.save(using=database)
         logger.info("finished task %d at %s: failed" % (task.id, datetime.now()))
+      # Tasks can change the data: the cached dashboard widgets are outdated
+      Dashboard.invalidate(database)
     # Remove the parameter again
     try:
       Parameter.objects.all().using(database).get(pk='Worker alive').delete()
@@ -16,15 +16,22 @@
 #
 
 import base64
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
 import json
+from io import StringIO
 import os
+import sys
 from time import sleep
+from types import SimpleNamespace
+from unittest.mock import patch
 
 from django.conf import settings
 from django.core import management
 from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.models import Sum, Count, Q
-from django.test import TransactionTestCase
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 
 import freppledb.output as output
 import freppledb.input as input
@@ -52,6 +59,7 @@ class execute_with_commands(TransactionTestCase):
     self.assertEqual(input.models.Calendar.objects.count(), 0)
     self.assertEqual(input.models.Demand.objects.count(), 0)
     self.assertEqual(output.models.Problem.objects.count(), 0)
+    self.assertEqual(output.models.Pegging.objects.count(), 0)
     self.assertEqual(input.models.OperationMaterial.objects.count(), 0)
     self.assertEqual(input.models.OperationPlanResource.objects.count(), 0)
     self.assertEqual(input.models.PurchaseOrder.objects.count(), 0)
@@ -71,6 +79,15 @@ class execute_with_commands(TransactionTestCase):
     self.assertTrue(input.models.OperationPlanMaterial.objects.count() > 400)
     self.assertTrue(input.models.OperationPlanResource.objects.count() > 20)
     self.assertTrue(input.models.OperationPlan.objects.count() > 300)
+    # The pegging table holds the same pegging as the demands
+    self.assertEqual(
+      output.models.Pegging.objects.count(),
+      sum(
+        len(d.plan.get('pegging', []))
+        for d in input.models.Demand.objects.all()
+        if isinstance(d.plan, dict)
+        )
+      )
 
 
 class execute_multidb(TransactionTestCase):
@@ -138,6 +155,534 @@ class execute_multidb(TransactionTestCase):
     self.assertNotEqual(count2, count1new)
 
 
+class execute_binary_loader(TransactionTestCase):
+
+  fixtures = ["demo"]
+
+  def setUp(self):
+    # Make sure the test database is used
+    os.environ['FREPPLE_TEST'] = "YES"
+    param = Parameter.objects.all().get_or_create(pk='plan.webservice')[0]
+    param.value = 'false'
+    param.save()
+
+  def tearDown(self):
+    del os.environ['FREPPLE_TEST']
+    if 'loader' in os.environ:
+      del os.environ['loader']
+
+  def getPlan(self):
+    return [
+      (i.name, i.type, i.startdate, i.enddate, i.quantity)
+      for i in input.models.OperationPlan.objects.order_by('name', 'startdate', 'quantity')
+      ]
+
+  def test_binary_loader(self):
+    # The binary bulk loader must produce exactly the same plan
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    plan = self.getPlan()
+    self.assertGreater(len(plan), 0)
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply,loader=binary')
+    self.assertEqual(self.getPlan(), plan)
+
+
+class execute_delta_export(TransactionTestCase):
+
+  fixtures = ["demo"]
+
+  def setUp(self):
+    # Make sure the test database is used
+    os.environ['FREPPLE_TEST'] = "YES"
+    param = Parameter.objects.all().get_or_create(pk='plan.webservice')[0]
+    param.value = 'false'
+    param.save()
+
+  def tearDown(self):
+    del os.environ['FREPPLE_TEST']
+    if 'export' in os.environ:
+      del os.environ['export']
+
+  def getPlan(self):
+    # The ids are left out: the delta export keeps the ids of the stored
+    # operationplans that are planned again
+    return (
+      sorted([
+        (i.name, i.type, i.startdate, i.enddate, i.quantity)
+        for i in input.models.OperationPlan.objects.all()
+      ]),
+      sorted([
+        (i.item_id, i.location_id, i.flowdate, i.quantity, i.onhand)
+        for i in input.models.OperationPlanMaterial.objects.all()
+      ]),
+      sorted([
+        (i.resource_id, i.startdate, i.enddate, i.quantity)
+        for i in input.models.OperationPlanResource.objects.all()
+      ]),
+      output.models.ResourceSummary.objects.count(),
+      [
+        (i.resource, i.bucket, i.startdate, i.load, i.available)
+        for i in output.models.ResourceBucketSummary.objects.order_by('resource', 'bucket', 'startdate')
+      ]
+      )
+
+  def test_delta_export(self):
+    # A delta export must leave the same plan in the database as a full export
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    plan = self.getPlan()
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply,export=delta')
+    self.assertEqual(self.getPlan(), plan)
+    management.call_command('frepple_run', plantype=2, constraint=0, env='supply,export=delta')
+    delta_plan = self.getPlan()
+    management.call_command('frepple_run', plantype=2, constraint=0, env='supply')
+    self.assertEqual(self.getPlan(), delta_plan)
+
+  def test_reused_ids(self):
+    # Planning the same model again creates identical operationplans with new
+    # ids. The delta export keeps the stored records and their ids.
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    ids = set(input.models.OperationPlan.objects.values_list('id', flat=True))
+    materials = set(input.models.OperationPlanMaterial.objects.values_list('id', flat=True))
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply,export=delta')
+    self.assertEqual(set(input.models.OperationPlan.objects.values_list('id', flat=True)), ids)
+    self.assertEqual(set(input.models.OperationPlanMaterial.objects.values_list('id', flat=True)), materials)
+    # The materials, resources and pegging refer to the stored ids
+    self.assertFalse(input.models.OperationPlanMaterial.objects.exclude(operationplan__in=ids).exists())
+    self.assertFalse(input.models.OperationPlanResource.objects.exclude(operationplan__in=ids).exists())
+    self.assertFalse(output.models.Pegging.objects.exclude(operationplan__in=ids).exists())
+    for i in input.models.Demand.objects.exclude(plan__isnull=True):
+      for j in i.plan.get('pegging', []):
+        self.assertIn(j['opplan'], ids)
+
+  def getConfirmedMaterials(self, opplan):
+    return sorted([
+      (i.item_id, i.location_id, i.quantity, i.flowdate, i.onhand, i.status)
+      for i in input.models.OperationPlanMaterial.objects.filter(operationplan=opplan)
+      ])
+
+  def test_confirmed_materials(self):
+    # The export updates the onhand of the materials of confirmed
+    # operationplans, without inserting them again
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    opplan = input.models.OperationPlan.objects.filter(type='PO').order_by('id')[0]
+    opplan.status = 'confirmed'
+    opplan.save()
+    input.models.OperationPlanMaterial.objects.filter(operationplan=opplan).update(status='confirmed')
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    materials = self.getConfirmedMaterials(opplan)
+    self.assertGreater(len(materials), 0)
+    self.assertTrue(all(i[5] == 'confirmed' for i in materials))
+    # The date of confirmed materials is input to the plan, the onhand isn't
+    input.models.OperationPlanMaterial.objects.filter(operationplan=opplan).update(onhand=-999)
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    self.assertEqual(self.getConfirmedMaterials(opplan), materials)
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply,export=delta')
+    self.assertEqual(self.getConfirmedMaterials(opplan), materials)
+
+
+class execute_parallel_export(TransactionTestCase):
+
+  fixtures = ["demo"]
+
+  def setUp(self):
+    # Make sure the test database is used
+    os.environ['FREPPLE_TEST'] = "YES"
+    param = Parameter.objects.all().get_or_create(pk='plan.webservice')[0]
+    param.value = 'false'
+    param.save()
+
+  def tearDown(self):
+    del os.environ['FREPPLE_TEST']
+
+  def getCounts(self):
+    return (
+      input.models.OperationPlan.objects.count(),
+      input.models.OperationPlanMaterial.objects.count(),
+      input.models.OperationPlanResource.objects.count(),
+      input.models.Demand.objects.filter(plan__isnull=False).count()
+      )
+
+  def test_sharded_export(self):
+    # The number of export connections doesn't change the exported plan
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    counts = self.getCounts()
+    param = Parameter.objects.all().get_or_create(pk='plan.exportConnections')[0]
+    param.value = '5'
+    param.save()
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    self.assertEqual(self.getCounts(), counts)
+
+  def getSummaries(self):
+    return (
+      [
+        (i.entity, i.name, i.count, i.weight)
+        for i in output.models.ProblemSummary.objects.order_by('entity', 'name')
+      ],
+      [
+        (i.sequence, i.category, i.name, i.value)
+        for i in output.models.KPI.objects.order_by('sequence', 'category', 'name')
+      ]
+      )
+
+  def test_summaries(self):
+    # The summaries collected during the export match the exported plan
+    param = Parameter.objects.all().get_or_create(pk='plan.exportConnections')[0]
+    param.value = '3'
+    param.save()
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    summaries = self.getSummaries()
+    self.assertGreater(len(summaries[1]), 0)
+    output.models.ProblemSummary.refresh()
+    output.models.KPI.refresh()
+    self.assertEqual(self.getSummaries(), summaries)
+
+  def test_summaries_closed(self):
+    # Closed operationplans aren't loaded in the plan, but they are counted in
+    # the indicators of the exported plan
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    closed = input.models.OperationPlan.objects.filter(type='PO').order_by('id')[0]
+    closed.status = 'closed'
+    closed.save()
+    management.call_command('frepple_run', plantype=1, constraint=15, env='supply')
+    self.assertTrue(input.models.OperationPlan.objects.filter(pk=closed.pk, status='closed').exists())
+    summaries = self.getSummaries()
+    output.models.ProblemSummary.refresh()
+    output.models.KPI.refresh()
+    self.assertEqual(self.getSummaries(), summaries)
+
+
+class execute_export_shards(SimpleTestCase):
+
+  def test_balance(self):
+    # Stand-in operations of 5 clusters, with 10, 6, 3, 2 and 1 operationplans
+    operations = [
+      SimpleNamespace(cluster=cluster, operationplans=[None] * size)
+      for cluster, size in [(1, 4), (1, 6), (2, 6), (3, 3), (4, 2), (5, 1), (5, 0)]
+      ]
+    frepple = SimpleNamespace(operations=lambda: iter(operations))
+    with patch.dict(sys.modules, {'frepple': frepple}):
+      from freppledb.execute.export_database_plan import export
+      shards = export(database=DEFAULT_DB_ALIAS, verbosity=0).getShards(2)
+    # Every cluster is exported by a single shard
+    for cluster in range(1, 6):
+      self.assertEqual(len([ i for i in shards if not i.skip(cluster) ]), 1)
+    # Both shards export the same number of operationplans
+    self.assertEqual(
+      [ sum(len(o.operationplans) for o in operations if not i.skip(o.cluster)) for i in shards ],
+      [11, 11]
+      )
+
+
+class StandInResource:
+  '''
+  Stand-in for a resource of the frePPLe engine, with a daily plan.
+  '''
+  def __init__(self, name, values, loadplans=()):
+    self.name = name
+    self.cluster = 1
+    self.values = values
+    self.loadplans = [
+      SimpleNamespace(
+        startdate=i[0], enddate=i[1], quantity=-1, resource=self,
+        operationplan=SimpleNamespace(id=1), setup=None, status='proposed'
+        )
+      for i in loadplans
+      ]
+    self.buckets = None
+
+  def getPlan(self, buckets):
+    for i in buckets[:-1]:
+      yield datetime(i.year, i.month, i.day)
+
+  def plan(self, buckets):
+    self.buckets = buckets
+    for start in self.getPlan(buckets):
+      values = self.values(start)
+      yield {
+        'start': start, 'available': values[0], 'unavailable': values[1],
+        'setup': values[2], 'load': values[3], 'free': values[4]
+        }
+
+
+class StandInBucketResource(StandInResource):
+  '''
+  Stand-in for a bucketized resource of the frePPLe engine, with weekly
+  buckets starting on monday.
+  '''
+  def getPlan(self, buckets):
+    for i in buckets[:-1]:
+      if i.weekday() == 0:
+        yield datetime(i.year, i.month, i.day)
+
+
+class execute_resourceplan_export(TestCase):
+  '''
+  Compares the resource plan export with a dense daily export of the same
+  plan, rolled up to the parent resources with the SQL statement that the
+  export used before.
+  '''
+
+  def setUp(self):
+    # Resource hierarchy:
+    #   top
+    #    |- parent
+    #    |   |- daily
+    #    |   |- weekly (bucketized)
+    #    |- sparse
+    top = input.models.Resource.objects.create(name='top')
+    parent = input.models.Resource.objects.create(name='parent', owner=top)
+    input.models.Resource.objects.create(name='daily', owner=parent)
+    input.models.Resource.objects.create(name='weekly', owner=parent, type='buckets')
+    input.models.Resource.objects.create(name='sparse', owner=top)
+    input.models.Resource.rebuildHierarchy()
+    input.models.OperationPlan.objects.bulk_create([
+      input.models.OperationPlan(id=1, type='MO', status='proposed')
+      ])
+
+    def own(dt):
+      # The parents have a plan of their own, which the rollup replaces
+      return (1, 0, 0, 0, 1)
+
+    def daily(dt):
+      if dt.weekday() >= 5:
+        return (0, 24, 0, 0, 0)
+      load = (dt.day % 3) * 2
+      return (8, 16, 0, load, 8 - load)
+
+    def weekly(dt):
+      if dt < datetime(2018, 1, 1):
+        return (0, 0, 0, 0, 0)
+      return (40, 0, 0, 10.5, 29.5)
+
+    def sparse(dt):
+      # Only has capacity in a window of one month
+      if datetime(2018, 1, 15) <= dt < datetime(2018, 2, 15):
+        return (4, 0, 1, 2, 1)
+      return (0, 0, 0, 0, 0)
+
+    self.resources = [
+      StandInResource('top', own),
+      StandInResource('parent', own),
+      StandInResource('daily', daily, [
+        (datetime(2018, 1, 10, 8), datetime(2018, 1, 10, 12)),
+        (datetime(2018, 2, 1, 8), datetime(2018, 2, 1, 17))
+        ]),
+      StandInBucketResource('weekly', weekly),
+      StandInResource('sparse', sparse, [
+        (datetime(2018, 1, 20, 8), datetime(2018, 2, 20, 17))
+        ])
+      ]
+
+  def test_resourceplan(self):
+    frepple = SimpleNamespace(
+      resources=lambda: iter(self.resources),
+      resource_buckets=StandInBucketResource,
+      settings=SimpleNamespace(current=datetime(2018, 1, 1))
+      )
+    with patch.dict(sys.modules, {'frepple': frepple}):
+      from freppledb.execute.export_database_plan import export
+      exporter = export(database=DEFAULT_DB_ALIAS, verbosity=0)
+      exporter.exportOperationPlanResources()
+      exporter.exportResourceplans()
+
+    # The horizon runs from 30 days before the first loadplan till 30 days
+    # after the last loadplan. The export of the loadplans collects their
+    # dates.
+    self.assertEqual(input.models.OperationPlanResource.objects.count(), 3)
+    buckets = self.resources[0].buckets
+    self.assertEqual(buckets[0], date(2017, 12, 11))
+    self.assertEqual(buckets[-1], date(2018, 3, 22))
+    self.assertEqual(len(buckets), (buckets[-1] - buckets[0]).days + 1)
+
+    # Dense daily export, with a record for every bucket of every resource
+    cursor = connections[DEFAULT_DB_ALIAS].cursor()
+    cursor.execute('''
+      create temporary table tmp_denseplan (
+        resource character varying(300) NOT NULL,
+        startdate timestamp with time zone NOT NULL,
+        available numeric(15,6),
+        unavailable numeric(15,6),
+        setup numeric(15,6),
+        load numeric(15,6),
+        free numeric(15,6)
+      )
+      ''')
+    cursor.executemany(
+      "insert into tmp_denseplan values (%s, %s, %s, %s, %s, %s, %s)",
+      [
+        (i.name, j['start'], j['available'], j['unavailable'], j['setup'], j['load'], j['free'])
+        for i in self.resources
+        for j in i.plan(buckets)
+      ])
+    # Previous rollup of the leaf resources into their parents
+    cursor.execute('''
+      with cte as (
+      select parent.name resource,
+      tmp_denseplan.startdate,
+      sum(tmp_denseplan.available) available,
+      sum(tmp_denseplan.unavailable) unavailable,
+      sum(tmp_denseplan.setup) setup,
+      sum(tmp_denseplan.load) "load",
+      sum(tmp_denseplan.free) free
+      from resource parent
+      inner join resource child on child.lft > parent.lft and child.rght < parent.rght
+      and not exists (select 1 from resource where owner_id = child.name)
+      inner join tmp_denseplan on tmp_denseplan.resource = child.name
+      group by parent.name, startdate)
+      update tmp_denseplan
+      set available = cte.available,
+      unavailable = cte.unavailable,
+      setup = cte.setup,
+      load = cte.load,
+      free = cte.free
+      from cte
+      where tmp_denseplan.resource = cte.resource
+      and tmp_denseplan.startdate = cte.startdate
+      ''')
+
+    # Expanding the exported records into days gives the dense plan, without
+    # the empty days
+    cursor.execute('''
+      create temporary table tmp_expandedplan as
+      select resource, day as startdate, available, unavailable, setup, load, free
+      from out_resourceplan
+      cross join generate_series(startdate, enddate - interval '1 day', interval '1 day') as day
+      ''')
+    cursor.execute('''
+      delete from tmp_denseplan
+      where (available, unavailable, setup, load, free) = (0, 0, 0, 0, 0)
+      ''')
+    cursor.execute('''
+      select * from (
+        select * from tmp_expandedplan
+        except all
+        select * from tmp_denseplan
+      ) missing
+      union all
+      select * from (
+        select * from tmp_denseplan
+        except all
+        select * from tmp_expandedplan
+      ) extra
+      ''')
+    self.assertEqual(cursor.fetchall(), [])
+
+    # Check the rollup and the sparse storage of some records
+    cursor.execute("select count(*) from tmp_denseplan")
+    dense = cursor.fetchone()[0]
+    self.assertLess(output.models.ResourceSummary.objects.count(), dense)
+    self.assertFalse(output.models.ResourceSummary.objects.filter(resource='weekly', startdate__lt=datetime(2018, 1, 1)).exists())
+    self.assertEqual(
+      output.models.ResourceSummary.objects.filter(resource='sparse').count(), 1
+      )
+    rec = output.models.ResourceSummary.objects.get(resource='parent', startdate=datetime(2018, 1, 1))
+    self.assertEqual(
+      (rec.available, rec.load, rec.free),
+      (8 + 40, (1 % 3) * 2 + 10.5, 8 - (1 % 3) * 2 + 29.5)
+      )
+    rec = output.models.ResourceSummary.objects.get(resource='top', startdate=datetime(2018, 1, 16))
+    self.assertEqual(
+      (rec.available, rec.setup, rec.load, rec.enddate),
+      (8 + 4, 1, (16 % 3) * 2 + 2, datetime(2018, 1, 17))
+      )
+
+
+class StandInDemand:
+  '''
+  Stand-in for a demand of the frePPLe engine, with its pegging.
+  '''
+  def __init__(self, name, pegging, hidden=False):
+    self.name = name
+    self.cluster = 1
+    self.hidden = hidden
+    self.pegging = [
+      SimpleNamespace(level=i[0], operationplan=SimpleNamespace(id=i[1]), quantity=i[2])
+      for i in pegging
+      ]
+
+
+class execute_pegging_export(TestCase):
+  '''
+  Compares the set-based update of the demand pegging with the update of
+  one demand at a time that the export used before.
+  '''
+
+  def setUp(self):
+    item = input.models.Item.objects.create(name='item')
+    location = input.models.Location.objects.create(name='location')
+    customer = input.models.Customer.objects.create(name='customer')
+    self.demands = [
+      StandInDemand('multilevel', [(0, 1, 10), (1, 2, 10), (1, 3, 2.5), (2, 4, 1 / 3)]),
+      StandInDemand('tab\tand back\\slash', [(0, 5, 1)]),
+      StandInDemand('unplanned', []),
+      StandInDemand('unchanged', [(0, 6, 4)]),
+      StandInDemand('hidden', [(0, 7, 1)], hidden=True)
+      ]
+    for d in self.demands:
+      input.models.Demand.objects.create(
+        name=d.name, item=item, location=location, customer=customer,
+        due=datetime(2018, 1, 1), plan={}
+        )
+    input.models.Demand.objects.filter(name='unchanged').update(
+      plan={'pegging': [{'level': 0, 'opplan': 6, 'quantity': 4}]}
+      )
+    self.initial = self.getPlans()
+
+  def getPlans(self):
+    return {
+      d.name: d.plan
+      for d in input.models.Demand.objects.all()
+      }
+
+  def rowByRow(self):
+    # The pegging update before it was set-based
+    cursor = connections[DEFAULT_DB_ALIAS].cursor()
+    with transaction.atomic():
+      cursor.executemany(
+        "update demand set plan=%s where name=%s",
+        [
+          (
+            json.dumps({'pegging': [
+              { 'level': j.level, 'opplan': j.operationplan.id, 'quantity': j.quantity }
+              for j in d.pegging
+              ]}),
+            d.name
+          )
+          for d in self.demands
+          if not d.hidden
+        ])
+
+  def test_pegging(self):
+    self.rowByRow()
+    expected = self.getPlans()
+    self.assertNotEqual(expected, self.initial)
+    for name, plan in self.initial.items():
+      input.models.Demand.objects.filter(name=name).update(plan=plan)
+
+    frepple = SimpleNamespace(
+      demands=lambda: iter(self.demands),
+      demand_default=StandInDemand
+      )
+    with patch.dict(sys.modules, {'frepple': frepple}):
+      from freppledb.execute.export_database_plan import export
+      with redirect_stdout(StringIO()) as log:
+        export(database=DEFAULT_DB_ALIAS, verbosity=0).exportPegging()
+      self.assertEqual(self.getPlans(), expected)
+      self.assertIn(': 3 updated, 6 pegging records', log.getvalue())
+      self.assertEqual(
+        sorted(output.models.Pegging.objects.values_list('demand', 'operationplan', 'sequence', 'level')),
+        [
+          ('multilevel', 1, 1, 0), ('multilevel', 2, 2, 1), ('multilevel', 3, 3, 1),
+          ('multilevel', 4, 4, 2), ('tab\tand back\\slash', 5, 1, 0), ('unchanged', 6, 1, 0)
+          ]
+        )
+
+      # Exporting the same pegging again doesn't update any demand
+      with redirect_stdout(StringIO()) as log:
+        export(database=DEFAULT_DB_ALIAS, verbosity=0).exportPegging()
+      self.assertEqual(self.getPlans(), expected)
+      self.assertIn(': 0 updated, 6 pegging records', log.getvalue())
+
+
 class FixtureTest(TransactionTestCase):
 
   def test_fixture_demo(self):
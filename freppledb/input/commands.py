@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+from contextlib import contextmanager
 import os
 from time import time
 from datetime import datetime
@@ -22,6 +23,7 @@ from django.db import connections, DEFAULT_DB_ALIAS
 
 from freppledb.boot import getAttributes
 from freppledb.common.commands import PlanTaskRegistry, PlanTask
+from freppledb.common.pgcopy import BinaryCopyReader
 from freppledb.input.models import Resource, Item
 
 
@@ -45,6 +47,7 @@ class LoadTask(PlanTask):
     - low weight by default, ie fast execution assumed
     - filter attribute to load only a subset of the data
     - subclass is used by the odoo connector to recognize data loading tasks 
+    - query method to read the data, which can use the binary bulk loader
   '''
   
   @staticmethod
@@ -53,6 +56,47 @@ class LoadTask(PlanTask):
 
   filter = None
 
+  # Number of rows fetched from the database at once
+  batchsize = 10000
+
+  @classmethod
+  @contextmanager
+  def query(cls, cursor, sql):
+    '''
+    Context manager returning the result rows of a SQL query.
+
+    By default the rows are fetched in batches from the server-side cursor
+    passed as argument.
+    When the environment variable "loader" is set to "binary" (ie the
+    argument --env=loader=binary is passed to the frepple_run command) the
+    table is instead pulled with a binary COPY statement and decoded in bulk.
+    Both methods return the same rows.
+
+    Fetching and decoding a batch happens without any lock. The rows of
+    the batch are then handed out while holding the model lock, which
+    serializes the model updates of tasks running in parallel.
+    '''
+    if os.environ.get('loader', None) == 'binary':
+      with BinaryCopyReader(connections[cursor.db.alias], sql, batchsize=cls.batchsize) as reader:
+        rows = cls.handoff( zip(*b) for b in reader.batches() )
+        try:
+          yield rows
+        finally:
+          rows.close()
+    else:
+      cursor.execute(sql)
+      rows = cls.handoff(iter(lambda: cursor.fetchmany(cls.batchsize), []))
+      try:
+        yield rows
+      finally:
+        rows.close()
+
+  @staticmethod
+  def handoff(batches):
+    for batch in batches:
+      with PlanTaskRegistry.lock:
+        yield from batch
+
 
 @PlanTaskRegistry.register
 class checkBuckets(CheckTask):
@@ -61,6 +105,7 @@ class checkBuckets(CheckTask):
   # check for overlaps (more than 1 bucket have the same startdate or the same enddate)
   description = "Checking Buckets"
   sequence = 80
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -105,28 +150,29 @@ class loadParameter(LoadTask):
 
   description = "Importing parameters"
   sequence = 90
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
     import frepple
 
     with connections[database].chunked_cursor() as cursor:
-      cursor.execute('''
+      default_current_date = True
+      with cls.query(cursor, '''
         SELECT name, value
         FROM common_parameter
         where name in ('currentdate', 'plan.calendar')
-        ''')
-      default_current_date = True
-      for rec in cursor:
-        if rec[0] == 'currentdate':
-          try:
-            frepple.settings.current = datetime.strptime(rec[1], "%Y-%m-%d %H:%M:%S")
-            default_current_date = False
-          except:
-            pass
-        elif rec[0] == 'plan.calendar' and rec[1]:
-          frepple.settings.calendar = frepple.calendar(name=rec[1])
-          print('Bucketized planning using calendar %s' % rec[1])
+        ''') as rows:
+        for rec in rows:
+          if rec[0] == 'currentdate':
+            try:
+              frepple.settings.current = datetime.strptime(rec[1], "%Y-%m-%d %H:%M:%S")
+              default_current_date = False
+            except:
+              pass
+          elif rec[0] == 'plan.calendar' and rec[1]:
+            frepple.settings.calendar = frepple.calendar(name=rec[1])
+            print('Bucketized planning using calendar %s' % rec[1])
       if default_current_date:
         frepple.settings.current = datetime.now().replace(microsecond=0)
       print('Current date: %s' % frepple.settings.current)
@@ -137,6 +183,7 @@ class loadLocations(LoadTask):
 
   description = "Importing locations"
   sequence = 91
+  dependencies = ('loadCalendars',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -152,21 +199,21 @@ class loadLocations(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, description, owner_id, available_id, category, subcategory, source
         FROM location %s
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          x = frepple.location(name=i[0], description=i[1], category=i[4], subcategory=i[5], source=i[6])
-          if i[2]:
-            x.owner = frepple.location(name=i[2])
-          if i[3]:
-            x.available = frepple.calendar(name=i[3])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            x = frepple.location(name=i[0], description=i[1], category=i[4], subcategory=i[5], source=i[6])
+            if i[2]:
+              x.owner = frepple.location(name=i[2])
+            if i[3]:
+              x.available = frepple.calendar(name=i[3])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d locations in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -174,6 +221,7 @@ class loadLocations(LoadTask):
 class loadCalendars(LoadTask):
   description = "Importing calendars"
   sequence = 92
+  dependencies = ('loadParameter',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -189,7 +237,7 @@ class loadCalendars(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, defaultvalue, source, 0 hidden
         FROM calendar %s
@@ -198,13 +246,13 @@ class loadCalendars(LoadTask):
           name, 0, 'common_bucket', 1 hidden
         FROM common_bucket
         order by name asc
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          frepple.calendar(name=i[0], default=i[1], source=i[2], hidden=i[3])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            frepple.calendar(name=i[0], default=i[1], source=i[2], hidden=i[3])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d calendars in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -213,6 +261,7 @@ class loadCalendarBuckets(LoadTask):
 
   description = "Importing calendar buckets"
   sequence = 93
+  dependencies = ('loadCalendars',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -228,51 +277,51 @@ class loadCalendarBuckets(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      prevcal = None
+      with cls.query(cursor, '''
         SELECT
           calendar_id, startdate, enddate, priority, value,
           sunday, monday, tuesday, wednesday, thursday, friday, saturday,
           starttime, endtime, source
         FROM calendarbucket %s
         ORDER BY calendar_id, startdate desc
-        ''' % filter_where)
-      prevcal = None
-      for i in cursor:
-        cnt += 1
-        try:
-          days = 0
-          if i[5]:
-            days += 1
-          if i[6]:
-            days += 2
-          if i[7]:
-            days += 4
-          if i[8]:
-            days += 8
-          if i[9]:
-            days += 16
-          if i[10]:
-            days += 32
-          if i[11]:
-            days += 64
-          if i[0] != prevcal:
-            cal = frepple.calendar(name=i[0])
-            prevcal = i[0]
-          b = frepple.bucket(
-            calendar=cal,
-            start=i[1],
-            end=i[2] if i[2] else datetime(2030, 12, 31),
-            priority=i[3],
-            source=i[14],
-            value=i[4],
-            days=days
-            )
-          if i[12]:
-            b.starttime = i[12].hour * 3600 + i[12].minute * 60 + i[12].second
-          if i[13]:
-            b.endtime = i[13].hour * 3600 + i[13].minute * 60 + i[13].second + 1
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            days = 0
+            if i[5]:
+              days += 1
+            if i[6]:
+              days += 2
+            if i[7]:
+              days += 4
+            if i[8]:
+              days += 8
+            if i[9]:
+              days += 16
+            if i[10]:
+              days += 32
+            if i[11]:
+              days += 64
+            if i[0] != prevcal:
+              cal = frepple.calendar(name=i[0])
+              prevcal = i[0]
+            b = frepple.bucket(
+              calendar=cal,
+              start=i[1],
+              end=i[2] if i[2] else datetime(2030, 12, 31),
+              priority=i[3],
+              source=i[14],
+              value=i[4],
+              days=days
+              )
+            if i[12]:
+              b.starttime = i[12].hour * 3600 + i[12].minute * 60 + i[12].second
+            if i[13]:
+              b.endtime = i[13].hour * 3600 + i[13].minute * 60 + i[13].second + 1
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d calendar buckets in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -281,6 +330,7 @@ class loadCustomers(LoadTask):
 
   description = "Importing customers"
   sequence = 94
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -296,19 +346,19 @@ class loadCustomers(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, description, owner_id, category, subcategory, source
         FROM customer %s
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          x = frepple.customer(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
-          if i[2]:
-            x.owner = frepple.customer(name=i[2])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            x = frepple.customer(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
+            if i[2]:
+              x.owner = frepple.customer(name=i[2])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d customers in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -317,6 +367,7 @@ class loadSuppliers(LoadTask):
 
   description = "Importing suppliers"
   sequence = 95
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -332,19 +383,19 @@ class loadSuppliers(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, description, owner_id, category, subcategory, source
         FROM supplier %s
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          x = frepple.supplier(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
-          if i[2]:
-            x.owner = frepple.supplier(name=i[2])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            x = frepple.supplier(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
+            if i[2]:
+              x.owner = frepple.supplier(name=i[2])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d suppliers in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -353,6 +404,7 @@ class loadOperations(LoadTask):
 
   description = "Importing operations"
   sequence = 96
+  dependencies = ('loadLocations', 'loadItems', 'loadCalendars')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -427,73 +479,73 @@ class loadOperations(LoadTask):
 
     with connections[database].chunked_cursor() as cursor:
 
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, fence, posttime, sizeminimum, sizemultiple, sizemaximum,
           type, duration, duration_per, location_id, cost, search, description,
           category, subcategory, source, item_id, priority, effective_start,
           effective_end, available_id
         FROM operation %s
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          if not i[6] or i[6] == "fixed_time":
-            x = frepple.operation_fixed_time(
-              name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
-              )
-            if i[7]:
-              x.duration = i[7].total_seconds()
-          elif i[6] == "time_per":
-            x = frepple.operation_time_per(
-              name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
-              )
-            if i[7]:
-              x.duration = i[7].total_seconds()
-            if i[8]:
-              x.duration_per = i[8].total_seconds()
-          elif i[6] == "alternate":
-            x = frepple.operation_alternate(
-              name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
-              )
-          elif i[6] == "split":
-            x = frepple.operation_split(
-              name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
-              )
-          elif i[6] == "routing":
-            x = frepple.operation_routing(
-              name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
-              )
-          else:
-            raise ValueError("Operation type '%s' not recognized" % i[6])
-          if i[1]:
-            x.fence = i[1].total_seconds()
-          if i[2]:
-            x.posttime = i[2].total_seconds()
-          if i[3] is not None:
-            x.size_minimum = i[3]
-          if i[4]:
-            x.size_multiple = i[4]
-          if i[5]:
-            x.size_maximum = i[5]
-          if i[9]:
-            x.location = frepple.location(name=i[9])
-          if i[10]:
-            x.cost = i[10]
-          if i[11]:
-            x.search = i[11]
-          if i[16]:
-            x.item = frepple.item(name=i[16])
-          if i[17] is not None:
-            x.priority = i[17]
-          if i[18]:
-            x.effective_start = i[18]
-          if i[19]:
-            x.effective_end = i[19]
-          if i[20]:
-            x.available = frepple.calendar(name=i[20])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            if not i[6] or i[6] == "fixed_time":
+              x = frepple.operation_fixed_time(
+                name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
+                )
+              if i[7]:
+                x.duration = i[7].total_seconds()
+            elif i[6] == "time_per":
+              x = frepple.operation_time_per(
+                name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
+                )
+              if i[7]:
+                x.duration = i[7].total_seconds()
+              if i[8]:
+                x.duration_per = i[8].total_seconds()
+            elif i[6] == "alternate":
+              x = frepple.operation_alternate(
+                name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
+                )
+            elif i[6] == "split":
+              x = frepple.operation_split(
+                name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
+                )
+            elif i[6] == "routing":
+              x = frepple.operation_routing(
+                name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
+                )
+            else:
+              raise ValueError("Operation type '%s' not recognized" % i[6])
+            if i[1]:
+              x.fence = i[1].total_seconds()
+            if i[2]:
+              x.posttime = i[2].total_seconds()
+            if i[3] is not None:
+              x.size_minimum = i[3]
+            if i[4]:
+              x.size_multiple = i[4]
+            if i[5]:
+              x.size_maximum = i[5]
+            if i[9]:
+              x.location = frepple.location(name=i[9])
+            if i[10]:
+              x.cost = i[10]
+            if i[11]:
+              x.search = i[11]
+            if i[16]:
+              x.item = frepple.item(name=i[16])
+            if i[17] is not None:
+              x.priority = i[17]
+            if i[18]:
+              x.effective_start = i[18]
+            if i[19]:
+              x.effective_end = i[19]
+            if i[20]:
+              x.available = frepple.calendar(name=i[20])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d operations in %.2f seconds' % (cnt, time() - starttime))
 
 @PlanTaskRegistry.register
@@ -501,6 +553,7 @@ class loadSuboperations(LoadTask):
 
   description = "Importing suboperations"
   sequence = 97
+  dependencies = ('loadOperations',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -516,7 +569,8 @@ class loadSuboperations(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      curopername = None
+      with cls.query(cursor, '''
         SELECT operation_id, suboperation_id, priority, effective_start, effective_end,
           (SELECT type
            from operation
@@ -524,25 +578,24 @@ class loadSuboperations(LoadTask):
         FROM suboperation
         WHERE priority >= 0 %s
         ORDER BY operation_id, priority
-        ''' % filter_and)
-      curopername = None
-      for i in cursor:
-        cnt += 1
-        try:
-          if i[0] != curopername:
-            curopername = i[0]
-            curoper = frepple.operation(name=curopername)
-          sub = frepple.suboperation(
-            owner=curoper,
-            operation=frepple.operation(name=i[1]),
-            priority=i[2]
-            )
-          if i[3]:
-            sub.effective_start = i[3]
-          if i[4]:
-            sub.effective_end = i[4]
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_and) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            if i[0] != curopername:
+              curopername = i[0]
+              curoper = frepple.operation(name=curopername)
+            sub = frepple.suboperation(
+              owner=curoper,
+              operation=frepple.operation(name=i[1]),
+              priority=i[2]
+              )
+            if i[3]:
+              sub.effective_start = i[3]
+            if i[4]:
+              sub.effective_end = i[4]
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d suboperations in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -551,6 +604,7 @@ class loadItems(LoadTask):
 
   description = "Importing items"
   sequence = 98
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -571,26 +625,26 @@ class loadItems(LoadTask):
         attrsql = ', %s' % ', '.join(attrs)
       else:
         attrsql = ''
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, description, owner_id,
           cost, category, subcategory, source %s
         FROM item %s
-        ''' % (attrsql, filter_where))
-      for i in cursor:
-        cnt += 1
-        try:
-          x = frepple.item(name=i[0], description=i[1], category=i[4], subcategory=i[5], source=i[6])
-          if i[2]:
-            x.owner = frepple.item(name=i[2])
-          if i[3]:
-            x.cost = i[3]
-          idx = 7
-          for a in attrs:
-            setattr(x, a, i[idx])
-            idx += 1
-        except Exception as e:
-          print("Error:", e)
+        ''' % (attrsql, filter_where)) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            x = frepple.item(name=i[0], description=i[1], category=i[4], subcategory=i[5], source=i[6])
+            if i[2]:
+              x.owner = frepple.item(name=i[2])
+            if i[3]:
+              x.cost = i[3]
+            idx = 7
+            for a in attrs:
+              setattr(x, a, i[idx])
+              idx += 1
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d items in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -599,6 +653,7 @@ class loadItemSuppliers(LoadTask):
 
   description = "Importing item suppliers"
   sequence = 99
+  dependencies = ('loadSuppliers', 'loadItems', 'loadLocations', 'loadResources')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -614,49 +669,49 @@ class loadItemSuppliers(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      cursuppliername = None
+      curitemname = None
+      with cls.query(cursor, '''
         SELECT
           supplier_id, item_id, location_id, sizeminimum, sizemultiple,
           cost, priority, effective_start, effective_end, source, leadtime,
           resource_id, resource_qty, fence
         FROM itemsupplier %s
         ORDER BY supplier_id, item_id, location_id, priority desc
-        ''' % filter_where)
-      cursuppliername = None
-      curitemname = None
-      for i in cursor:
-        cnt += 1
-        try:
-          if i[0] != cursuppliername:
-            cursuppliername = i[0]
-            cursupplier = frepple.supplier(name=cursuppliername)
-          if i[1] != curitemname:
-            curitemname = i[1]
-            curitem = frepple.item(name=curitemname)
-          curitemsupplier = frepple.itemsupplier(
-            supplier=cursupplier, item=curitem, source=i[9],
-            leadtime=i[10].total_seconds() if i[10] else 0,
-            fence=i[13].total_seconds() if i[13] else 0,
-            resource_qty=i[12]
-            )
-          if i[2]:
-            curitemsupplier.location = frepple.location(name=i[2])
-          if i[3]:
-            curitemsupplier.size_minimum = i[3]
-          if i[4]:
-            curitemsupplier.size_multiple = i[4]
-          if i[5]:
-            curitemsupplier.cost = i[5]
-          if i[6]:
-            curitemsupplier.priority = i[6]
-          if i[7]:
-            curitemsupplier.effective_start = i[7]
-          if i[8]:
-            curitemsupplier.effective_end = i[8]
-          if i[11]:
-            curitemsupplier.resource = frepple.resource(name=i[11])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            if i[0] != cursuppliername:
+              cursuppliername = i[0]
+              cursupplier = frepple.supplier(name=cursuppliername)
+            if i[1] != curitemname:
+              curitemname = i[1]
+              curitem = frepple.item(name=curitemname)
+            curitemsupplier = frepple.itemsupplier(
+              supplier=cursupplier, item=curitem, source=i[9],
+              leadtime=i[10].total_seconds() if i[10] else 0,
+              fence=i[13].total_seconds() if i[13] else 0,
+              resource_qty=i[12]
+              )
+            if i[2]:
+              curitemsupplier.location = frepple.location(name=i[2])
+            if i[3]:
+              curitemsupplier.size_minimum = i[3]
+            if i[4]:
+              curitemsupplier.size_multiple = i[4]
+            if i[5]:
+              curitemsupplier.cost = i[5]
+            if i[6]:
+              curitemsupplier.priority = i[6]
+            if i[7]:
+              curitemsupplier.effective_start = i[7]
+            if i[8]:
+              curitemsupplier.effective_end = i[8]
+            if i[11]:
+              curitemsupplier.resource = frepple.resource(name=i[11])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d item suppliers in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -665,6 +720,7 @@ class loadItemDistributions(LoadTask):
 
   description = "Importing item distributions"
   sequence = 100
+  dependencies = ('loadItems', 'loadLocations', 'loadResources')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -680,49 +736,49 @@ class loadItemDistributions(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      curoriginname = None
+      curitemname = None
+      with cls.query(cursor, '''
         SELECT
           origin_id, item_id, location_id, sizeminimum, sizemultiple,
           cost, priority, effective_start, effective_end, source,
           leadtime, resource_id, resource_qty, fence
         FROM itemdistribution %s
         ORDER BY origin_id, item_id, location_id, priority desc
-        ''' % filter_where)
-      curoriginname = None
-      curitemname = None
-      for i in cursor:
-        cnt += 1
-        try:
-          if i[0] != curoriginname:
-            curoriginname = i[0]
-            curorigin = frepple.location(name=curoriginname)
-          if i[1] != curitemname:
-            curitemname = i[1]
-            curitem = frepple.item(name=curitemname)
-          curitemdistribution = frepple.itemdistribution(
-            origin=curorigin, item=curitem, source=i[9],
-            leadtime=i[10].total_seconds() if i[10] else 0,
-            fence=i[13].total_seconds() if i[13] else 0,
-            resource_qty=i[12]
-            )
-          if i[2]:
-            curitemdistribution.destination = frepple.location(name=i[2])
-          if i[3]:
-            curitemdistribution.size_minimum = i[3]
-          if i[4]:
-            curitemdistribution.size_multiple = i[4]
-          if i[5]:
-            curitemdistribution.cost = i[5]
-          if i[6]:
-            curitemdistribution.priority = i[6]
-          if i[7]:
-            curitemdistribution.effective_start = i[7]
-          if i[8]:
-            curitemdistribution.effective_end = i[8]
-          if i[11]:
-            curitemdistribution.resource = frepple.resource(name=i[11])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            if i[0] != curoriginname:
+              curoriginname = i[0]
+              curorigin = frepple.location(name=curoriginname)
+            if i[1] != curitemname:
+              curitemname = i[1]
+              curitem = frepple.item(name=curitemname)
+            curitemdistribution = frepple.itemdistribution(
+              origin=curorigin, item=curitem, source=i[9],
+              leadtime=i[10].total_seconds() if i[10] else 0,
+              fence=i[13].total_seconds() if i[13] else 0,
+              resource_qty=i[12]
+              )
+            if i[2]:
+              curitemdistribution.destination = frepple.location(name=i[2])
+            if i[3]:
+              curitemdistribution.size_minimum = i[3]
+            if i[4]:
+              curitemdistribution.size_multiple = i[4]
+            if i[5]:
+              curitemdistribution.cost = i[5]
+            if i[6]:
+              curitemdistribution.priority = i[6]
+            if i[7]:
+              curitemdistribution.effective_start = i[7]
+            if i[8]:
+              curitemdistribution.effective_end = i[8]
+            if i[11]:
+              curitemdistribution.resource = frepple.resource(name=i[11])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d item distributions in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -731,6 +787,7 @@ class loadBuffers(LoadTask):
 
   description = "Importing buffers"
   sequence = 101
+  dependencies = ('loadLocations', 'loadItems', 'loadCalendars')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -746,36 +803,36 @@ class loadBuffers(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT name, description, location_id, item_id, onhand,
           minimum, minimum_calendar_id, type,
           min_interval, category, subcategory, source
         FROM buffer %s
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        if i[7] == "infinite":
-          b = frepple.buffer_infinite(
-            name=i[0], description=i[1], location=frepple.location(name=i[2]),
-            item=frepple.item(name=i[3]), onhand=max(i[4] or 0, 0),
-            category=i[9], subcategory=i[10], source=i[11]
-            )
-        elif not i[7] or i[7] == "default":
-          b = frepple.buffer(
-            name=i[0], description=i[1], location=frepple.location(name=i[2]),
-            item=frepple.item(name=i[3]), onhand=max(i[4] or 0, 0),
-            category=i[9], subcategory=i[10], source=i[11]
-            )
-          if i[8]:
-            b.mininterval = i[8].total_seconds()
-        else:
-          raise ValueError("Buffer type '%s' not recognized" % i[7])
-        if i[10] == 'tool':
-          b.tool = True
-        if i[5]:
-          b.minimum = i[5]
-        if i[6]:
-          b.minimum_calendar = frepple.calendar(name=i[6])
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          if i[7] == "infinite":
+            b = frepple.buffer_infinite(
+              name=i[0], description=i[1], location=frepple.location(name=i[2]),
+              item=frepple.item(name=i[3]), onhand=max(i[4] or 0, 0),
+              category=i[9], subcategory=i[10], source=i[11]
+              )
+          elif not i[7] or i[7] == "default":
+            b = frepple.buffer(
+              name=i[0], description=i[1], location=frepple.location(name=i[2]),
+              item=frepple.item(name=i[3]), onhand=max(i[4] or 0, 0),
+              category=i[9], subcategory=i[10], source=i[11]
+              )
+            if i[8]:
+              b.mininterval = i[8].total_seconds()
+          else:
+            raise ValueError("Buffer type '%s' not recognized" % i[7])
+          if i[10] == 'tool':
+            b.tool = True
+          if i[5]:
+            b.minimum = i[5]
+          if i[6]:
+            b.minimum_calendar = frepple.calendar(name=i[6])
       print('Loaded %d buffers in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -784,6 +841,7 @@ class loadSetupMatrices(LoadTask):
 
   description = "Importing setup matrix rules"
   sequence = 102
+  dependencies = ()
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -799,26 +857,26 @@ class loadSetupMatrices(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           setupmatrix_id, priority, fromsetup, tosetup, duration, cost, source
         FROM setuprule %s
         ORDER BY setupmatrix_id, priority DESC
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          r = frepple.setupmatrix(name=i[0], source=i[6]).addRule(priority=i[1])
-          if i[2]:
-            r.fromsetup = i[2]
-          if i[3]:
-            r.tosetup = i[3]
-          if i[4]:
-            r.duration = i[4].total_seconds()
-          if i[5]:
-            r.cost = i[5]
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            r = frepple.setupmatrix(name=i[0], source=i[6]).addRule(priority=i[1])
+            if i[2]:
+              r.fromsetup = i[2]
+            if i[3]:
+              r.tosetup = i[3]
+            if i[4]:
+              r.duration = i[4].total_seconds()
+            if i[5]:
+              r.cost = i[5]
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d setup matrix rules in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -827,6 +885,7 @@ class loadResources(LoadTask):
 
   description = "Importing resources"
   sequence = 103
+  dependencies = ('loadCalendars', 'loadLocations', 'loadSetupMatrices')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -843,55 +902,55 @@ class loadResources(LoadTask):
       cnt = 0
       starttime = time()
       Resource.rebuildHierarchy(database=database)
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, description, maximum, maximum_calendar_id, location_id, type,
           cost, maxearly, setup, setupmatrix_id, category, subcategory,
           owner_id, source, available_id
         FROM %s %s
         ORDER BY lvl ASC, name
-        ''' % (connections[cursor.db.alias].ops.quote_name('resource'), filter_where) )
-      for i in cursor:
-        cnt += 1
-        try:
-          if i[5] == "infinite":
-            x = frepple.resource_infinite(
-              name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
-              )
-          elif i[5] == "buckets":
-            x = frepple.resource_buckets(
-              name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
-              )
-            if i[3]:
-              x.maximum_calendar = frepple.calendar(name=i[3])
-            if i[7] is not None:
-              x.maxearly = i[7]
-          elif not i[5] or i[5] == "default":
-            x = frepple.resource_default(
-              name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
-              )
-            if i[3]:
-              x.maximum_calendar = frepple.calendar(name=i[3])
-            if i[7] is not None:
-              x.maxearly = i[7].total_seconds()
-            if i[2] is not None:
-              x.maximum = i[2]
-          else:
-            raise ValueError("Resource type '%s' not recognized" % i[5])
-          if i[4]:
-            x.location = frepple.location(name=i[4])
-          if i[6]:
-            x.cost = i[6]
-          if i[8]:
-            x.setup = i[8]
-          if i[9]:
-            x.setupmatrix = frepple.setupmatrix(name=i[9])
-          if i[12]:
-            x.owner = frepple.resource(name=i[12])
-          if i[14]:
-            x.available = frepple.calendar(name=i[14])
-        except Exception as e:
-          print("Error:", e)
+        ''' % (connections[cursor.db.alias].ops.quote_name('resource'), filter_where) ) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            if i[5] == "infinite":
+              x = frepple.resource_infinite(
+                name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
+                )
+            elif i[5] == "buckets":
+              x = frepple.resource_buckets(
+                name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
+                )
+              if i[3]:
+                x.maximum_calendar = frepple.calendar(name=i[3])
+              if i[7] is not None:
+                x.maxearly = i[7]
+            elif not i[5] or i[5] == "default":
+              x = frepple.resource_default(
+                name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
+                )
+              if i[3]:
+                x.maximum_calendar = frepple.calendar(name=i[3])
+              if i[7] is not None:
+                x.maxearly = i[7].total_seconds()
+              if i[2] is not None:
+                x.maximum = i[2]
+            else:
+              raise ValueError("Resource type '%s' not recognized" % i[5])
+            if i[4]:
+              x.location = frepple.location(name=i[4])
+            if i[6]:
+              x.cost = i[6]
+            if i[8]:
+              x.setup = i[8]
+            if i[9]:
+              x.setupmatrix = frepple.setupmatrix(name=i[9])
+            if i[12]:
+              x.owner = frepple.resource(name=i[12])
+            if i[14]:
+              x.available = frepple.calendar(name=i[14])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d resources in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -900,6 +959,7 @@ class loadResourceSkills(LoadTask):
 
   description = "Importing resources skills"
   sequence = 104
+  dependencies = ('loadResources',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -915,25 +975,25 @@ class loadResourceSkills(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           resource_id, skill_id, effective_start, effective_end, priority, source
         FROM resourceskill %s
         ORDER BY skill_id, priority, resource_id
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          cur = frepple.resourceskill(
-            resource=frepple.resource(name=i[0]), skill=frepple.skill(name=i[1]),
-            priority=i[4] or 1, source=i[5]
-            )
-          if i[2]:
-            cur.effective_start = i[2]
-          if i[3]:
-            cur.effective_end = i[3]
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            cur = frepple.resourceskill(
+              resource=frepple.resource(name=i[0]), skill=frepple.skill(name=i[1]),
+              priority=i[4] or 1, source=i[5]
+              )
+            if i[2]:
+              cur.effective_start = i[2]
+            if i[3]:
+              cur.effective_end = i[3]
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d resource skills in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -942,6 +1002,7 @@ class loadOperationMaterials(LoadTask):
 
   description = "Importing operation materials"
   sequence = 105
+  dependencies = ('loadOperations', 'loadSuboperations', 'loadItems', 'loadBuffers', 'loadItemSuppliers', 'loadItemDistributions')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -959,35 +1020,35 @@ class loadOperationMaterials(LoadTask):
       starttime = time()
       # Note: The sorting of the flows is not really necessary, but helps to make
       # the planning progress consistent across runs and database engines.
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           operation_id, item_id, quantity, type, effective_start,
           effective_end, name, priority, search, source
         FROM operationmaterial %s
         ORDER BY operation_id, item_id
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          curflow = frepple.flow(
-            operation=frepple.operation(name=i[0]),
-            item=frepple.item(name=i[1]),
-            quantity=i[2],
-            type="flow_%s" % i[3],
-            source=i[9]
-            )
-          if i[4]:
-            curflow.effective_start = i[4]
-          if i[5]:
-            curflow.effective_end = i[5]
-          if i[6]:
-            curflow.name = i[6]
-          if i[7]:
-            curflow.priority = i[7]
-          if i[8]:
-            curflow.search = i[8]
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            curflow = frepple.flow(
+              operation=frepple.operation(name=i[0]),
+              item=frepple.item(name=i[1]),
+              quantity=i[2],
+              type="flow_%s" % i[3],
+              source=i[9]
+              )
+            if i[4]:
+              curflow.effective_start = i[4]
+            if i[5]:
+              curflow.effective_end = i[5]
+            if i[6]:
+              curflow.name = i[6]
+            if i[7]:
+              curflow.priority = i[7]
+            if i[8]:
+              curflow.search = i[8]
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d operation materials in %.2f seconds' % (cnt, time() - starttime))
 
       # Check for operations where:
@@ -997,21 +1058,23 @@ class loadOperationMaterials(LoadTask):
       starttime = time()
       cnt = 0
       print('Auto-update operation items...')
-      for oper in frepple.operations():
-        if oper.hidden or oper.item or oper.hasSuperOperations:
-          continue
-        item = None
-        for fl in oper.flows:
-          if fl.quantity < 0 or fl.hidden:
+      # Other tasks can be updating the model in parallel
+      with PlanTaskRegistry.lock:
+        for oper in frepple.operations():
+          if oper.hidden or oper.item or oper.hasSuperOperations:
             continue
-          if item and item != fl.item:
-            item = None
-            break
-          else:
-            item = fl.item
-        if item:
-          cnt += 1
-          oper.item = item
+          item = None
+          for fl in oper.flows:
+            if fl.quantity < 0 or fl.hidden:
+              continue
+            if item and item != fl.item:
+              item = None
+              break
+            else:
+              item = fl.item
+          if item:
+            cnt += 1
+            oper.item = item
       print('Auto-update of %s operation items in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -1020,6 +1083,7 @@ class loadOperationResources(LoadTask):
 
   description = "Importing operation resources"
   sequence = 106
+  dependencies = ('loadOperations', 'loadSuboperations', 'loadResources', 'loadResourceSkills')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1037,38 +1101,38 @@ class loadOperationResources(LoadTask):
       starttime = time()
       # Note: The sorting of the loads is not really necessary, but helps to make
       # the planning progress consistent across runs and database engines.
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           operation_id, resource_id, quantity, effective_start, effective_end, name,
           priority, setup, search, skill_id, source
         FROM operationresource %s
         ORDER BY operation_id, resource_id
-        ''' % filter_where)
-      for i in cursor:
-        cnt += 1
-        try:
-          curload = frepple.load(
-            operation=frepple.operation(name=i[0]),
-            resource=frepple.resource(name=i[1]),
-            quantity=i[2],
-            source=i[10]
-            )
-          if i[3]:
-            curload.effective_start = i[3]
-          if i[4]:
-            curload.effective_end = i[4]
-          if i[5]:
-            curload.name = i[5]
-          if i[6]:
-            curload.priority = i[6]
-          if i[7]:
-            curload.setup = i[7]
-          if i[8]:
-            curload.search = i[8]
-          if i[9]:
-            curload.skill = frepple.skill(name=i[9])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_where) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            curload = frepple.load(
+              operation=frepple.operation(name=i[0]),
+              resource=frepple.resource(name=i[1]),
+              quantity=i[2],
+              source=i[10]
+              )
+            if i[3]:
+              curload.effective_start = i[3]
+            if i[4]:
+              curload.effective_end = i[4]
+            if i[5]:
+              curload.name = i[5]
+            if i[6]:
+              curload.priority = i[6]
+            if i[7]:
+              curload.setup = i[7]
+            if i[8]:
+              curload.search = i[8]
+            if i[9]:
+              curload.skill = frepple.skill(name=i[9])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d resource loads in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -1077,6 +1141,7 @@ class loadDemand(LoadTask):
 
   description = "Importing demands"
   sequence = 107
+  dependencies = ('loadItems', 'loadOperations', 'loadCustomers', 'loadLocations')
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1092,36 +1157,36 @@ class loadDemand(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           name, due, quantity, priority, item_id,
           operation_id, customer_id, owner_id, minshipment, maxlateness,
           category, subcategory, source, location_id, status
         FROM demand
         WHERE (status IS NULL OR status ='open' OR status = 'quote') %s
-        ''' % filter_and)
-      for i in cursor:
-        cnt += 1
-        try:
-          x = frepple.demand(
-            name=i[0], due=i[1], quantity=i[2], priority=i[3], status=i[14],
-            item=frepple.item(name=i[4]), category=i[10], subcategory=i[11],
-            source=i[12]
-            )
-          if i[5]:
-            x.operation = frepple.operation(name=i[5])
-          if i[6]:
-            x.customer = frepple.customer(name=i[6])
-          if i[7]:
-            x.owner = frepple.demand(name=i[7])
-          if i[8] is not None:
-            x.minshipment = i[8]
-          if i[9] is not None:
-            x.maxlateness = i[9].total_seconds()
-          if i[13]:
-            x.location = frepple.location(name=i[13])
-        except Exception as e:
-          print("Error:", e)
+        ''' % filter_and) as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            x = frepple.demand(
+              name=i[0], due=i[1], quantity=i[2], priority=i[3], status=i[14],
+              item=frepple.item(name=i[4]), category=i[10], subcategory=i[11],
+              source=i[12]
+              )
+            if i[5]:
+              x.operation = frepple.operation(name=i[5])
+            if i[6]:
+              x.customer = frepple.customer(name=i[6])
+            if i[7]:
+              x.owner = frepple.demand(name=i[7])
+            if i[8] is not None:
+              x.minshipment = i[8]
+            if i[9] is not None:
+              x.maxlateness = i[9].total_seconds()
+            if i[13]:
+              x.location = frepple.location(name=i[13])
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d demands in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -1152,7 +1217,7 @@ class loadOperationPlans(LoadTask):   # TODO if we are going to replan anyway, w
       cnt_do = 0
       cnt_dlvr = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           operationplan.operation_id, operationplan.id, operationplan.quantity,
           operationplan.startdate, operationplan.enddate, operationplan.status, operationplan.source,
@@ -1169,57 +1234,57 @@ class loadOperationPlans(LoadTask):   # TODO if we are going to replan anyway, w
           and operationplan.quantity >= 0 and operationplan.status <> 'closed'
           %s%s and operationplan.type in ('PO', 'MO', 'DO', 'DLVR')
         ORDER BY operationplan.id ASC
-        ''' % (filter_and, confirmed_filter))
-      for i in cursor:
-        try:
-          if i[7] == 'MO':
-            cnt_mo += 1
-            opplan = frepple.operationplan(
-              operation=frepple.operation(name=i[0]), id=i[1],
-              quantity=i[2], source=i[6], start=i[3], end=i[4],
-              status=i[5], reference=i[13], create=i[15]
-              )
-          elif i[7] == 'PO':
-            cnt_po += 1
-            opplan = frepple.operationplan(
-              location=frepple.location(name=i[12]), ordertype=i[7],
-              id=i[1], reference=i[13],
-              item=frepple.item(name=i[11]) if i[11] else None,
-              supplier=frepple.supplier(name=i[10]) if i[10] else None,
-              quantity=i[2], start=i[3], end=i[4],
-              status=i[5], source=i[6], create=i[15]
-              )
-          elif i[7] == 'DO':
-            cnt_do += 1
-            opplan = frepple.operationplan(
-              location=frepple.location(name=i[9]) if i[9] else None,
-              id=i[1], reference=i[13], ordertype=i[7],
-              item=frepple.item(name=i[11]) if i[11] else None,
-              origin=frepple.location(name=i[8]) if i[8] else None,
-              quantity=i[2], start=i[3], end=i[4],
-              status=i[5], source=i[6], create=i[15]
-              )
-          elif i[7] == 'DLVR':
-            cnt_dlvr += 1
-            opplan = frepple.operationplan(
-              location=frepple.location(name=i[12]) if i[12] else None,
-              id=i[1], reference=i[13], ordertype=i[7],
-              item=frepple.item(name=i[11]) if i[11] else None,
-              origin=frepple.location(name=i[8]) if i[8] else None,
-              demand=frepple.demand(name=i[14]) if i[14] else None,
-              quantity=i[2], start=i[3], end=i[4],
-              status=i[5], source=i[6], create=i[15]
-              )
-            opplan = None
-          else:
-            print("Warning: unhandled operationplan type '%s'" % i[7])
-            continue
-          if i[14] and opplan:
-            opplan.demand = frepple.demand(name=i[14])
-        except Exception as e:
-          print("Error:", e)
+        ''' % (filter_and, confirmed_filter)) as rows:
+        for i in rows:
+          try:
+            if i[7] == 'MO':
+              cnt_mo += 1
+              opplan = frepple.operationplan(
+                operation=frepple.operation(name=i[0]), id=i[1],
+                quantity=i[2], source=i[6], start=i[3], end=i[4],
+                status=i[5], reference=i[13], create=i[15]
+                )
+            elif i[7] == 'PO':
+              cnt_po += 1
+              opplan = frepple.operationplan(
+                location=frepple.location(name=i[12]), ordertype=i[7],
+                id=i[1], reference=i[13],
+                item=frepple.item(name=i[11]) if i[11] else None,
+                supplier=frepple.supplier(name=i[10]) if i[10] else None,
+                quantity=i[2], start=i[3], end=i[4],
+                status=i[5], source=i[6], create=i[15]
+                )
+            elif i[7] == 'DO':
+              cnt_do += 1
+              opplan = frepple.operationplan(
+                location=frepple.location(name=i[9]) if i[9] else None,
+                id=i[1], reference=i[13], ordertype=i[7],
+                item=frepple.item(name=i[11]) if i[11] else None,
+                origin=frepple.location(name=i[8]) if i[8] else None,
+                quantity=i[2], start=i[3], end=i[4],
+                status=i[5], source=i[6], create=i[15]
+                )
+            elif i[7] == 'DLVR':
+              cnt_dlvr += 1
+              opplan = frepple.operationplan(
+                location=frepple.location(name=i[12]) if i[12] else None,
+                id=i[1], reference=i[13], ordertype=i[7],
+                item=frepple.item(name=i[11]) if i[11] else None,
+                origin=frepple.location(name=i[8]) if i[8] else None,
+                demand=frepple.demand(name=i[14]) if i[14] else None,
+                quantity=i[2], start=i[3], end=i[4],
+                status=i[5], source=i[6], create=i[15]
+                )
+              opplan = None
+            else:
+              print("Warning: unhandled operationplan type '%s'" % i[7])
+              continue
+            if i[14] and opplan:
+              opplan.demand = frepple.demand(name=i[14])
+          except Exception as e:
+            print("Error:", e)
     with connections[database].chunked_cursor() as cursor:
-      cursor.execute('''
+      with cls.query(cursor, '''
         SELECT
           operationplan.operation_id, operationplan.id, operationplan.quantity,
           operationplan.startdate, operationplan.enddate, operationplan.status,
@@ -1236,21 +1301,21 @@ class loadOperationPlans(LoadTask):   # TODO if we are going to replan anyway, w
         WHERE operationplan.quantity >= 0 and operationplan.status <> 'closed'
           %s%s and operationplan.type = 'MO'
         ORDER BY operationplan.id ASC
-        ''' % (filter_and, confirmed_filter))
-      for i in cursor:
-        cnt_mo += 1
-        opplan = frepple.operationplan(
-          operation=frepple.operation(name=i[0]),
-          id=i[1], quantity=i[2], source=i[7],
-          start=i[3], end=i[4], status=i[5]
-          )
-        if i[6] and opplan:
-          try:
-            opplan.owner = frepple.operationplan(id=i[6])
-          except:
-            pass        
-        if i[8] and opplan:
-          opplan.demand = frepple.demand(name=i[8])
+        ''' % (filter_and, confirmed_filter)) as rows:
+        for i in rows:
+          cnt_mo += 1
+          opplan = frepple.operationplan(
+            operation=frepple.operation(name=i[0]),
+            id=i[1], quantity=i[2], source=i[7],
+            start=i[3], end=i[4], status=i[5]
+            )
+          if i[6] and opplan:
+            try:
+              opplan.owner = frepple.operationplan(id=i[6])
+            except:
+              pass        
+          if i[8] and opplan:
+            opplan.demand = frepple.demand(name=i[8])
       print('Loaded %d manufacturing orders, %d purchase orders, %d distribution orders and %s deliveries in %.2f seconds' % (cnt_mo, cnt_po, cnt_do, cnt_dlvr, time() - starttime))
 
     with connections[database].cursor() as cursor:
@@ -1270,6 +1335,7 @@ class loadOperationPlanMaterials(LoadTask):
 
   description = "Importing operationplanmaterials"
   sequence = 109
+  dependencies = ('loadOperationPlans',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1278,28 +1344,28 @@ class loadOperationPlanMaterials(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         select
           quantity, flowdate, operationplan_id, item_id, location_id, status
         from operationplanmaterial
         where status <> 'proposed'
-      ''')
-      for i in cursor:
-        cnt += 1
-        try:
-          opplan = frepple.operationplan(id=i[2])
-          if opplan.status not in ("confirmed", "approved"):
-            pass
-          for fl in opplan.flowplans:
-            if fl.buffer.item and fl.buffer.item.name == i[3] \
-              and fl.buffer.location and fl.buffer.location.name == i[4]:
-                fl.status = "confirmed"
-                if i[1]:
-                  fl.date = i[1]
-                fl.quantity = i[0]
-                break
-        except Exception as e:
-          print("Error:", e)
+      ''') as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            opplan = frepple.operationplan(id=i[2])
+            if opplan.status not in ("confirmed", "approved"):
+              pass
+            for fl in opplan.flowplans:
+              if fl.buffer.item and fl.buffer.item.name == i[3] \
+                and fl.buffer.location and fl.buffer.location.name == i[4]:
+                  fl.status = "confirmed"
+                  if i[1]:
+                    fl.date = i[1]
+                  fl.quantity = i[0]
+                  break
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d operationplanmaterials in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -1308,6 +1374,7 @@ class loadOperationPlanResources(LoadTask):
 
   description = "Importing operationplanresources"
   sequence = 110
+  dependencies = ('loadOperationPlans',)
 
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
@@ -1316,23 +1383,23 @@ class loadOperationPlanResources(LoadTask):
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
       starttime = time()
-      cursor.execute('''
+      with cls.query(cursor, '''
         select resource_id, quantity, operationplan_id
         from operationplanresource
         where status <> 'proposed'
-      ''')
-      for i in cursor:
-        cnt += 1
-        try:
-          opplan = frepple.operationplan(id=i[2])
-          if opplan.status not in ("confirmed", "approved"):
-            pass
-          for lo in opplan.loadplans:
-            if lo.resource.name == i[0]:
-              lo.status = "confirmed"
-              lo.quantity = i[1]
-        except Exception as e:
-          print("Error:", e)
+      ''') as rows:
+        for i in rows:
+          cnt += 1
+          try:
+            opplan = frepple.operationplan(id=i[2])
+            if opplan.status not in ("confirmed", "approved"):
+              pass
+            for lo in opplan.loadplans:
+              if lo.resource.name == i[0]:
+                lo.status = "confirmed"
+                lo.quantity = i[1]
+          except Exception as e:
+            print("Error:", e)
       print('Loaded %d operationplanresources in %.2f seconds' % (cnt, time() - starttime))
 
 
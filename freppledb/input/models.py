@@ -1278,6 +1278,7 @@ class OperationPlanMaterial(AuditModel):
   class Meta:
     db_table = 'operationplanmaterial'
     ordering = ['item', 'location', 'flowdate']
+    index_together = [['item', 'location', 'flowdate']]
     verbose_name = _('operationplan material')
     verbose_name_plural = _('operationplan materials')
 
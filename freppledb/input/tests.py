@@ -14,11 +14,12 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import json
 import tempfile
 
 from django.test import TestCase
 
-from freppledb.input.models import Location
+from freppledb.input.models import Location, OperationPlan
 
 
 class DataLoadTest(TestCase):
@@ -78,3 +79,55 @@ class DataLoadTest(TestCase):
       [(i.name, i.category or u'') for i in Location.objects.order_by('name')],
       [(u'All locations', u''), (u'factory 1', u''), (u'factory 2', u''), (u'factory 3', u'cat1'), (u'factory 4', u'')]  # Test result is different in Enterprise Edition
       )
+
+  def test_operationplan_detail(self):
+    ids = [ i.id for i in OperationPlan.objects.all().order_by('id')[:5] ]
+    response = self.client.get(
+      '/operationplan/', {'id': ids}, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+      )
+    self.assertEqual(response.status_code, 200)
+    data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+    self.assertEqual(sorted([ i['id'] for i in data ]), ids)
+
+  def test_operationplan_update(self):
+    opplans = list(OperationPlan.objects.all().order_by('id')[:2])
+    response = self.client.post(
+      '/operationplan/',
+      json.dumps([
+        {'id': opplans[0].id, 'quantity': 123, 'reference': 'upd'},
+        {'id': opplans[1].id},
+        {'id': 999999, 'quantity': 1}
+        ]),
+      content_type='application/json',
+      HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+      )
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(
+      [ (i['id'], i['status']) for i in json.loads(response.content.decode('utf-8')) ],
+      [(opplans[0].id, 'ok'), (opplans[1].id, 'unchanged'), (999999, 'error')]
+      )
+    opplan = OperationPlan.objects.get(id=opplans[0].id)
+    self.assertEqual((opplan.quantity, opplan.reference), (123, 'upd'))
+    self.assertEqual(opplan.startdate, opplans[0].startdate)
+
+  def test_hierarchy_update(self):
+    # A rebuild leaves free numbers for new records
+    Location.objects.update(lft=None)
+    Location.rebuildHierarchy()
+
+    def contains(parent, child):
+      parent = Location.objects.get(name=parent)
+      child = Location.objects.get(name=child)
+      return parent.lft < child.lft and child.rght < parent.rght and child.lvl == parent.lvl + 1
+
+    # Insert a new location
+    Location(name='factory 3', owner=Location.objects.get(name='factory 1')).save()
+    self.assertTrue(contains('factory 1', 'factory 3'))
+    # Move a location with the locations below it
+    loc = Location.objects.get(name='factory 1')
+    loc.owner = Location.objects.get(name='factory 2')
+    loc.save()
+    self.assertTrue(contains('factory 2', 'factory 1'))
+    self.assertTrue(contains('factory 1', 'factory 3'))
+    # Nothing was left for a rebuild
+    self.assertFalse(Location.objects.filter(lft__isnull=True).exists())
@@ -20,6 +20,7 @@ import json
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections, transaction
 from django.db.models import Q
 from django.db.models.fields import CharField
 from django.http import HttpResponse, Http404
@@ -41,6 +42,7 @@ from freppledb.input.models import Calendar, CalendarBucket, ManufacturingOrder,
 from freppledb.input.models import ResourceSkill, Supplier, ItemSupplier, searchmode
 from freppledb.input.models import ItemDistribution, DistributionOrder, PurchaseOrder
 from freppledb.input.models import OperationPlan, OperationPlanMaterial, OperationPlanResource
+from freppledb.output.models import Pegging
 from freppledb.common.report import GridReport, GridFieldBool, GridFieldLastModified
 from freppledb.common.report import GridFieldDateTime, GridFieldTime, GridFieldText
 from freppledb.common.report import GridFieldNumber, GridFieldInteger, GridFieldCurrency
@@ -1136,6 +1138,7 @@ class ManufacturingOrderList(GridReport):
   basequeryset = ManufacturingOrder.objects.all()
   default_sort = (2, 'desc')
   model = ManufacturingOrder
+  estimateCount = True
   frozenColumns = 2
   multiselect = True
   editable = True
@@ -1162,7 +1165,7 @@ class ManufacturingOrderList(GridReport):
     if args and args[0]:
       q = q.filter(location=args[0])
     return q.extra(select={
-      'demand': "(select string_agg(value || ' : ' || key, ', ') from (select key, value from jsonb_each_text(operationplan.plan->'pegging') order by key desc limit 10) peg)"
+      'demand': Pegging.demands('operationplan.id', limit=10)
     })
 
 
@@ -1256,6 +1259,7 @@ class DistributionOrderList(GridReport):
   default_sort = (2, 'desc')
   basequeryset = DistributionOrder.objects.all()
   model = DistributionOrder
+  estimateCount = True
   frozenColumns = 2
   multiselect = True
   editable = True
@@ -1298,7 +1302,7 @@ class DistributionOrderList(GridReport):
       else:
         q = q.filter(location=args[0])
     return q.extra(select={
-      'demand': "(select string_agg(value || ' : ' || key, ', ') from (select key, value from jsonb_each_text(operationplan.plan->'pegging') order by key desc limit 10) peg)",
+      'demand': Pegging.demands('operationplan.id', limit=10),
       'total_cost': "cost*quantity"
       })
 
@@ -1427,6 +1431,7 @@ class PurchaseOrderList(GridReport):
   title = _("purchase orders")
   basequeryset = PurchaseOrder.objects.all()
   model = PurchaseOrder
+  estimateCount = True
   default_sort = (2, 'desc')
   frozenColumns = 2
   multiselect = True
@@ -1467,7 +1472,7 @@ class PurchaseOrderList(GridReport):
         q = q.filter(location=args[0])
     return q.extra(
       select={
-        'demand': "coalesce((select string_agg(value || ' : ' || key, ', ') from (select key, value from jsonb_each_text(operationplan.plan->'pegging') order by key desc limit 10) peg), '')",
+        'demand': "coalesce(%s, '')" % Pegging.demands('operationplan.id', limit=10),
         'total_cost': "coalesce((select max(cost) from itemsupplier where itemsupplier.item_id = operationplan.item_id and itemsupplier.location_id = operationplan.location_id and itemsupplier.supplier_id = operationplan.supplier_id), (select cost from item where item.name = operationplan.item_id)) * quantity",
         'unit_cost': "coalesce((select max(cost) from itemsupplier where itemsupplier.item_id = operationplan.item_id and itemsupplier.location_id = operationplan.location_id and itemsupplier.supplier_id = operationplan.supplier_id), (select cost from item where item.name = operationplan.item_id))"
       })
@@ -1593,15 +1598,7 @@ class OperationPlanDetail(View):
     first = True
     if not ids:
       yield "[]"
-      raise StopIteration
-    try:
-      opplans = [ x for x in OperationPlan.objects.all().using(request.database).filter(id__in=ids).select_related("operation") ]
-      opplanmats = [ x for x in OperationPlanMaterial.objects.all().using(request.database).filter(operationplan__id__in=ids).values() ]
-      opplanrscs = [ x for x in OperationPlanResource.objects.all().using(request.database).filter(operationplan__id__in=ids).values() ]
-    except Exception as e:
-      logger.error("Error retrieving operationplan data: %s" % e)
-      yield "[]"
-      raise StopIteration
+      return
 
     # Store my permissions
     view_PO = request.user.has_perm("input.view_purchaseorder")
@@ -1610,6 +1607,35 @@ class OperationPlanDetail(View):
     view_OpplanMaterial = request.user.has_perm("input.view_operationplanmaterial")
     view_OpplanResource = request.user.has_perm("input.view_operationplanresource")
 
+    # Every related table is read with a single query, and grouped by
+    # operationplan
+    try:
+      opplans = [ x for x in OperationPlan.objects.all().using(request.database).filter(id__in=ids).select_related("operation") ]
+      opplanmats = {}
+      if view_OpplanMaterial:
+        for m in OperationPlanMaterial.objects.all().using(request.database) \
+          .filter(operationplan__id__in=ids) \
+          .values('operationplan_id', 'flowdate', 'quantity', 'onhand', 'item_id', 'location_id'):
+            opplanmats.setdefault(m['operationplan_id'], []).append(m)
+      opplanrscs = {}
+      if view_OpplanMaterial and view_OpplanResource:
+        for m in OperationPlanResource.objects.all().using(request.database) \
+          .filter(operationplan__id__in=ids) \
+          .values('operationplan_id', 'startdate', 'quantity', 'resource_id'):
+            opplanrscs.setdefault(m['operationplan_id'], []).append(m)
+      demands = set()
+      for opplan in opplans:
+        if opplan.plan and 'pegging' in opplan.plan:
+          demands.update(opplan.plan['pegging'].keys())
+      due = {
+        name: dt.strftime("%Y-%m-%dT%H:%M:%S")
+        for name, dt in Demand.objects.all().using(request.database).filter(name__in=demands).values_list('name', 'due')
+        } if demands else {}
+    except Exception as e:
+      logger.error("Error retrieving operationplan data: %s" % e)
+      yield "[]"
+      return
+
     # Loop over all operationplans
     for opplan in opplans:
 
@@ -1647,7 +1673,7 @@ class OperationPlanDetail(View):
             res["pegging_demand"].append({
               "demand": {"name": d},
               "quantity": q,
-              "due": Demand.objects.all().using(request.database).get(name=d).due.strftime("%Y-%m-%dT%H:%M:%S")
+              "due": due[d]
               })
           res["pegging_demand"].sort(key=lambda f: (f['demand']['name'], f['due']))
         if opplan.operation:
@@ -1657,14 +1683,9 @@ class OperationPlanDetail(View):
             }
 
         # Information on materials
-        if view_OpplanMaterial:
-          firstmat = True
-          for m in opplanmats:
-            if m['operationplan_id'] != opplan.id:
-              continue
-            if firstmat:
-              firstmat = False
-              res['flowplans'] = []
+        if opplan.id in opplanmats:
+          res['flowplans'] = []
+          for m in opplanmats[opplan.id]:
             res['flowplans'].append({
               "date": m['flowdate'].strftime("%Y-%m-%dT%H:%M:%S"),
               "quantity": float(m['quantity']),
@@ -1674,22 +1695,17 @@ class OperationPlanDetail(View):
                 }
               })
 
-          # Information on resources
-          if view_OpplanResource:
-            firstres = True
-            for m in opplanrscs:
-              if m['operationplan_id'] != opplan.id:
-                continue
-              if firstres:
-                firstres = False
-                res['loadplans'] = []
-              res['loadplans'].append({
-                "date": m['startdate'].strftime("%Y-%m-%dT%H:%M:%S"),
-                "quantity": float(m['quantity']),
-                "resource": {
-                  "name": m['resource_id']
-                  }
-                })
+        # Information on resources
+        if opplan.id in opplanrscs:
+          res['loadplans'] = []
+          for m in opplanrscs[opplan.id]:
+            res['loadplans'].append({
+              "date": m['startdate'].strftime("%Y-%m-%dT%H:%M:%S"),
+              "quantity": float(m['quantity']),
+              "resource": {
+                "name": m['resource_id']
+                }
+              })
 
         # Final result
         if first:
@@ -1697,10 +1713,10 @@ class OperationPlanDetail(View):
           first = False
         else:
           yield ',%s' % json.dumps(res)
-        yield "]"
       except Exception as e:
         # Ignore exceptions and move on
         logger.error("Error retrieving operationplan: %s" % e)
+    yield "[]" if first else "]"
 
 
 
@@ -1741,53 +1757,93 @@ class OperationPlanDetail(View):
     update_MO = request.user.has_perm("input.change_manufacturingorder")
     update_DO = request.user.has_perm("input.change_distributionorder")
 
+    # Read all operationplans with a single query
+    results = []
+    updates = []
+    try:
+      ids = set()
+      for opplan_data in data:
+        try:
+          ids.add(int(opplan_data.get('id', None)))
+        except (TypeError, ValueError):
+          pass
+      opplans = {
+        i.id: i
+        for i in OperationPlan.objects.all().using(request.database).filter(id__in=ids).only('id', 'type')
+        }
+    except Exception as e:
+      logger.error("Error updating operationplan data: %s" % e)
+      return HttpResponseServerError("Error updating operationplan data", content_type='text/html')
+
+    # Validate the changes
     for opplan_data in data:
+      result = {'id': opplan_data.get('id', None)}
+      results.append(result)
       try:
-        # Read the object from the database
-        opplan = OperationPlan.objects.all().using(request.database).get(id=opplan_data.get('id', None))
+        opplan = opplans.get(int(opplan_data.get('id', None)), None)
+        if not opplan:
+          result.update({'status': 'error', 'message': 'Operationplan not found'})
+          continue
 
         # Check permissions
-        if opplan.type == "DO" and not update_DO:
-          continue
-        if opplan.type == "PO" and not update_PO:
-          continue
-        if opplan.type == "MO" and not update_MO:
+        if (opplan.type == "DO" and not update_DO) \
+          or (opplan.type == "PO" and not update_PO) \
+          or (opplan.type == "MO" and not update_MO):
+            result.update({'status': 'error', 'message': 'Permission denied'})
+            continue
+
+        # Collect the updated fields
+        upd = [
+          opplan.id,
+          "start" in opplan_data,
+          datetime.strptime(opplan_data['start'], "%Y-%m-%dT%H:%M:%S") if "start" in opplan_data else None,
+          "end" in opplan_data,
+          datetime.strptime(opplan_data['end'], "%Y-%m-%dT%H:%M:%S") if "end" in opplan_data else None,
+          "quantity" in opplan_data,
+          float(opplan_data['quantity']) if "quantity" in opplan_data else None,
+          "status" in opplan_data,
+          opplan_data.get('status', None),
+          "reference" in opplan_data,
+          opplan_data.get('reference', None)
+          ]
+        if not any(upd[1::2]):
+          result['status'] = 'unchanged'
           continue
+        updates.append(upd)
+        result['status'] = 'ok'
+      except Exception as e:
+        result.update({'status': 'error', 'message': str(e)})
 
-        # Update fields
-        save = False
-        if "start" in opplan_data:
-          # Update start date
-          opplan.startdate = datetime.strptime(opplan_data['start'], "%Y-%m-%dT%H:%M:%S")
-          save = True
-        if "end" in opplan_data:
-          # Update end date
-          opplan.enddate = datetime.strptime(opplan_data['end'], "%Y-%m-%dT%H:%M:%S")
-          save = True
-        if "quantity" in opplan_data:
-          # Update quantity
-          opplan.quantity = opplan_data['quantity']
-          save = True
-        if "status" in opplan_data:
-          # Status quantity
-          opplan.status = opplan_data['status']
-          save = True
-
-        if "reference" in opplan_data:
-          # Update reference
-          opplan.reference = opplan_data['reference']
-          save = True
-
-        # Save if changed
-        if save:
-          opplan.save(
-            using=request.database,
-            update_fields=["startdate", "enddate", "quantity", "reference", "lastmodified"]
+    # Save all changes with a single statement
+    if updates:
+      try:
+        with transaction.atomic(using=request.database):
+          cursor = connections[request.database].cursor()
+          cursor.execute('''
+            update operationplan set
+              startdate = case when upd.set_start then upd.startdate else operationplan.startdate end,
+              enddate = case when upd.set_end then upd.enddate else operationplan.enddate end,
+              quantity = case when upd.set_quantity then upd.quantity else operationplan.quantity end,
+              status = case when upd.set_status then upd.status else operationplan.status end,
+              reference = case when upd.set_reference then upd.reference else operationplan.reference end,
+              lastmodified = %%s
+            from (values %s) as upd(
+              id, set_start, startdate, set_end, enddate, set_quantity, quantity,
+              set_status, status, set_reference, reference
+              )
+            where operationplan.id = upd.id
+            ''' % ','.join([
+              "(%s, %s, %s::timestamp, %s, %s::timestamp, %s, %s::numeric, %s, %s::varchar, %s, %s::varchar)"
+              ] * len(updates)),
+            [datetime.now()] + [ v for upd in updates for v in upd ]
             )
-      except OperationPlan.DoesNotExist:
-        # Silently ignore
-        pass
       except Exception as e:
-        # Swallow the exception and move on
-        logger.error("Error updating operationplan: %s" % e)
-    return HttpResponse(content="OK")
+        logger.error("Error updating operationplan data: %s" % e)
+        for result in results:
+          if result['status'] == 'ok':
+            result.update({'status': 'error', 'message': str(e)})
+
+    return HttpResponse(
+      content=json.dumps(results),
+      content_type='application/json; charset=%s' % settings.DEFAULT_CHARSET
+      )
@@ -16,11 +16,18 @@
 #
 import base64
 import email
+from http.client import HTTPConnection, HTTPSConnection
+from itertools import islice
 import jwt
 import os
+import shutil
+import tempfile
+from threading import Thread
 import time
+from urllib.parse import urlparse
 from urllib.request import urlopen, HTTPError, Request
 from xml.sax.saxutils import quoteattr
+import zlib
 
 from django.utils.http import urlencode
 
@@ -49,19 +56,40 @@ class OdooReadData(PlanTask):
       can be transferred during automated scheduled runs at a quiet moment.
   Which data elements belong to each category is determined in the Odoo
   addon module and can vary between implementations.
+
+  When the parameter odoo.incremental is true, mode 1 runs only read the
+  records changed in Odoo since the time stored in the parameter odoo.lastSync.
+  The changes are applied on top of the model loaded from the frePPLe
+  database. The open purchase and manufacturing orders are always read in
+  full. Clearing the odoo.lastSync parameter triggers a full refresh.
   '''
 
   description = "Load Odoo data"
   sequence = 130
   label = ('odoo_read_1', _("Read Odoo data"))
 
+  # Size of the chunks in which the data is passed from odoo to the parser
+  chunksize = 256 * 1024
+
+  # Odoo time to use as the starting point of the next incremental run
+  timestamp = None
+
   @classmethod
   def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
     for i in range(5):
       if ("odoo_read_%s" % i) in os.environ:
         cls.mode = i
+        cls.delta = None
+        cls.timestamp = None
+        if i == 1 and Parameter.getValue("odoo.incremental", database, "false").lower() == "true":
+          cls.delta = Parameter.getValue("odoo.lastSync", database, None) or None
+        if cls.delta:
+          # The odoo data from the database is loaded as well, and the changes
+          # are applied on top of it. Odoo still sends all open purchase and
+          # manufacturing orders, so we don't load those from the database.
+          cls.description = "Load Odoo data changed since %s" % cls.delta
         for stdLoad in PlanTaskRegistry.reg:
-          if issubclass(stdLoad, LoadTask):
+          if issubclass(stdLoad, LoadTask) and (not cls.delta or stdLoad.__name__ == 'loadOperationPlans'):
             stdLoad.filter = "(source is null or source<>'odoo_%s')" % cls.mode
             stdLoad.description += " - non-odoo source"
         return 1
@@ -110,25 +138,115 @@ class OdooReadData(PlanTask):
       raise Exception("Odoo connector not configured correctly")
 
     # Connect to the odoo URL to GET data
-    url = "%sfrepple/xml?%s" % (odoo_url, urlencode({
-        'database': odoo_db,
-        'language': odoo_language,
-        'company': odoo_company,
-        'mode': cls.mode
-        }))
+    args = {
+      'database': odoo_db,
+      'language': odoo_language,
+      'company': odoo_company,
+      'mode': cls.mode
+      }
+    if cls.delta:
+      args['delta'] = cls.delta
+    url = "%sfrepple/xml?%s" % (odoo_url, urlencode(args))
     try:
       request = Request(url)
       encoded = base64.encodestring(('%s:%s' % (odoo_user, odoo_password)).encode('utf-8'))[:-1]
       request.add_header("Authorization", "Basic %s" % encoded.decode('ascii'))
+      request.add_header("Accept-Encoding", "gzip")
     except HTTPError as e:
       print("Error connecting to odoo at %s: %s" % (url, e))
       raise e
 
     # Download and parse XML data
+    starttime = time.time()
     with urlopen(request) as f:
-      frepple.readXMLdata(f.read().decode('utf-8'), False, False)
+      size = cls.parseXML(f, compressed=(f.headers.get('Content-Encoding', None) == 'gzip'))
+      cls.timestamp = f.headers.get('X-Frepple-Delta', None)
+    print("Read %d bytes of odoo data in %.2f seconds" % (size, time.time() - starttime))
     frepple.printsize()
 
+  @classmethod
+  def parseXML(cls, source, compressed=False):
+    '''
+    Passes the XML data from a file-like object to the frePPLe parser, while
+    it is being read. Compressed data is decompressed on the fly.
+
+    A thread copies the data in chunks into a named pipe, from which the
+    parser reads its input. Reading the data and parsing it overlap, and only
+    a single chunk is kept in memory at any time.
+    On platforms without named pipes the data is first copied into a
+    temporary file.
+    Returns the size of the XML data.
+    '''
+    import frepple
+
+    size = 0
+
+    def getChunks():
+      nonlocal size
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+      while True:
+        data = source.read(cls.chunksize)
+        if not data:
+          break
+        while data:
+          if decompressor:
+            chunk = decompressor.decompress(data, cls.chunksize)
+            data = decompressor.unconsumed_tail
+          else:
+            chunk = data
+            data = None
+          size += len(chunk)
+          yield chunk
+      if decompressor:
+        chunk = decompressor.flush()
+        size += len(chunk)
+        yield chunk
+
+    folder = tempfile.mkdtemp(prefix='frepple_odoo_')
+    try:
+      filename = os.path.join(folder, 'odoo.xml')
+      if not hasattr(os, 'mkfifo'):
+        with open(filename, 'wb') as f:
+          for chunk in getChunks():
+            f.write(chunk)
+        frepple.readXMLfile(filename, False, False)
+        return size
+
+      os.mkfifo(filename)
+      errors = []
+
+      def feed():
+        try:
+          with open(filename, 'wb') as pipe:
+            for chunk in getChunks():
+              pipe.write(chunk)
+        except BrokenPipeError:
+          # The parser stopped reading
+          pass
+        except Exception as e:
+          errors.append(e)
+
+      feeder = Thread(target=feed, daemon=True)
+      feeder.start()
+      try:
+        # The parser releases the Python interpreter while it is running
+        frepple.readXMLfile(filename, False, False)
+      except Exception:
+        # Unblock the feeder if the parser didn't open the pipe
+        os.close(os.open(filename, os.O_RDONLY | os.O_NONBLOCK))
+        feeder.join()
+        # An error while reading the data truncates the XML document. That
+        # error is more relevant than the parsing error.
+        if errors:
+          raise errors[0]
+        raise
+      feeder.join()
+      if errors:
+        raise errors[0]
+      return size
+    finally:
+      shutil.rmtree(folder, ignore_errors=True)
+
 
 @PlanTaskRegistry.register
 class OdooSaveStatic(PlanTask):
@@ -151,6 +269,19 @@ class OdooSaveStatic(PlanTask):
     from freppledb.execute.export_database_static import exportStaticModel
     exportStaticModel(database=database, source='odoo_%s' % cls.mode).run()
 
+    # Remember where the next incremental run needs to start from
+    if cls.mode == 1 and OdooReadData.timestamp:
+      param = Parameter.objects.all().using(database).get_or_create(name='odoo.lastSync')[0]
+      param.value = OdooReadData.timestamp
+      param.save(using=database)
+
+
+class DeliveredError(Exception):
+  '''
+  Error raised after a request was delivered to odoo, which may already have
+  processed it.
+  '''
+
 
 @PlanTaskRegistry.register
 class OdooWritePlan(PlanTask):
@@ -176,6 +307,9 @@ class OdooWritePlan(PlanTask):
          redundant operationplan.
     - The XML file uploaded is not exactly the standard XML of frePPLe, but a
       slight variation that fits odoo better.
+    - The operationplans are uploaded in batches, whose size is set with the
+      parameter odoo.exportBatchSize. Each batch is streamed to odoo in a
+      separate request.
     - Filter expressions are evaluated to limit the plan data that is
       automatically exported.
         - odoo.filter_export_purchase_order
@@ -191,6 +325,23 @@ class OdooWritePlan(PlanTask):
   sequence = 390
   label = ('odoo_write', _("Write results to Odoo"))
 
+  # Size of the chunks in which the data is sent to odoo
+  chunksize = 64 * 1024
+  # Compression of the data requires a web server in front of odoo that
+  # decompresses the request
+  compress = False
+  # Each batch is sent in a single block with a content length. The werkzeug
+  # server of odoo doesn't read chunked requests reliably, but chunked
+  # transfer encoding can be used with a web server in front of odoo.
+  chunked = False
+  # Number of times a failed batch is sent again, and the delay in between.
+  # The batches in the incremental mode 2 are only sent again when odoo
+  # didn't receive them.
+  retries = 2
+  retrydelay = 10
+  # Timeout in seconds of the connection
+  timeout = 600
+
   @classmethod
   def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
     if 'odoo_write' in os.environ:
@@ -225,15 +376,21 @@ class OdooWritePlan(PlanTask):
     odoo_language = Parameter.getValue("odoo.language", database, 'en_US')
     if not ok:
       raise Exception("Odoo connector not configured correctly")
-    boundary = email.generator._make_boundary()
+    try:
+      batchsize = int(Parameter.getValue("odoo.exportBatchSize", database, '1000'))
+    except ValueError:
+      print("Warning: Invalid format for parameter 'odoo.exportBatchSize'.")
+      batchsize = 1000
+    encoded = base64.encodestring(('%s:%s' % (odoo_user, odoo_password)).encode('utf-8'))
+    authorization = "Basic %s" % encoded.decode('ascii')[:-1]
 
     # Generator function
     # We generate output in the multipart/form-data format.
     # We send the connection parameters as well as a file with the planning
     # results in XML-format.
-    # TODO respect the parameters odoo.filter_export_purchase_order, odoo.filter_export_manufacturing_order, odoo.filter_export_distribution_order
-    # these are python expressions - attack-sensitive evaluation!
-    def publishPlan(cls):
+    # The first batch replaces all previous proposals in odoo. The next
+    # batches are sent in the incremental mode 2.
+    def publishPlan(boundary, batch, first):
       yield '--%s\r' % boundary
       yield 'Content-Disposition: form-data; name="webtoken"\r'
       yield '\r'
@@ -255,6 +412,11 @@ class OdooWritePlan(PlanTask):
       yield 'Content-Disposition: form-data; name="company"\r'
       yield '\r'
       yield '%s\r' % odoo_company
+      if not first:
+        yield '--%s\r' % boundary
+        yield 'Content-Disposition: form-data; name="mode"\r'
+        yield '\r'
+        yield '2\r'
       yield '--%s\r' % boundary
       yield 'Content-Disposition: file; name="frePPLe plan"; filename="frepple_plan.xml"\r'
       yield 'Content-Type: application/xml\r'
@@ -263,12 +425,22 @@ class OdooWritePlan(PlanTask):
       yield '<plan xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
       # Export relevant operationplans
       yield '<operationplans>'
+      for opplan, xml in batch:
+        yield xml
+      yield '</operationplans>'
+      yield '</plan>'
+      yield '--%s--\r' % boundary
+      yield '\r'
+
+    # Find the operationplans to export
+    # TODO respect the parameters odoo.filter_export_purchase_order, odoo.filter_export_manufacturing_order, odoo.filter_export_distribution_order
+    # these are python expressions - attack-sensitive evaluation!
+    def getOperationplans():
       for i in frepple.operationplans():
         if i.ordertype == 'PO':
           if not i.item or not i.item.source or not i.item.source.startswith('odoo') or i.locked:
             continue
-          cls.exported.append(i)
-          yield '<operationplan id="%s" ordertype="PO" item=%s location=%s supplier=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>' % (
+          yield i, '<operationplan id="%s" ordertype="PO" item=%s location=%s supplier=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>' % (
             i.id, quoteattr(i.item.name), quoteattr(i.location.name),
             quoteattr(i.supplier.name), i.start, i.end, i.quantity,
             quoteattr(i.operation.location.subcategory), quoteattr(i.item.subcategory),
@@ -277,44 +449,125 @@ class OdooWritePlan(PlanTask):
         elif i.ordertype == "MO":
           if not i.operation or not i.operation.source or not i.operation.source.startswith('odoo') or i.locked:
             continue
-          cls.exported.append(i)
-          yield '<operationplan id="%s" ordertype="MO" item=%s location=%s operation=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>' % (
+          yield i, '<operationplan id="%s" ordertype="MO" item=%s location=%s operation=%s start="%s" end="%s" quantity="%s" location_id=%s item_id=%s criticality="%d"/>' % (
             i.id, quoteattr(i.operation.item.name), quoteattr(i.operation.location.name),
             quoteattr(i.operation.name), i.start, i.end, i.quantity,
             quoteattr(i.operation.location.subcategory), quoteattr(i.operation.item.subcategory),
             int(i.criticality)
             )
-      yield '</operationplans>'
-      yield '</plan>'
-      yield '--%s--\r' % boundary
-      yield '\r'
 
-    # Connect to the odoo URL to POST data
-    try:
-      cls.exported = []
-      body = '\n'.join(publishPlan(cls)).encode('utf-8')
-      size = len(body)
-      encoded = base64.encodestring(('%s:%s' % (odoo_user, odoo_password)).encode('utf-8'))
-      req = Request(
-        "%sfrepple/xml/" % odoo_url,
-        data=body,
-        headers={
-          'Authorization': "Basic %s" % encoded.decode('ascii')[:-1],
-          'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
-          'Content-length': size
-          }
-        )
-
-      # Posting the data and displaying the server response
-      print("Uploading %d bytes of planning results to odoo" % size)
-      with urlopen(req) as f:
-        msg = f.read()
-        print("Odoo response: %s" % msg.decode('utf-8'))
+    # Post the operationplans in batches.
+    # The operationplans of a batch are marked as approved when odoo
+    # accepted it. When a batch fails, only that batch is sent again. Odoo
+    # may already have processed a batch that failed after it was delivered.
+    # Only the first batch, which replaces all proposals, can then be sent
+    # again.
+    operationplans = getOperationplans()
+    first = True
+    size = 0
+    count = 0
+    while True:
+      batch = list(islice(operationplans, batchsize) if batchsize > 0 else operationplans)
+      if not batch and not first:
+        break
+      for attempt in range(cls.retries, -1, -1):
+        try:
+          boundary = email.generator._make_boundary()
+          sent, msg = cls.postData(
+            "%sfrepple/xml/" % odoo_url,
+            publishPlan(boundary, batch, first),
+            {
+              'Authorization': authorization,
+              'Content-Type': 'multipart/form-data; boundary=%s' % boundary
+            })
+          break
+        except Exception as e:
+          if not attempt or (not first and isinstance(e, DeliveredError)):
+            print("Error connecting to odoo: %s" % e)
+            raise e
+          print("Error connecting to odoo, retrying: %s" % e)
+          time.sleep(cls.retrydelay)
+      size += sent
+      count += len(batch)
+      print("Odoo response: %s" % msg)
 
       # Mark the exported operations as approved
-      for i in cls.exported:
+      for i, xml in batch:
         i.status = 'approved'
-      del cls.exported
+      first = False
+      if batchsize <= 0:
+        break
+    print("Uploaded %d operationplans in %d bytes to odoo" % (count, size))
 
-    except HTTPError as e:
-      print("Error connecting to odoo", e.read())
+  @classmethod
+  def postData(cls, url, data, headers):
+    '''
+    Posts a request with chunked transfer encoding. The data is an iterable
+    of strings, which are separated with a newline. They are sent in chunks
+    while they are being generated, and are optionally compressed.
+    Without chunked transfer encoding the data is collected first.
+    Returns the number of bytes sent and the response of the server.
+    Errors after the request was sent completely raise a DeliveredError.
+    '''
+    url = urlparse(url)
+    if url.scheme == 'https':
+      conn = HTTPSConnection(url.hostname, url.port, timeout=cls.timeout)
+    else:
+      conn = HTTPConnection(url.hostname, url.port, timeout=cls.timeout)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if cls.compress else None
+    sent = 0
+    body = []
+
+    def sendChunk(chunk):
+      nonlocal sent
+      if compressor:
+        chunk = compressor.compress(chunk)
+      if not chunk:
+        return
+      if cls.chunked:
+        conn.send(('%x\r\n' % len(chunk)).encode('ascii') + chunk + b'\r\n')
+      else:
+        body.append(chunk)
+      sent += len(chunk)
+
+    try:
+      conn.putrequest('POST', url.path + ('?%s' % url.query if url.query else ''))
+      for k, v in headers.items():
+        conn.putheader(k, v)
+      if compressor:
+        conn.putheader('Content-Encoding', 'gzip')
+      if cls.chunked:
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+      buf = []
+      buflen = 0
+      for i in data:
+        if buf:
+          buf.append('\n')
+        buf.append(i)
+        buflen += len(i) + 1
+        if buflen >= cls.chunksize:
+          sendChunk(''.join(buf).encode('utf-8'))
+          buf = ['']
+          buflen = 0
+      if buf:
+        sendChunk(''.join(buf).encode('utf-8'))
+      if compressor:
+        # The remaining compressed data is sent as is
+        compressor, chunk = None, compressor.flush()
+        sendChunk(chunk)
+      if cls.chunked:
+        conn.send(b'0\r\n\r\n')
+      else:
+        conn.putheader('Content-Length', str(sent))
+        conn.endheaders(b''.join(body))
+      try:
+        response = conn.getresponse()
+        msg = response.read().decode('utf-8')
+      except Exception as e:
+        raise DeliveredError("No response from odoo: %s" % e)
+      if response.status >= 400:
+        raise DeliveredError("HTTP error %s %s: %s" % (response.status, response.reason, msg))
+      return sent, msg
+    finally:
+      conn.close()
@@ -0,0 +1,39 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations
+
+
+def add_parameters(apps, schema_editor):
+  Parameter = apps.get_model('common', 'Parameter')
+  # New parameter: odoo.exportBatchSize
+  param, created = Parameter.objects.get_or_create(name='odoo.exportBatchSize')
+  if created:
+    param.value = "1000"
+    param.description = "Odoo connector: number of operationplans uploaded to odoo in a single request"
+    param.save()
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+      ('odoo', '0002_parameters'),
+  ]
+
+  operations = [
+    migrations.RunPython(add_parameters),
+  ]
@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations
+
+
+def add_parameters(apps, schema_editor):
+  Parameter = apps.get_model('common', 'Parameter')
+  # New parameter: odoo.incremental
+  param, created = Parameter.objects.get_or_create(name='odoo.incremental')
+  if created:
+    param.value = "false"
+    param.description = "Odoo connector: when true, only the records changed in odoo since the last run are read"
+    param.save()
+  # New parameter: odoo.lastSync
+  param, created = Parameter.objects.get_or_create(name='odoo.lastSync')
+  if created:
+    param.value = ""
+    param.description = "Odoo connector: odoo time of the last data load, used as starting point of incremental loads. Clear it to read all data again."
+    param.save()
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+      ('odoo', '0003_exportbatchsize'),
+  ]
+
+  operations = [
+    migrations.RunPython(add_parameters),
+  ]
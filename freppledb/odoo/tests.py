@@ -0,0 +1,231 @@
+#
+# Copyright (C) 2007-2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import sys
+from threading import Thread
+from types import SimpleNamespace
+from unittest.mock import patch
+import zlib
+
+from django.test import SimpleTestCase, TestCase
+
+from freppledb.common.commands import PlanTaskRegistry
+from freppledb.common.models import Parameter
+from freppledb.input.commands import LoadTask
+from freppledb.odoo.commands import OdooReadData, OdooWritePlan, DeliveredError
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  '''
+  Stand-in for the odoo server, which stores the requests it receives.
+  The connection is closed without a response for the requests listed in
+  the failures attribute, like odoo does when it runs into a timeout.
+  '''
+  requests = []
+  failures = []
+
+  def do_POST(self):
+    chunks = []
+    if 'Content-Length' in self.headers:
+      chunks.append(self.rfile.read(int(self.headers['Content-Length'])))
+    else:
+      while True:
+        size = int(self.rfile.readline().strip(), 16)
+        chunk = self.rfile.read(size)
+        self.rfile.readline()
+        if not size:
+          break
+        chunks.append(chunk)
+    self.requests.append((dict(self.headers), chunks))
+    if len(self.requests) in self.failures:
+      self.close_connection = True
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.end_headers()
+    self.wfile.write(b'Processed')
+
+  def log_message(self, *args):
+    pass
+
+
+class StandInServer:
+
+  def setUp(self):
+    StandInHandler.requests = []
+    StandInHandler.failures = []
+    self.server = HTTPServer(('localhost', 0), StandInHandler)
+    Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = 'http://localhost:%s/frepple/xml/' % self.server.server_port
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    OdooWritePlan.compress = False
+    OdooWritePlan.chunked = False
+
+
+class OdooUploadTest(StandInServer, SimpleTestCase):
+
+  def test_chunked_upload(self):
+    OdooWritePlan.chunked = True
+    data = ['<operationplan id="%s"/>' % i for i in range(100000)]
+    sent, msg = OdooWritePlan.postData(self.url, iter(data), {'Content-Type': 'application/xml'})
+    self.assertEqual(msg, 'Processed')
+    self.assertEqual(len(StandInHandler.requests), 1)
+    headers, chunks = StandInHandler.requests[0]
+    self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+    self.assertGreater(len(chunks), 1)
+    self.assertEqual(b''.join(chunks), '\n'.join(data).encode('utf-8'))
+    self.assertEqual(sent, sum(len(c) for c in chunks))
+
+  def test_compressed_upload(self):
+    OdooWritePlan.compress = True
+    data = ['<operationplan id="%s"/>' % i for i in range(100000)]
+    sent, msg = OdooWritePlan.postData(self.url, iter(data), {'Content-Type': 'application/xml'})
+    headers, chunks = StandInHandler.requests[0]
+    self.assertEqual(headers['Content-Encoding'], 'gzip')
+    self.assertEqual(
+      zlib.decompress(b''.join(chunks), 16 + zlib.MAX_WBITS),
+      '\n'.join(data).encode('utf-8')
+      )
+
+  def test_unchunked_upload(self):
+    data = ['<operationplan id="%s"/>' % i for i in range(100000)]
+    sent, msg = OdooWritePlan.postData(self.url, iter(data), {'Content-Type': 'application/xml'})
+    headers, chunks = StandInHandler.requests[0]
+    self.assertNotIn('Transfer-Encoding', headers)
+    self.assertEqual(int(headers['Content-Length']), sent)
+    self.assertEqual(b''.join(chunks), '\n'.join(data).encode('utf-8'))
+
+
+class OdooIncrementalTest(TestCase):
+
+  def setUp(self):
+    os.environ['odoo_read_1'] = '1'
+    self.loaders = [i for i in PlanTaskRegistry.reg if issubclass(i, LoadTask)]
+    self.descriptions = {i: i.description for i in self.loaders}
+    Parameter.objects.update_or_create(name='odoo.incremental', defaults={'value': 'true'})
+
+  def tearDown(self):
+    del os.environ['odoo_read_1']
+    for i in self.loaders:
+      i.filter = None
+      i.description = self.descriptions[i]
+    OdooReadData.description = "Load Odoo data"
+
+  def test_full_load(self):
+    # Without a previous run all odoo data is read from odoo
+    self.assertEqual(OdooReadData.getWeight(), 1)
+    self.assertIsNone(OdooReadData.delta)
+    for i in self.loaders:
+      self.assertEqual(i.filter, "(source is null or source<>'odoo_1')")
+
+  def test_incremental_load(self):
+    # Only the operationplans are read in full from odoo
+    Parameter.objects.update_or_create(name='odoo.lastSync', defaults={'value': '2018-01-01 00:00:00'})
+    self.assertEqual(OdooReadData.getWeight(), 1)
+    self.assertEqual(OdooReadData.delta, '2018-01-01 00:00:00')
+    for i in self.loaders:
+      if i.__name__ == 'loadOperationPlans':
+        self.assertEqual(i.filter, "(source is null or source<>'odoo_1')")
+      else:
+        self.assertIsNone(i.filter)
+
+
+
+class OdooWritePlanTest(StandInServer, TestCase):
+
+  def setUp(self):
+    super().setUp()
+    for name, value in (
+      ('odoo.user', 'admin'), ('odoo.password', 'admin'), ('odoo.db', 'odoo'),
+      ('odoo.url', self.url[:-len('frepple/xml/')]), ('odoo.company', 'company'),
+      ('odoo.exportBatchSize', '2')
+      ):
+      Parameter.objects.update_or_create(name=name, defaults={'value': value})
+    OdooWritePlan.retrydelay = 0
+    item = SimpleNamespace(name='item', source='odoo_1', subcategory='1,1')
+    location = SimpleNamespace(name='location', subcategory='1')
+    self.operationplans = [
+      SimpleNamespace(
+        id=i, ordertype='PO', item=item, location=location,
+        supplier=SimpleNamespace(name='supplier'),
+        operation=SimpleNamespace(location=location),
+        start=datetime(2018, 1, 1), end=datetime(2018, 1, 2), quantity=1,
+        criticality=0, locked=i == 3, status='proposed'
+        )
+      for i in range(6)
+      ]
+    # Locked operationplans and operationplans of other sources are skipped
+    self.operationplans.append(SimpleNamespace(
+      id=6, ordertype='PO', item=SimpleNamespace(name='other', source=None),
+      locked=False, status='proposed'
+      ))
+
+  def tearDown(self):
+    super().tearDown()
+    OdooWritePlan.retrydelay = 10
+
+  def runUpload(self):
+    frepple = SimpleNamespace(operationplans=lambda: iter(self.operationplans))
+    with patch.dict(sys.modules, {'frepple': frepple}):
+      OdooWritePlan.run()
+
+  def getBatches(self):
+    # Returns the operationplans and the mode of every request
+    batches = []
+    for headers, chunks in StandInHandler.requests:
+      data = b''.join(chunks).decode('utf-8')
+      batches.append((
+        [int(i.split('"', 1)[0]) for i in data.split('<operationplan id="')[1:]],
+        'name="mode"' in data
+        ))
+    return batches
+
+  def getApproved(self):
+    return [i.id for i in self.operationplans if i.status == 'approved']
+
+  def test_batches(self):
+    # The first batch replaces all proposals in odoo, the next ones are
+    # incremental. All uploaded operationplans are approved.
+    self.runUpload()
+    self.assertEqual(self.getBatches(), [
+      ([0, 1], False), ([2, 4], True), ([5], True)
+      ])
+    self.assertEqual(self.getApproved(), [0, 1, 2, 4, 5])
+
+  def test_retry_first_batch(self):
+    # The first batch is sent again when odoo didn't respond
+    StandInHandler.failures = [1]
+    self.runUpload()
+    self.assertEqual(self.getBatches(), [
+      ([0, 1], False), ([0, 1], False), ([2, 4], True), ([5], True)
+      ])
+    self.assertEqual(self.getApproved(), [0, 1, 2, 4, 5])
+
+  def test_no_retry_incremental_batch(self):
+    # An incremental batch that odoo received isn't sent again, since odoo
+    # may have processed it already. Only the accepted batch is approved.
+    StandInHandler.failures = [2]
+    with self.assertRaises(DeliveredError):
+      self.runUpload()
+    self.assertEqual(self.getBatches(), [([0, 1], False), ([2, 4], True)])
+    self.assertEqual(self.getApproved(), [0, 1])
@@ -0,0 +1,45 @@
+#
+# Copyright (C) 2017 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0004_squashed_41'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Pegging',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('demand', models.CharField(max_length=300, verbose_name='demand', db_index=True)),
+                ('operationplan', models.IntegerField(verbose_name='operationplan', db_index=True)),
+                ('sequence', models.IntegerField(verbose_name='sequence')),
+                ('level', models.IntegerField(verbose_name='level')),
+                ('quantity', models.DecimalField(verbose_name='quantity', decimal_places=6, max_digits=15)),
+            ],
+            options={
+                'verbose_name': 'pegging',
+                'verbose_name_plural': 'peggings',
+                'db_table': 'out_pegging',
+                'ordering': ['demand', 'sequence'],
+            },
+        ),
+    ]
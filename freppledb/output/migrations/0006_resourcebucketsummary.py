@@ -0,0 +1,52 @@
+#
+# Copyright (C) 2017 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0005_pegging'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceBucketSummary',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('resource', models.CharField(max_length=300, verbose_name='resource')),
+                ('bucket', models.CharField(max_length=300, verbose_name='bucket')),
+                ('startdate', models.DateTimeField(verbose_name='startdate')),
+                ('enddate', models.DateTimeField(verbose_name='enddate')),
+                ('available', models.DecimalField(verbose_name='available', null=True, decimal_places=6, max_digits=15)),
+                ('unavailable', models.DecimalField(verbose_name='unavailable', null=True, decimal_places=6, max_digits=15)),
+                ('setup', models.DecimalField(verbose_name='setup', null=True, decimal_places=6, max_digits=15)),
+                ('load', models.DecimalField(verbose_name='load', null=True, decimal_places=6, max_digits=15)),
+            ],
+            options={
+                'verbose_name': 'resource bucket summary',
+                'verbose_name_plural': 'resource bucket summaries',
+                'db_table': 'out_resourcebucket',
+                'ordering': ['resource', 'bucket', 'startdate'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='resourcebucketsummary',
+            unique_together=set([('resource', 'bucket', 'startdate')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+#
+# Copyright (C) 2017 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+def refreshBuckets(apps, schema_editor):
+  # The summary is computed with the enddate of the resource plan, and is
+  # only filled once that field exists
+  from freppledb.output.models import ResourceBucketSummary
+  ResourceBucketSummary.refresh(schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0006_resourcebucketsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resourcesummary',
+            name='enddate',
+            field=models.DateTimeField(verbose_name='enddate', null=True),
+        ),
+        migrations.RunSQL(
+            "update out_resourceplan set enddate = startdate + interval '1 day'",
+            migrations.RunSQL.noop
+        ),
+        migrations.AlterField(
+            model_name='resourcesummary',
+            name='enddate',
+            field=models.DateTimeField(verbose_name='enddate'),
+        ),
+        migrations.RunPython(refreshBuckets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2017 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+def fillSummaries(apps, schema_editor):
+  from freppledb.output.models import ProblemSummary, KPI
+  ProblemSummary.refresh(schema_editor.connection.alias)
+  KPI.refresh(schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0007_resourceplan_enddate'),
+        ('input', '0022_operationplanmaterial_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProblemSummary',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('entity', models.CharField(max_length=15, verbose_name='entity')),
+                ('name', models.CharField(max_length=20, verbose_name='name')),
+                ('count', models.IntegerField(verbose_name='count')),
+                ('weight', models.DecimalField(verbose_name='weight', decimal_places=6, max_digits=20)),
+            ],
+            options={
+                'verbose_name': 'problem summary',
+                'verbose_name_plural': 'problem summaries',
+                'db_table': 'out_problemsummary',
+                'ordering': ['entity', 'name'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='problemsummary',
+            unique_together=set([('entity', 'name')]),
+        ),
+        migrations.CreateModel(
+            name='KPI',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, auto_created=True, verbose_name='ID')),
+                ('sequence', models.IntegerField(verbose_name='sequence')),
+                ('category', models.CharField(max_length=20, verbose_name='category')),
+                ('name', models.CharField(max_length=30, verbose_name='name')),
+                ('value', models.DecimalField(verbose_name='value', decimal_places=6, max_digits=20)),
+            ],
+            options={
+                'verbose_name': 'kpi',
+                'verbose_name_plural': 'kpis',
+                'db_table': 'out_kpi',
+                'ordering': ['sequence', 'id'],
+            },
+        ),
+        migrations.RunPython(fillSummaries, migrations.RunPython.noop),
+    ]
@@ -16,7 +16,7 @@
 #
 
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
 
 
 class Problem(models.Model):
@@ -63,8 +63,16 @@ class Constraint(models.Model):
 
 
 class ResourceSummary(models.Model):
+  '''
+  The resource plan is stored sparsely. A record holds the daily values
+  of all days from its start date till its end date. Days without any
+  availability, load, setup and free capacity aren't stored.
+  The records of bucketized resources hold the total of a resource
+  bucket, and cover only the first day of the bucket.
+  '''
   resource = models.CharField(_('resource'), max_length=300)
   startdate = models.DateTimeField(_('startdate'))
+  enddate = models.DateTimeField(_('enddate'))
   available = models.DecimalField(_('available'), max_digits=15, decimal_places=6, null=True)
   unavailable = models.DecimalField(_('unavailable'), max_digits=15, decimal_places=6, null=True)
   setup = models.DecimalField(_('setup'), max_digits=15, decimal_places=6, null=True)
@@ -77,3 +85,239 @@ class ResourceSummary(models.Model):
     unique_together = (('resource', 'startdate'),)
     verbose_name = 'resource summary'  # No need to translate these since only used internally
     verbose_name_plural = 'resource summaries'
+
+  @staticmethod
+  def densify(field, startdate, enddate, table='out_resourceplan'):
+    '''
+    Returns a SQL expression that totals a field of the resource plan over
+    the days between two dates. The dates are SQL expressions.
+    A day counts when it starts within the dates. The days are counted on
+    the calendar of the database session, so that the days with a daylight
+    saving time change count as a single day.
+    The resource plan records need to be joined with the condition:
+      <table>.startdate < <enddate> and <table>.enddate > <startdate>
+    '''
+    return '''
+      sum(%(table)s.%(field)s * greatest(0,
+        least(%(table)s.enddate, %(end)s)::date - greatest(%(table)s.startdate, %(start)s)::date
+        + case when least(%(table)s.enddate, %(end)s) > least(%(table)s.enddate, %(end)s)::date then 1 else 0 end
+        - case when greatest(%(table)s.startdate, %(start)s) > greatest(%(table)s.startdate, %(start)s)::date then 1 else 0 end
+        ))
+      ''' % {'table': table, 'field': field, 'start': startdate, 'end': enddate}
+
+
+class ResourceBucketSummary(models.Model):
+  '''
+  The resource plan aggregated in the time buckets of every bucket size.
+  '''
+  resource = models.CharField(_('resource'), max_length=300)
+  bucket = models.CharField(_('bucket'), max_length=300)
+  startdate = models.DateTimeField(_('startdate'))
+  enddate = models.DateTimeField(_('enddate'))
+  available = models.DecimalField(_('available'), max_digits=15, decimal_places=6, null=True)
+  unavailable = models.DecimalField(_('unavailable'), max_digits=15, decimal_places=6, null=True)
+  setup = models.DecimalField(_('setup'), max_digits=15, decimal_places=6, null=True)
+  load = models.DecimalField(_('load'), max_digits=15, decimal_places=6, null=True)
+
+  class Meta:
+    db_table = 'out_resourcebucket'
+    ordering = ['resource', 'bucket', 'startdate']
+    unique_together = (('resource', 'bucket', 'startdate'),)
+    verbose_name = 'resource bucket summary'  # No need to translate these since only used internally
+    verbose_name_plural = 'resource bucket summaries'
+
+  @classmethod
+  def refresh(cls, database=DEFAULT_DB_ALIAS, resources=None):
+    '''
+    Recomputes the summary from the resource plan.
+    When a list of resources is passed, only these resources are refreshed.
+    '''
+    cursor = connections[database].cursor()
+    if resources is None:
+      cursor.execute("truncate table out_resourcebucket")
+      filter_where = ''
+      params = []
+    else:
+      resources = list(resources)
+      if not resources:
+        return
+      cursor.execute(
+        "delete from out_resourcebucket where resource = any(%s)",
+        (resources,)
+        )
+      filter_where = 'where out_resourceplan.resource = any(%s)'
+      params = [resources]
+    cursor.execute('''
+      insert into out_resourcebucket
+        (resource, bucket, startdate, enddate, available, unavailable, setup, load)
+      select
+        out_resourceplan.resource, common_bucketdetail.bucket_id,
+        common_bucketdetail.startdate, common_bucketdetail.enddate,
+        coalesce(%s, 0),
+        coalesce(%s, 0),
+        coalesce(%s, 0),
+        coalesce(%s, 0)
+      from out_resourceplan
+      inner join common_bucketdetail
+        on out_resourceplan.startdate < common_bucketdetail.enddate
+        and out_resourceplan.enddate > common_bucketdetail.startdate
+      %s
+      group by out_resourceplan.resource, common_bucketdetail.bucket_id,
+        common_bucketdetail.startdate, common_bucketdetail.enddate
+      ''' % (
+        ResourceSummary.densify('available', 'common_bucketdetail.startdate', 'common_bucketdetail.enddate'),
+        ResourceSummary.densify('unavailable', 'common_bucketdetail.startdate', 'common_bucketdetail.enddate'),
+        ResourceSummary.densify('setup', 'common_bucketdetail.startdate', 'common_bucketdetail.enddate'),
+        ResourceSummary.densify('load', 'common_bucketdetail.startdate', 'common_bucketdetail.enddate'),
+        filter_where
+      ), params)
+
+
+class Pegging(models.Model):
+  '''
+  The pegging of each demand, stored as one record per pegged operationplan.
+  The records of a demand are numbered in the order of its pegging.
+  '''
+  demand = models.CharField(_('demand'), max_length=300, db_index=True)
+  operationplan = models.IntegerField(_('operationplan'), db_index=True)
+  sequence = models.IntegerField(_('sequence'))
+  level = models.IntegerField(_('level'))
+  quantity = models.DecimalField(_('quantity'), max_digits=15, decimal_places=6)
+
+  class Meta:
+    db_table = 'out_pegging'
+    ordering = ['demand', 'sequence']
+    verbose_name = 'pegging'  # No need to translate these since only used internally
+    verbose_name_plural = 'peggings'
+
+  @staticmethod
+  def demands(operationplan, limit=None):
+    '''
+    Returns a SQL expression that lists the demands pegged to an
+    operationplan, as "quantity : demand" pairs separated with a comma.
+    The operationplan is a SQL expression with its identifier.
+    '''
+    return '''
+      (select string_agg(peg.quantity || ' : ' || peg.demand, ', ')
+      from (
+        select demand, sum(quantity)::float8 as quantity
+        from out_pegging
+        where out_pegging.operationplan = %s
+        group by demand
+        order by demand desc
+        %s
+        ) peg)
+      ''' % (operationplan, ('limit %d' % limit) if limit else '')
+
+
+class ProblemSummary(models.Model):
+  '''
+  The number and total weight of the problems of every entity and type.
+  This summary is computed during the export of the plan. Like the problems
+  themselves, it only changes when the plan is generated again.
+  '''
+  entity = models.CharField(_('entity'), max_length=15)
+  name = models.CharField(_('name'), max_length=20)
+  count = models.IntegerField(_('count'))
+  weight = models.DecimalField(_('weight'), max_digits=20, decimal_places=6)
+
+  class Meta:
+    db_table = 'out_problemsummary'
+    ordering = ['entity', 'name']
+    unique_together = (('entity', 'name'),)
+    verbose_name = 'problem summary'  # No need to translate these since only used internally
+    verbose_name_plural = 'problem summaries'
+
+  @classmethod
+  def refresh(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Recomputes the summary from the problem table.
+    '''
+    cursor = connections[database].cursor()
+    cursor.execute("truncate table out_problemsummary")
+    cursor.execute('''
+      insert into out_problemsummary (entity, name, count, weight)
+      select entity, name, count(*), sum(weight)
+      from out_problem
+      group by entity, name
+      ''')
+
+
+class KPI(models.Model):
+  '''
+  The performance indicators of the plan, displayed in the KPI report.
+  The indicators are computed during the export of the plan, and again by
+  the report when the data changed since.
+  '''
+  sequence = models.IntegerField(_('sequence'))
+  category = models.CharField(_('category'), max_length=20)
+  name = models.CharField(_('name'), max_length=30)
+  value = models.DecimalField(_('value'), max_digits=20, decimal_places=6)
+
+  class Meta:
+    db_table = 'out_kpi'
+    ordering = ['sequence', 'id']
+    verbose_name = 'kpi'  # No need to translate these since only used internally
+    verbose_name_plural = 'kpis'
+
+  @classmethod
+  def refresh(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Recomputes the indicators from the plan tables.
+    The problem summary needs to be up to date.
+    '''
+    with transaction.atomic(using=database):
+      cursor = connections[database].cursor()
+      cursor.execute("delete from out_kpi")
+      cursor.execute('''
+        insert into out_kpi (sequence, category, name, value)
+        select 101, 'Problem count', name, sum(count)
+        from out_problemsummary
+        group by name
+        union all
+        select 102, 'Problem weight', name, round(sum(weight))
+        from out_problemsummary
+        group by name
+        union all
+        select 201, 'Demand', 'Requested', coalesce(round(sum(quantity)),0)
+        from demand
+        where status in ('open', 'quote')
+        union all
+        select 202, 'Demand', 'Planned', coalesce(round(sum(quantity)),0)
+        from operationplan
+        where demand_id is not null and owner_id is null
+        union all
+        select 203, 'Demand', 'Planned late', coalesce(round(sum(quantity)),0)
+        from operationplan
+        where enddate > due and demand_id is not null and owner_id is null
+        union all
+        select 204, 'Demand', 'Planned on time', coalesce(round(sum(quantity)),0)
+        from operationplan
+        where enddate <= due and demand_id is not null and owner_id is null
+        union all
+        select 205, 'Demand', 'Unplanned', coalesce(round(sum(weight)),0)
+        from out_problemsummary
+        where name = 'unplanned'
+        union all
+        select 206, 'Demand', 'Total lateness', coalesce(round(sum(quantity * extract(epoch from enddate - due)) / 86400),0)
+        from operationplan
+        where enddate > due and demand_id is not null and owner_id is null
+        union all
+        select 301, 'Operation', 'Count', count(*)
+        from operationplan
+        union all
+        select 301, 'Operation', 'Quantity', coalesce(round(sum(quantity)),0)
+        from operationplan
+        union all
+        select 302, 'Resource', 'Usage', coalesce(round(sum(quantity * extract(epoch from enddate - startdate)) / 86400),0)
+        from operationplanresource
+        union all
+        select 401, 'Material', 'Produced', coalesce(round(sum(quantity)),0)
+        from operationplanmaterial
+        where quantity>0
+        union all
+        select 402, 'Material', 'Consumed', coalesce(round(sum(-quantity)),0)
+        from operationplanmaterial
+        where quantity<0
+        order by 1, 3
+        ''')
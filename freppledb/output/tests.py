@@ -15,7 +15,21 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from django.test import TestCase
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.http import HttpResponse, HttpResponseForbidden
+from django.test import RequestFactory, TestCase
+
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.middleware import MultiDBMiddleware
+from freppledb.common.models import Bucket, BucketDetail, Parameter
+from freppledb.input.models import Demand, OperationPlanMaterial, Resource
+from freppledb.output.models import Pegging, ProblemSummary, ResourceSummary, ResourceBucketSummary
+from freppledb.output.views.buffer import OverviewReport as InventoryReport
+from freppledb.output.views.resource import OverviewReport
+from freppledb.output.views.kpi import Report as KPIReport
 
 
 class OutputTest(TestCase):
@@ -119,3 +133,262 @@ class OutputTest(TestCase):
     response = self.client.get('/kpi/?format=spreadsheetlist')
     self.assertEqual(response.status_code, 200)
     self.assertTrue(response.__getitem__('Content-Type').startswith('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+
+  # Dashboard widget cache
+  def test_widget_cache(self):
+    Dashboard.invalidate(DEFAULT_DB_ALIAS)
+    response = self.client.get('/widget/alerts/')
+    self.assertEqual(response.status_code, 200)
+    self.assertNotContains(response, 'cachetest')
+    # A plan change without invalidation isn't visible yet
+    ProblemSummary.objects.create(entity='demand', name='cachetest', count=1, weight=1)
+    response = self.client.get('/widget/alerts/')
+    self.assertNotContains(response, 'cachetest')
+    # After a plan run the widget is computed again
+    Dashboard.invalidate(DEFAULT_DB_ALIAS)
+    response = self.client.get('/widget/alerts/')
+    self.assertContains(response, 'cachetest')
+
+  def test_widget_cache_invalidation(self):
+    # Saving the preferences of the user doesn't invalidate the cache, but
+    # a data edit does
+    middleware = MultiDBMiddleware()
+    factory = RequestFactory()
+    version = Dashboard.getVersion(DEFAULT_DB_ALIAS)
+    for path in ('/preferences/', '/horizon/', '/settings/'):
+      middleware.process_response(factory.post(path), HttpResponse())
+    middleware.process_response(factory.get('/data/input/item/'), HttpResponse())
+    middleware.process_response(factory.post('/data/input/item/'), HttpResponseForbidden())
+    self.assertEqual(Dashboard.getVersion(DEFAULT_DB_ALIAS), version)
+    middleware.process_response(factory.post('/data/input/item/'), HttpResponse())
+    self.assertNotEqual(Dashboard.getVersion(DEFAULT_DB_ALIAS), version)
+
+  def test_widget_without_cache(self):
+    # Without a shared cache the widgets are always computed again
+    with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+      self.assertIsNone(Dashboard.getCache())
+      response = self.client.get('/widget/alerts/')
+      self.assertNotContains(response, 'cachetest')
+      ProblemSummary.objects.create(entity='demand', name='cachetest', count=1, weight=1)
+      response = self.client.get('/widget/alerts/')
+      self.assertContains(response, 'cachetest')
+
+
+class ResourcePlanTest(TestCase):
+  '''
+  The resource plan is stored sparsely. The reports expand it into days,
+  and must give the same results as a dense daily resource plan.
+  '''
+
+  def setUp(self):
+    Parameter.objects.update_or_create(name='loading_time_units', defaults={'value': 'hours'})
+    Resource.objects.create(name='daily')
+    Resource.objects.create(name='weekly', type='buckets')
+    bucket = Bucket.objects.create(name='week', level=3)
+    for i in range(6):
+      start = datetime(2018, 10, 1) + timedelta(weeks=i)
+      BucketDetail.objects.create(
+        bucket=bucket, name=str(start.date()), startdate=start, enddate=start + timedelta(weeks=1)
+        )
+    # Records of (resource, start, end, available, unavailable, setup, load).
+    # The first record spans the change to winter time on october 28th.
+    # The bucketized resource has a record on the first day of its buckets.
+    records = [
+      ('daily', datetime(2018, 10, 10), datetime(2018, 10, 31), 8, 16, 1, 2),
+      ('daily', datetime(2018, 10, 31), datetime(2018, 11, 3), 8, 16, 0, 5),
+      ('weekly', datetime(2018, 10, 15), datetime(2018, 10, 16), 40, 0, 0, 10),
+      ('weekly', datetime(2018, 10, 22), datetime(2018, 10, 23), 40, 0, 2, 20),
+      ('weekly', datetime(2018, 10, 29), datetime(2018, 10, 30), 40, 0, 0, 30),
+      ]
+    self.dense = {}
+    for res, start, end, available, unavailable, setup, load in records:
+      ResourceSummary.objects.create(
+        resource=res, startdate=start, enddate=end, available=available,
+        unavailable=unavailable, setup=setup, load=load, free=0
+        )
+      while start < end:
+        self.dense[(res, start)] = (available, unavailable, setup, load)
+        start += timedelta(days=1)
+
+  def getDense(self, resource, start, end):
+    # Total of the dense plan over the days starting between two dates
+    total = [0, 0, 0, 0]
+    for (res, day), values in self.dense.items():
+      if res == resource and start <= day < end:
+        total = [i + j for i, j in zip(total, values)]
+    return total
+
+  def test_densify(self):
+    cursor = connections[DEFAULT_DB_ALIAS].cursor()
+    for start, end in [
+      (datetime(2018, 10, 1), datetime(2018, 12, 1)),
+      (datetime(2018, 10, 22), datetime(2018, 10, 29)),
+      (datetime(2018, 10, 27), datetime(2018, 10, 30)),
+      (datetime(2018, 10, 12, 12), datetime(2018, 11, 1, 12)),
+      (datetime(2018, 10, 30), datetime(2018, 11, 2))
+      ]:
+      cursor.execute('''
+        select resource, %s, %s, %s, %s
+        from out_resourceplan
+        where startdate < %%(end)s and enddate > %%(start)s
+        group by resource
+        ''' % tuple(
+          ResourceSummary.densify(f, '%(start)s', '%(end)s')
+          for f in ('available', 'unavailable', 'setup', 'load')
+          ),
+        {'start': start, 'end': end}
+        )
+      result = { i[0]: list(i[1:]) for i in cursor.fetchall() }
+      for res in ('daily', 'weekly'):
+        self.assertEqual(result.get(res, [0, 0, 0, 0]), self.getDense(res, start, end), (res, start, end))
+
+  def test_bucket_summary(self):
+    ResourceBucketSummary.refresh()
+    for i in ResourceBucketSummary.objects.all():
+      self.assertEqual(
+        [i.available, i.unavailable, i.setup, i.load],
+        self.getDense(i.resource, i.startdate, i.enddate)
+        )
+    self.assertEqual(ResourceBucketSummary.objects.filter(resource='daily').count(), 4)
+
+  def checkReport(self):
+    # The buckets at the edges of the report horizon are partly included
+    request = SimpleNamespace(
+      database=DEFAULT_DB_ALIAS, report_bucket='week',
+      report_startdate=datetime(2018, 10, 17), report_enddate=datetime(2018, 11, 1)
+      )
+    OverviewReport.initialize(request)
+    result = {
+      (i['resource'], i['startdate']): [i['available'], i['unavailable'], i['setup'], i['load']]
+      for i in OverviewReport.query(request, Resource.objects.all())
+      }
+    buckets = BucketDetail.objects.filter(enddate__gt=request.report_startdate, startdate__lt=request.report_enddate)
+    self.assertEqual(len(result), 2 * buckets.count())
+    for i in buckets:
+      for res in ('daily', 'weekly'):
+        self.assertEqual(
+          result[(res, i.startdate.date())],
+          self.getDense(
+            res, max(i.startdate, request.report_startdate), min(i.enddate, request.report_enddate)
+            ),
+          (res, i.startdate)
+          )
+
+  def test_report(self):
+    # Without a summary the report reads the resource plan
+    self.checkReport()
+    ResourceBucketSummary.refresh()
+    self.checkReport()
+    # Buckets that changed after the summary was computed are read from the
+    # resource plan as well
+    BucketDetail.objects.filter(startdate=datetime(2018, 10, 22)).update(enddate=datetime(2018, 10, 26))
+    BucketDetail.objects.create(
+      bucket_id='week', name='2018-10-26', startdate=datetime(2018, 10, 26), enddate=datetime(2018, 10, 29)
+      )
+    self.checkReport()
+
+
+class InventoryReportTest(TestCase):
+  '''
+  Compares the inventory report with the inventory profile computed the
+  way the report did before: the onhand at the start of the horizon is the
+  onhand of the material flow with the highest id before the horizon, and
+  the end inventory is accumulated bucket per bucket.
+  '''
+
+  fixtures = ["demo"]
+
+  def getPrevious(self, request):
+    flows = {}
+    for i in OperationPlanMaterial.objects.order_by('id'):
+      flows.setdefault('%s @ %s' % (i.item_id, i.location_id), []).append(i)
+    buckets = BucketDetail.objects.filter(
+      bucket=request.report_bucket, enddate__gt=request.report_startdate,
+      startdate__lt=request.report_enddate
+      ).order_by('startdate')
+    result = []
+    for buf in sorted(flows):
+      endoh = 0
+      for i in flows[buf]:
+        if i.flowdate < request.report_startdate:
+          endoh = float(i.onhand)
+      for b in buckets:
+        startoh = endoh
+        quantities = [
+          float(i.quantity) for i in flows[buf]
+          if b.startdate <= i.flowdate < b.enddate
+          and request.report_startdate <= i.flowdate < request.report_enddate
+          ]
+        endoh += sum(quantities)
+        result.append((
+          buf, b.name, b.startdate.date(), round(startoh, 1),
+          round(sum(q for q in quantities if q > 0), 1),
+          round(-sum(q for q in quantities if q < 0), 1),
+          round(endoh, 1)
+          ))
+    return result
+
+  def test_report(self):
+    for bucket, start, end in [
+      ('month', datetime(2014, 1, 1), datetime(2014, 5, 1)),
+      ('week', datetime(2014, 1, 1), datetime(2014, 4, 1)),
+      # Horizons starting halfway the plan and in the middle of a bucket
+      ('week', datetime(2014, 2, 12), datetime(2014, 3, 20)),
+      ('day', datetime(2014, 3, 10), datetime(2014, 3, 31)),
+      ]:
+      request = SimpleNamespace(
+        database=DEFAULT_DB_ALIAS, report_bucket=bucket,
+        report_startdate=start, report_enddate=end
+        )
+      InventoryReport.initialize(request)
+      result = [
+        (
+          i['buffer'], i['bucket'], i['startdate'], i['startoh'],
+          float(i['produced']), float(i['consumed']), i['endoh']
+        )
+        for i in InventoryReport.query(
+          request, InventoryReport.basequeryset(request, (), {})
+          )
+        ]
+      self.assertEqual(result, self.getPrevious(request), (bucket, start, end))
+
+
+class PeggingTest(TestCase):
+
+  def test_demands(self):
+    # An operationplan can be pegged more than once to the same demand
+    for demand, operationplan, level, quantity in [
+      ('SO 1', 1, 0, 5), ('SO 1', 1, 1, 2.5), ('SO 2', 1, 0, 1),
+      ('SO 3', 1, 2, 4), ('SO 3', 2, 0, 8)
+      ]:
+      Pegging.objects.create(
+        demand=demand, operationplan=operationplan, sequence=level,
+        level=level, quantity=quantity
+        )
+    cursor = connections[DEFAULT_DB_ALIAS].cursor()
+    cursor.execute("select %s, %s, %s" % (
+      Pegging.demands('1'), Pegging.demands('1', limit=2), Pegging.demands('3')
+      ))
+    self.assertEqual(
+      cursor.fetchone(),
+      ('4 : SO 3, 1 : SO 2, 7.5 : SO 1', '4 : SO 3, 1 : SO 2', None)
+      )
+
+
+class KPITest(TestCase):
+
+  fixtures = ["demo"]
+
+  def getRequested(self):
+    request = SimpleNamespace(database=DEFAULT_DB_ALIAS)
+    for i in KPIReport.query(request, None):
+      if i['category'] == 'Demand' and i['name'] == 'Requested':
+        return i['value']
+
+  def test_data_edit(self):
+    # The indicators follow the edits of the data
+    requested = self.getRequested()
+    Demand.objects.filter(status='open').update(status='closed')
+    Dashboard.invalidate(DEFAULT_DB_ALIAS)
+    self.assertNotEqual(requested, 0)
+    self.assertEqual(self.getRequested(), 0)
@@ -24,6 +24,7 @@ from django.utils.translation import string_concat
 
 from freppledb.boot import getAttributeFields
 from freppledb.input.models import Buffer, Item, Location, OperationPlanMaterial
+from freppledb.output.models import Pegging
 from freppledb.common.report import GridReport, GridPivot, GridFieldText, GridFieldNumber
 from freppledb.common.report import GridFieldDateTime, GridFieldInteger, GridFieldDuration
 from freppledb.common.report import GridFieldCurrency, GridFieldLastModified
@@ -124,34 +125,10 @@ class OverviewReport(GridPivot):
     cursor = connections[request.database].cursor()
     basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)
 
-    # Execute a query  to get the onhand value at the start of our horizon
-    startohdict = {}
-    query = '''
-      select opplanmat.item_id, opplanmat.location_id, sum(oh.onhand)
-      from (%s) opplanmat
-      inner join (
-        select operationplanmaterial.item_id,
-          operationplanmaterial.location_id,
-          operationplanmaterial.onhand as onhand
-        from operationplanmaterial,
-          (select item_id, location_id, max(id) as id
-           from operationplanmaterial
-           where flowdate < '%s'
-           group by item_id, location_id
-          ) maxid
-        where maxid.item_id = operationplanmaterial.item_id
-          and maxid.location_id = operationplanmaterial.location_id
-        and maxid.id = operationplanmaterial.id
-      ) oh
-      on oh.item_id = opplanmat.item_id
-      and oh.location_id = opplanmat.location_id
-      group by opplanmat.item_id, opplanmat.location_id
-      ''' % (basesql, request.report_startdate)
-    cursor.execute(query, baseparams)
-    for row in cursor.fetchall():
-      startohdict[ "%s @ %s" % (row[0], row[1]) ] = float(row[2])
-
-    # Execute the actual query
+    # Execute the query.
+    # The onhand at the start of the horizon is the onhand of the last material
+    # flow before the horizon. It is found with an index lookup per buffer.
+    # The end inventory of each bucket is a running total over the buckets.
     query = '''
       select
         invplan.item_id || ' @ ' || invplan.location_id,
@@ -161,14 +138,28 @@ class OverviewReport(GridPivot):
         location.subcategory, location.available_id, location.owner_id, 
         location.source, location.lastmodified, %s
         invplan.bucket, invplan.startdate, invplan.enddate,
-        invplan.consumed, invplan.produced
+        invplan.consumed, invplan.produced, invplan.endoh
       from (
         select
           opplanmat.item_id, opplanmat.location_id,
           d.bucket as bucket, d.startdate as startdate, d.enddate as enddate,
           coalesce(sum(greatest(operationplanmaterial.quantity, 0)),0) as consumed,
-          coalesce(-sum(least(operationplanmaterial.quantity, 0)),0) as produced
+          coalesce(-sum(least(operationplanmaterial.quantity, 0)),0) as produced,
+          coalesce(max(startoh.onhand), 0) + sum(coalesce(sum(operationplanmaterial.quantity), 0)) over (
+            partition by opplanmat.item_id, opplanmat.location_id
+            order by d.startdate
+            ) as endoh
         from (%s) opplanmat
+        -- Onhand at the start of the horizon
+        left join lateral (
+          select onhand
+          from operationplanmaterial
+          where operationplanmaterial.item_id = opplanmat.item_id
+          and operationplanmaterial.location_id = opplanmat.location_id
+          and operationplanmaterial.flowdate < %%s
+          order by operationplanmaterial.flowdate desc, operationplanmaterial.id desc
+          limit 1
+          ) startoh on true
         -- Multiply with buckets
         cross join (
              select name as bucket, startdate, enddate
@@ -196,22 +187,17 @@ class OverviewReport(GridPivot):
       )
     cursor.execute(
       query, baseparams + (
+        request.report_startdate,
         request.report_bucket, request.report_startdate,
         request.report_enddate, request.report_startdate, request.report_enddate
         )
       )
 
     # Build the python result
-    prevbuf = None
     for row in cursor.fetchall():
       numfields = len(row)
-      if row[0] != prevbuf:
-        prevbuf = row[0]
-        startoh = startohdict.get(prevbuf, 0)
-        endoh = startoh + float(row[numfields - 2] - row[numfields - 1])
-      else:
-        startoh = endoh
-        endoh += float(row[numfields - 2] - row[numfields - 1])
+      endoh = float(row[numfields - 1])
+      startoh = endoh - float(row[numfields - 3] - row[numfields - 2])
       res = {
         'buffer': row[0],
         'item': row[1],
@@ -229,12 +215,12 @@ class OverviewReport(GridPivot):
         'location__owner_id': row[13],
         'location__source': row[14],
         'location__lastmodified': row[15],
-        'bucket': row[numfields - 5],
-        'startdate': row[numfields - 4].date(),
-        'enddate': row[numfields - 3].date(),
+        'bucket': row[numfields - 6],
+        'startdate': row[numfields - 5].date(),
+        'enddate': row[numfields - 4].date(),
         'startoh': round(startoh, 1),
-        'produced': round(row[numfields - 2], 1),
-        'consumed': round(row[numfields - 1], 1),
+        'produced': round(row[numfields - 3], 1),
+        'consumed': round(row[numfields - 2], 1),
         'endoh': round(endoh, 1),
         }
       # Add attribute fields
@@ -255,6 +241,7 @@ class DetailReport(GridReport):
   template = 'input/operationplanreport.html'
   title = _("Inventory detail report")
   model = OperationPlanMaterial
+  estimateCount = True
   permissions = (('view_inventory_report', 'Can view inventory report'),)
   frozenColumns = 0
   editable = False
@@ -272,7 +259,7 @@ class DetailReport(GridReport):
     else:
       base = OperationPlanMaterial.objects
     return base.select_related().extra(select={
-      'pegging': "(select string_agg(value || ' : ' || key, ', ') from (select key, value from jsonb_each_text(plan->'pegging') order by key desc) peg)"
+      'pegging': Pegging.demands('operationplanmaterial.operationplan_id')
       })
 
   @classmethod
@@ -25,8 +25,9 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import force_text
 
 from freppledb.boot import getAttributeFields
-from freppledb.input.models import Demand, Item, PurchaseOrder, DistributionOrder
+from freppledb.input.models import Item, PurchaseOrder, DistributionOrder
 from freppledb.input.models import DeliveryOrder, ManufacturingOrder
+from freppledb.output.models import Pegging
 from freppledb.common.report import GridReport, GridPivot, GridFieldText
 from freppledb.common.report import GridFieldNumber, GridFieldDateTime, GridFieldInteger
 
@@ -201,6 +202,7 @@ class DetailReport(GridReport):
   template = 'output/demandplan.html'
   title = _("Demand plan detail")
   model = DeliveryOrder
+  estimateCount = True
   permissions = (("view_demand_report", "Can view demand report"),)
   frozenColumns = 0
   editable = False
@@ -259,10 +261,10 @@ def OperationPlans(request):
   so_list = request.GET.getlist('demand')
 
   # Collect operationplans associated with the sales order(s)
-  id_list = []
-  for dm in Demand.objects.all().using(request.database).filter(pk__in=so_list).only('plan'):
-    for op in dm.plan['pegging']:
-      id_list.append(op['opplan'])
+  id_list = list(
+    Pegging.objects.all().using(request.database)
+    .filter(demand__in=so_list).values_list('operationplan', flat=True)
+    )
 
   # Collect details on the operationplans
   result = []
@@ -18,8 +18,10 @@
 from django.utils.translation import ugettext_lazy as _
 from django.db import connections
 
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import Parameter
 from freppledb.common.report import GridReport, GridFieldText, GridFieldInteger
+from freppledb.output.models import KPI
 
 
 class Report(GridReport):
@@ -40,58 +42,21 @@ class Report(GridReport):
 
   @staticmethod
   def query(request, basequery):
-    # Execute the query
+    # The indicators are computed during the export of the plan. After a
+    # data edit the version stamp of the scenario changes, and the indicators
+    # are computed again. Without a shared cache to store the version stamp,
+    # they are always computed again.
+    version = Dashboard.getVersion(request.database)
+    cachekey = 'kpi:version:%s' % request.database
+    if version is None or Dashboard.getCache().get(cachekey) != version:
+      KPI.refresh(request.database)
+      if version is not None:
+        Dashboard.getCache().set(cachekey, version, None)
     cursor = connections[request.database].cursor()
     cursor.execute('''
-      select 101 as id, 'Problem count' as category, name as name, count(*) as value
-      from out_problem
-      group by name
-      union all
-      select 102, 'Problem weight', name, round(sum(weight))
-      from out_problem
-      group by name
-      union all
-      select 201, 'Demand', 'Requested', coalesce(round(sum(quantity)),0)
-      from demand
-      where status in ('open', 'quote')
-      union all
-      select 202, 'Demand', 'Planned', coalesce(round(sum(quantity)),0)
-      from operationplan
-      where demand_id is not null and owner_id is null
-      union all
-      select 203, 'Demand', 'Planned late', coalesce(round(sum(quantity)),0)
-      from operationplan
-      where enddate > due and demand_id is not null and owner_id is null
-      union all
-      select 204, 'Demand', 'Planned on time', coalesce(round(sum(quantity)),0)
-      from operationplan
-      where enddate <= due and demand_id is not null and owner_id is null
-      union all
-      select 205, 'Demand', 'Unplanned', coalesce(round(sum(weight)),0)
-      from out_problem
-      where name = 'unplanned'
-      union all
-      select 206, 'Demand', 'Total lateness', coalesce(round(sum(quantity * extract(epoch from enddate - due)) / 86400),0)
-      from operationplan
-      where enddate > due and demand_id is not null and owner_id is null
-      union all
-      select 301, 'Operation', 'Count', count(*)
-      from operationplan
-      union all
-      select 301, 'Operation', 'Quantity', coalesce(round(sum(quantity)),0)
-      from operationplan
-      union all
-      select 302, 'Resource', 'Usage', coalesce(round(sum(quantity * extract(epoch from enddate - startdate)) / 86400),0)
-      from operationplanresource
-      union all
-      select 401, 'Material', 'Produced', coalesce(round(sum(quantity)),0)
-      from operationplanmaterial
-      where quantity>0
-      union all
-      select 402, 'Material', 'Consumed', coalesce(round(sum(-quantity)),0)
-      from operationplanmaterial
-      where quantity<0
-      order by 1
+      select sequence, category, name, value
+      from out_kpi
+      order by sequence, id
       '''
       )
 
@@ -81,18 +81,14 @@ class ReportByDemand(GridReport):
     # Get the earliest and latest operationplan, and the demand due date
     cursor = connections[request.database].cursor()
     cursor.execute('''
-      with dmd as (
-        select
-          due,
-          cast(jsonb_array_elements(plan->'pegging')->>'opplan' as integer) opplan
-        from demand
-        where name = %s
-        )
-      select min(dmd.due), min(startdate), max(enddate)
-      from dmd
+      select min(demand.due), min(startdate), max(enddate)
+      from out_pegging
+      inner join demand
+      on demand.name = out_pegging.demand
       inner join operationplan
-      on dmd.opplan = operationplan.id
+      on out_pegging.operationplan = operationplan.id
       and type <> 'STCK'
+      where out_pegging.demand = %s
       ''', (args[0]))
     x = cursor.fetchone()
     (due, start, end) = x
@@ -142,19 +138,13 @@ class ReportByDemand(GridReport):
     query = '''
       with pegging as (
         select
-          min(rownum) as rownum, min(due) as due, opplan, min(lvl) as lvl, sum(quantity) as quantity
-        from (select
-          row_number() over () as rownum, opplan, due, lvl, quantity
-        from (select
-          due,
-          cast(jsonb_array_elements(plan->'pegging')->>'opplan' as integer) as opplan,
-          cast(jsonb_array_elements(plan->'pegging')->>'level' as integer) as lvl,
-          cast(jsonb_array_elements(plan->'pegging')->>'quantity' as numeric) as quantity
-          from demand
-          where name = %s
-          ) d1
-          )d2
-        group by opplan
+          min(sequence) as rownum, min(demand.due) as due, operationplan as opplan,
+          min(level) as lvl, sum(out_pegging.quantity) as quantity
+        from out_pegging
+        inner join demand
+          on demand.name = out_pegging.demand
+        where out_pegging.demand = %s
+        group by operationplan
         )
       select
         pegging.due, operationplan.name, pegging.lvl, ops.pegged,
@@ -24,6 +24,7 @@ from django.utils.text import capfirst
 from freppledb.boot import getAttributeFields
 from freppledb.input.models import Resource, Location, OperationPlanResource, Operation
 from freppledb.common.models import Parameter
+from freppledb.output.models import ResourceSummary, Pegging
 from freppledb.common.report import GridReport, GridPivot, GridFieldCurrency
 from freppledb.common.report import GridFieldLastModified, GridFieldDuration
 from freppledb.common.report import GridFieldDateTime, GridFieldInteger
@@ -122,6 +123,17 @@ class OverviewReport(GridPivot):
     # Assure the item hierarchy is up to date
     Resource.rebuildHierarchy(database=basequery.db)
 
+    # The resource plan is stored sparsely, and needs to be expanded into
+    # the part of the buckets at the edges of the horizon. The buckets that
+    # aren't in the bucketed summary, eg because they were added after the
+    # last plan export, are also expanded from the resource plan.
+    edge_start = "greatest(d.startdate, '%s')" % request.report_startdate
+    edge_end = "least(d.enddate, '%s')" % request.report_enddate
+    available = ResourceSummary.densify('available', edge_start, edge_end)
+    unavailable = ResourceSummary.densify('unavailable', edge_start, edge_end)
+    load = ResourceSummary.densify('load', edge_start, edge_end)
+    setup = ResourceSummary.densify('setup', edge_start, edge_end)
+
     # Execute the query
     cursor = connections[request.database].cursor()
     query = '''
@@ -129,13 +141,22 @@ class OverviewReport(GridPivot):
         res.type, res.maximum, res.maximum_calendar_id, res.cost, res.maxearly,
         res.setupmatrix_id, res.setup, location.name, location.description,
         location.category, location.subcategory, location.available_id,
-        coalesce(max(plan_summary.avg_util),0) as avgutil,
+        coalesce(
+          sum(
+            coalesce(max(summary.load), %s, 0)
+            + coalesce(max(summary.setup), %s, 0)
+            ) over (partition by res.name) * 100.0
+          / greatest(
+            sum(coalesce(max(summary.available), %s, 0)) over (partition by res.name),
+            0.0001
+            ),
+          0) as avgutil,
         %s
         d.bucket as col1, d.startdate as col2,
-        coalesce(sum(out_resourceplan.available),0) * (case when res.type = 'buckets' then 1 else %f end) as available,
-        coalesce(sum(out_resourceplan.unavailable),0) * (case when res.type = 'buckets' then 1 else %f end) as unavailable,
-        coalesce(sum(out_resourceplan.load),0) * (case when res.type = 'buckets' then 1 else %f end) as loading,
-        coalesce(sum(out_resourceplan.setup),0) * (case when res.type = 'buckets' then 1 else %f end) as setup
+        coalesce(max(summary.available), %s, 0) * (case when res.type = 'buckets' then 1 else %f end) as available,
+        coalesce(max(summary.unavailable), %s, 0) * (case when res.type = 'buckets' then 1 else %f end) as unavailable,
+        coalesce(max(summary.load), %s, 0) * (case when res.type = 'buckets' then 1 else %f end) as loading,
+        coalesce(max(summary.setup), %s, 0) * (case when res.type = 'buckets' then 1 else %f end) as setup
       from (%s) res
       left outer join location
         on res.location_id = location.name
@@ -145,25 +166,21 @@ class OverviewReport(GridPivot):
                    from common_bucketdetail
                    where bucket_id = '%s' and enddate > '%s' and startdate < '%s'
                    ) d
-      -- Utilization info
+      -- Utilization info of buckets completely within the horizon
+      left join out_resourcebucket summary
+      on res.name = summary.resource
+      and summary.bucket = '%s'
+      and summary.startdate = d.startdate
+      and summary.enddate = d.enddate
+      and d.startdate >= '%s'
+      and d.enddate <= '%s'
+      -- Utilization info of the buckets at the edges of the horizon, and of
+      -- the buckets without a summary
       left join out_resourceplan
       on res.name = out_resourceplan.resource
-      and d.startdate <= out_resourceplan.startdate
-      and d.enddate > out_resourceplan.startdate
-      and out_resourceplan.startdate >= '%s'
-      and out_resourceplan.startdate < '%s'
-      -- Average utilization info
-      left join (
-          select
-            resource,
-            ( coalesce(sum(out_resourceplan.load),0) + coalesce(sum(out_resourceplan.setup),0) )
-             * 100.0 / coalesce(greatest(sum(out_resourceplan.available), 0.0001),1) as avg_util
-          from out_resourceplan
-          where out_resourceplan.startdate >= '%s'
-          and out_resourceplan.startdate < '%s'
-          group by resource
-          ) plan_summary
-      on res.name = plan_summary.resource
+      and (d.startdate < '%s' or d.enddate > '%s' or summary.resource is null)
+      and out_resourceplan.startdate < %s
+      and out_resourceplan.enddate > %s
       -- Grouping and sorting
       group by res.name, res.description, res.category, res.subcategory,
         res.type, res.maximum, res.maximum_calendar_id, res.cost, res.maxearly,
@@ -172,11 +189,14 @@ class OverviewReport(GridPivot):
         %s d.bucket, d.startdate
       order by %s, d.startdate
       ''' % (
-        reportclass.attr_sql, units[0], units[0], units[0], units[0],
+        load, setup, available,
+        reportclass.attr_sql, available, units[0], unavailable, units[0],
+        load, units[0], setup, units[0],
         basesql, request.report_bucket, request.report_startdate,
         request.report_enddate,
+        request.report_bucket, request.report_startdate, request.report_enddate,
         request.report_startdate, request.report_enddate,
-        request.report_startdate, request.report_enddate,
+        edge_end, edge_start,
         reportclass.attr_sql, sortsql
       )
     cursor.execute(query, baseparams)
@@ -222,6 +242,7 @@ class DetailReport(GridReport):
   template = 'input/operationplanreport.html'
   title = _("Resource detail report")
   model = OperationPlanResource
+  estimateCount = True
   permissions = (("view_resource_report", "Can view resource report"),)
   frozenColumns = 3
   editable = False
@@ -236,7 +257,7 @@ class DetailReport(GridReport):
     else:
       base = OperationPlanResource.objects
     return base.select_related().extra(select={
-      'pegging': "(select string_agg(value || ' : ' || key, ', ') from (select key, value from jsonb_each_text(plan->'pegging') order by key desc) peg)",
+      'pegging': Pegging.demands('operationplanresource.operationplan_id'),
       'duration': "(operationplan.enddate - operationplan.startdate)"
       })
 
@@ -32,6 +32,7 @@ from freppledb.common.models import Parameter
 from freppledb.common.dashboard import Dashboard, Widget
 from freppledb.common.report import GridReport, getCurrency
 from freppledb.input.models import PurchaseOrder, DistributionOrder, OperationPlanResource
+from freppledb.output.models import ResourceSummary
 
 
 class LateOrdersWidget(Widget):
@@ -40,6 +41,7 @@ class LateOrdersWidget(Widget):
   tooltip = _("Shows orders that will be delivered after their due date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/problem/?entity=demand&name=late&sord=asc&sidx=startdate'
   exporturl = True
   limit = 20
@@ -104,6 +106,7 @@ class ShortOrdersWidget(Widget):
   tooltip = _("Shows orders that are not planned completely")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   # Note the gte filter lets pass "short" and "unplanned", and filters out
   # "late" and "early".
   url = '/problem/?entity=demand&name__gte=short&sord=asc&sidx=startdate'
@@ -165,6 +168,7 @@ class ManufacturingOrderWidget(Widget):
   tooltip = _("Shows manufacturing orders by start date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/manufacturingorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -394,6 +398,7 @@ class DistributionOrderWidget(Widget):
   tooltip = _("Shows distribution orders by start date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/distributionorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -619,6 +624,7 @@ class PurchaseOrderWidget(Widget):
   tooltip = _("Shows purchase orders by ordering date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/purchaseorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -872,6 +878,7 @@ class PurchaseQueueWidget(Widget):
   tooltip = _("Display a list of new purchase orders")
   permissions = (("view_purchaseorder", "Can view purchase orders"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/purchaseorder/?status=proposed&sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -912,6 +919,7 @@ class DistributionQueueWidget(Widget):
   tooltip = _("Display a list of new distribution orders")
   permissions = (("view_distributionorder", "Can view distribution orders"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/distributionorder/?status=proposed&sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -952,6 +960,7 @@ class ShippingQueueWidget(Widget):
   tooltip = _("Display a list of new distribution orders")
   permissions = (("view_distributionorder", "Can view distribution orders"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/distributionorder/?sidx=plandate&sord=asc'
   exporturl = True
   limit = 20
@@ -993,6 +1002,7 @@ class ResourceQueueWidget(Widget):
   tooltip = _("Display planned activities for the resources")
   permissions = (("view_resource_report", "Can view resource report"),)
   asynchronous = True
+  cacheable = True
   url = '/loadplan/?sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -1033,6 +1043,7 @@ class PurchaseAnalysisWidget(Widget):
   tooltip = _("Analyse the urgency of existing purchase orders")
   permissions = (("view_purchaseorder", "Can view purchase orders"),)
   asynchronous = True
+  cacheable = True
   url = '/data/input/purchaseorder/?status=confirmed&sidx=color&sord=asc'
   limit = 20
 
@@ -1073,6 +1084,7 @@ class AlertsWidget(Widget):
   tooltip = _("Overview of all alerts in the plan")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/problem/'
   entities = 'material,capacity,demand,operation'
 
@@ -1091,8 +1103,8 @@ class AlertsWidget(Widget):
         )
       ]
     cursor = connections[db].cursor()
-    query = '''select name, count(*), sum(weight)
-      from out_problem
+    query = '''select name, sum(count), sum(weight)
+      from out_problemsummary
       where entity in (%s)
       group by name
       order by name
@@ -1143,6 +1155,7 @@ class ResourceLoadWidget(Widget):
   tooltip = _("Shows the resources with the highest utilization")
   permissions = (("view_resource_report", "Can view resource report"),)
   asynchronous = True
+  cacheable = True
   url = '/resource/'
   exporturl = True
   limit = 5
@@ -1211,20 +1224,28 @@ class ResourceLoadWidget(Widget):
       ]
     cursor = connections[request.database].cursor()
     GridReport.getBuckets(request)
+    # The resource plan is stored sparsely, and is expanded into the days
+    # of the reporting horizon
+    load = ResourceSummary.densify('load', '%(start)s', '%(end)s')
+    setup = ResourceSummary.densify('setup', '%(start)s', '%(end)s')
+    available = ResourceSummary.densify('available', '%(start)s', '%(end)s')
+    free = ResourceSummary.densify('free', '%(start)s', '%(end)s')
     query = '''select
                   resource,
-                  ( coalesce(sum(out_resourceplan.load),0) + coalesce(sum(out_resourceplan.setup),0) )
-                   * 100.0 / coalesce(sum(out_resourceplan.available)+0.000001,1) as avg_util,
-                  coalesce(sum(out_resourceplan.load),0) + coalesce(sum(out_resourceplan.setup),0),
-                  coalesce(sum(out_resourceplan.free),0)
+                  ( coalesce(%s,0) + coalesce(%s,0) )
+                   * 100.0 / coalesce(%s+0.000001,1) as avg_util,
+                  coalesce(%s,0) + coalesce(%s,0),
+                  coalesce(%s,0)
                 from out_resourceplan
-                where out_resourceplan.startdate >= %s
-                  and out_resourceplan.startdate < %s
+                where out_resourceplan.startdate < %%(end)s
+                  and out_resourceplan.enddate > %%(start)s
                 group by resource
                 order by 2 desc
-                limit %s
-              '''
-    cursor.execute(query, (request.report_startdate, request.report_enddate, limit))
+                limit %%(limit)s
+              ''' % (load, setup, available, load, setup, free)
+    cursor.execute(query, {
+      'start': request.report_startdate, 'end': request.report_enddate, 'limit': limit
+      })
     for res in cursor.fetchall():
       result.append('<tr><td><a href="%s/resource/%s/">%s</a></td><td class="util">%.2f</td></tr>' % (
         request.prefix, urlquote(res[0]), res[0], res[1]
@@ -1242,6 +1263,7 @@ class InventoryByLocationWidget(Widget):
   title = _("inventory by location")
   tooltip = _("Display the locations with the highest inventory value")
   asynchronous = True
+  cacheable = True
   limit = 5
 
   def args(self):
@@ -1334,6 +1356,7 @@ class InventoryByItemWidget(Widget):
   title = _("inventory by item")
   tooltip = _("Display the items with the highest inventory value")
   asynchronous = True
+  cacheable = True
   limit = 20
 
   def args(self):
@@ -1423,6 +1446,7 @@ class DeliveryPerformanceWidget(Widget):
   title = _("delivery performance")
   tooltip = _("Shows the percentage of demands that are planned to be shipped completely on time")
   asynchronous = True
+  cacheable = True
   green = 90
   yellow = 80
 
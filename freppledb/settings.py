@@ -163,6 +163,21 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = True    # Whether sessions expire when a user
 
 MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.SessionStorage'
 
+# Caches
+# The dashboard cache is shared between the web server and the worker
+# processes, which invalidate it after each plan run.
+CACHES = {
+  'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+  'dashboard': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(FREPPLE_LOGDIR, 'cache'),
+    'TIMEOUT': 86400,
+    'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+  }
+
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
 # A list of strings representing the host/domain names the application can serve.